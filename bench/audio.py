@@ -0,0 +1,74 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+from bench import commands, jobs
+
+# Pipe buffer between BePipe and NeroAAC. Large enough that the decoder rarely waits on the
+# encoder, and the default limit for unprivileged users on Linux
+PIPE_SIZE = 1024 * 1024
+
+
+def track_dest_loc(audio_dest_loc, track_num):
+    """The file location the given audio track of audio_dest_loc is encoded to, e.g.
+    'folder\\test.track01.m4a' for track 0 of 'folder\\test.m4a'"""
+    base, ext = os.path.splitext(audio_dest_loc)
+    return '{0}.track{1:02d}{2}'.format(base, track_num + 1, ext)
+
+
+def add_audio_track_jobs(graph, bepipe_loc, nero_loc, scripts, audio_dest_loc, nero_args=None):
+    """Add one BePipe into NeroAAC job per audio track. The jobs don't depend on each other, so
+    run_jobs encodes the tracks concurrently, alongside the video. Each job pipes BePipe straight
+    into NeroAAC without a shell. See commands.PipedCommand.
+
+    Arguments:
+    Note: All file location strings have Parentheses wrapped around them by the commands.
+
+    graph: The jobs.JobGraph
+    bepipe_loc: string file location of the BePipe executable
+    nero_loc: string file location of the NeroAAC executable
+    scripts: list of string script arguments to BePipe, one per track, e.g. one for each of the
+        BlurayTitleInfo.num_audio_tracks tracks
+    audio_dest_loc: string file location the tracks are named after. See track_dest_loc
+    nero_args: Nullable string, string dictionary for the arguments to be passed to NeroAAC
+
+    Returns the list of jobs in track order"""
+
+    if not scripts:
+        raise ValueError('Must give a script for at least one audio track')
+
+    ret = []
+    for track_num, script in enumerate(scripts):
+        dest_loc = track_dest_loc(audio_dest_loc, track_num)
+        command = commands.bePipe_neroAAC_command(bepipe_loc, nero_loc, script, dest_loc,
+                                                  nero_args)
+        command.bufsize = PIPE_SIZE
+        ret.append(graph.add(jobs.Job('Audio ' + dest_loc, command,
+                                      inputs=commands.script_inputs(script), outputs=[dest_loc],
+                                      kind=jobs.Job.AUDIO)))
+    return ret
+
+
+def encode_audio_tracks(bepipe_loc, nero_loc, scripts, audio_dest_loc, nero_args=None,
+                        max_workers=None, runner=jobs.run_command, on_result=None):
+    """Encode every audio track at once, at most one track per CPU. See add_audio_track_jobs for
+    the arguments, and jobs.run_jobs for max_workers, runner and on_result.
+
+    Returns a dictionary of job name to jobs.JobResult in track order"""
+
+    graph = jobs.JobGraph()
+    add_audio_track_jobs(graph, bepipe_loc, nero_loc, scripts, audio_dest_loc, nero_args)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    return jobs.run_jobs(graph, min(max_workers, len(graph)), runner, on_result)
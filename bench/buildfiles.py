@@ -0,0 +1,94 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Write a JobGraph for POSIX build tools instead of as a Windows batch file. A ninja build file or
+Makefile has an edge from every job's inputs to its outputs, so 'ninja -j N' or 'make -j N' runs
+independent jobs in parallel and skips jobs whose outputs are newer than their inputs. Commands
+are quoted for /bin/sh, which both tools run them with."""
+
+import re
+
+
+def posix_line(command):
+    """The command of a Job quoted for a POSIX shell. String commands are used as they are"""
+    if isinstance(command, str):
+        return command
+    return command.posix_line()
+
+
+def write_shell_script(graph, file):
+    """Write every job to file as a serial POSIX shell script in dependency order, stopping at the
+    first failure"""
+    file.write('#!/bin/sh\nset -e\n\n')
+    for job in graph.topological_order():
+        file.write('# ' + _one_line(job.name) + '\n')
+        file.write(_one_line(posix_line(job.command)) + '\n\n')
+
+
+def write_ninja(graph, file):
+    """Write every job to file as a ninja build file. Every job must have an output"""
+    file.write('rule run\n  command = $cmd\n  description = $desc\n\n')
+    for job in graph.topological_order():
+        _check_outputs(job)
+        file.write('build ' + ' '.join(_ninja_path(output) for output in job.outputs)
+                   + ': run')
+        for input_loc in job.inputs:
+            file.write(' ' + _ninja_path(input_loc))
+        file.write('\n  cmd = ' + _ninja_value(posix_line(job.command))
+                   + '\n  desc = ' + _ninja_value(job.name) + '\n\n')
+
+
+def write_makefile(graph, file):
+    """Write every job to file as a GNU Makefile whose default target builds every output. Outputs
+    of a failed job are deleted so they aren't mistaken for finished. Jobs with more than one
+    output need GNU make 4.3 or later. Every job must have an output"""
+    order = graph.topological_order()
+    for job in order:
+        _check_outputs(job)
+    file.write('.DELETE_ON_ERROR:\n.PHONY: all\n\nall:')
+    for job in order:
+        for output in job.outputs:
+            file.write(' ' + _make_path(output))
+    file.write('\n\n')
+    for job in order:
+        file.write('# ' + _one_line(job.name) + '\n')
+        file.write(' '.join(_make_path(output) for output in job.outputs))
+        file.write(' &:' if len(job.outputs) > 1 else ':')
+        for input_loc in job.inputs:
+            file.write(' ' + _make_path(input_loc))
+        file.write('\n\t' + _one_line(posix_line(job.command)).replace('$', '$$') + '\n\n')
+
+
+def _check_outputs(job):
+    if not job.outputs:
+        raise ValueError(job.name + ' has no outputs for the build file to track')
+
+
+def _one_line(text):
+    if '\n' in text or '\r' in text:
+        raise ValueError('Can not write a line break: ' + repr(text))
+    return text
+
+
+def _ninja_path(path):
+    return re.sub(r'([$ :])', r'$\1', _one_line(path))
+
+
+def _ninja_value(value):
+    return _one_line(value).replace('$', '$$')
+
+
+def _make_path(path):
+    # make can't take a $ in a target at all, but escaping it keeps it from expanding
+    return re.sub(r'([ :#\\])', r'\\\1', _one_line(path)).replace('$', '$$')
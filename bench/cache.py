@@ -0,0 +1,144 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import glob
+import hashlib
+import json
+import os
+import tempfile
+
+
+def disc_fingerprint(bd_loc):
+    """Fingerprint of the bluray at bd_loc made from the contents of BDMV/index.bdmv and the name,
+    size and modification time of every playlist. Only reads the metadata files, never the clips.
+    A disc image such as an ISO is fingerprinted by its name, size and modification time instead.
+    Raises OSError if bd_loc is neither an image nor a directory containing BDMV/index.bdmv"""
+
+    if os.path.isfile(bd_loc):
+        stat = os.stat(bd_loc)
+        return hashlib.sha1('image:{0}:{1}:{2}'.format(
+            os.path.basename(bd_loc), stat.st_size, stat.st_mtime_ns).encode()).hexdigest()
+    bdmv = os.path.join(bd_loc, 'BDMV')
+    digest = hashlib.sha1()
+    with open(os.path.join(bdmv, 'index.bdmv'), 'rb') as file:
+        digest.update(file.read())
+    playlist_dir = os.path.join(bdmv, 'PLAYLIST')
+    if os.path.isdir(playlist_dir):
+        for entry in sorted(os.scandir(playlist_dir), key=lambda e: e.name):
+            stat = entry.stat()
+            digest.update('{0}:{1}:{2}\n'.format(entry.name, stat.st_size,
+                                                  stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+class TitleInfoCache:
+
+    """
+    On-disk cache of bluray title information, keyed by disc fingerprint and title number.
+    Pass one of these as the cache argument of disc.BlurayTitleInfo to skip opening the disc when
+    it has been scanned before.
+    Public methods:
+        __init__(cache_dir, max_entries=256):
+            Arguments:
+                cache_dir: [string] The directory to keep the cache in. Created if missing
+                max_entries: [int] The number of titles to keep. The least recently used titles
+                    are evicted beyond this
+        get(bd_loc, title_num): Returns the cached dictionary for the title or None. Discs that
+            can't be fingerprinted always miss
+        put(bd_loc, title_num, data): Stores the JSON serializable dictionary for the title. Does
+            nothing for discs that can't be fingerprinted
+        invalidate(bd_loc): Removes every title of the disc at bd_loc
+        clear(): Removes every title
+    """
+
+    def __init__(self, cache_dir, max_entries=256):
+        if max_entries < 1:
+            raise ValueError('max_entries must be at least 1')
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, bd_loc, title_num):
+        try:
+            path = self._entry_path(disc_fingerprint(bd_loc), title_num)
+        except OSError:
+            return None
+        try:
+            with open(path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return None
+        # Reading doesn't reliably update atime, so the mtime tracks recent use instead
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted by another writer since it was read, which doesn't spoil the data
+            pass
+        return data
+
+    def put(self, bd_loc, title_num, data):
+        try:
+            path = self._entry_path(disc_fingerprint(bd_loc), title_num)
+        except OSError:
+            return
+        # A temporary file per writer, so concurrent puts of the same title don't mix their data
+        fd, temp_path = tempfile.mkstemp('.tmp', os.path.basename(path) + '.', self.cache_dir)
+        try:
+            with open(fd, 'w') as file:
+                json.dump(data, file)
+            os.replace(temp_path, path)
+        except BaseException:
+            _remove(temp_path)
+            raise
+        self._evict()
+
+    def invalidate(self, bd_loc):
+        try:
+            fingerprint = disc_fingerprint(bd_loc)
+        except OSError:
+            return
+        for path in glob.glob(os.path.join(self.cache_dir, fingerprint + '-*.json')):
+            _remove(path)
+
+    def clear(self):
+        for path in self._entries():
+            _remove(path)
+
+    def _entry_path(self, fingerprint, title_num):
+        return os.path.join(self.cache_dir, '{0}-{1}.json'.format(fingerprint, title_num))
+
+    def _entries(self):
+        return glob.glob(os.path.join(self.cache_dir, '*-*.json'))
+
+    def _evict(self):
+        entries = self._entries()
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=_mtime)
+        for path in entries[:len(entries) - self.max_entries]:
+            _remove(path)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return 0
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
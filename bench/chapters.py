@@ -12,11 +12,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+from array import array
 from datetime import datetime, timedelta
+from fractions import Fraction
+from bench import tracing
 
 
 class Chapter:
 
+    __slots__ = ('name', 'start', 'duration')
+
     def __init__(self, name, start, duration):
         self.name = name
         self.start = start
@@ -43,21 +48,14 @@ class Chapter:
 
 
 def remove_chapters_shorter_than(chapters, seconds):
-    for i in range(0, len(chapters)):
-        if (chapters[i].duration - Chapter.min_time).total_seconds() < seconds:
-            del chapters[i]
+    chapters[:] = ChapterPipeline(chapters).remove_shorter_than(seconds)
 
 
+@tracing.traced('chapters.split_chapters')
 def split_chapters(chapters, index):
-    ret = []
-    delta = timedelta()
-    for i in range(0, len(chapters)):
-        if i % index == 0:
-            ret.append([])
-            delta = chapters[i].start - Chapter.min_time
-        ret[-1].append(chapters[i])
-        ret[-1][-1].start = ret[-1][-1].start - delta
-    return ret
+    """Split chapters into lists of index chapters each, with the starts of each list rebased so
+    that its first chapter starts at zero. The given chapters are left untouched"""
+    return list(ChapterPipeline(chapters).split(index))
 
 
 def rename_chapters(chapters, names, repeat=False):
@@ -72,8 +70,362 @@ def rename_chapters(chapters, names, repeat=False):
         chapters[i].name = names[i % len(names)]
 
 
+@tracing.traced('chapters.create_mkv_chapters')
 def create_mkv_chapters(chapters, file):
-    for i in range(0, len(chapters)):
+    """Write chapters to file in the simple mkvmerge chapter format. chapters may be any iterable of
+    Chapter, including a ChapterPipeline, which is evaluated here in a single pass. Nothing is
+    written if the chapters raise, e.g. a ChapterPipeline.rename given too many names"""
+    lines = []
+    for i, chapter in enumerate(chapters):
         base_chapter_str = "CHAPTER{0:02d}".format(i+1)
-        file.write(base_chapter_str + "=" + str(chapters[i].start.time()) + "\n")
-        file.write(base_chapter_str + "NAME=" + chapters[i].name + "\n")
+        lines.append(base_chapter_str + "=" + str(chapter.start.time()) + "\n")
+        lines.append(base_chapter_str + "NAME=" + chapter.name + "\n")
+    file.write(''.join(lines))
+
+
+@tracing.traced('chapters.create_x264_qpfile')
+def create_x264_qpfile(chapters, framerate, file, first_frame=0, num_frames=None):
+    """Write an x264 qpfile to file that forces an IDR frame at the start of every chapter, so the
+    encode can later be cut at chapters without reencoding
+
+    Arguments:
+    chapters: iterable of Chapter
+    framerate: The frame rate in any form parse_frame_rate accepts, e.g.
+        BlurayTitleInfo.frame_rate
+    file: The file
+    first_frame: int frame the encode starts at, e.g. its --seek. Chapters starting before it are
+        left out. Frames are still numbered from the start of the input, as x264 adds the seek
+        to the frame it is encoding before looking it up in the qpfile
+    num_frames: Nullable int number of frames in the encode, e.g. its --frames. Chapters starting
+        after the encode are left out"""
+
+    framerate = parse_frame_rate(framerate)
+    frames = [ticks_to_frames(ticks_from_datetime(chapter.start), framerate)
+              for chapter in chapters]
+    _write_qpfile(file, frames, first_frame, num_frames)
+
+
+class ChapterPipeline:
+
+    """
+    Lazy chain of chapter transforms. Each transform returns a new pipeline and nothing is done
+    until the pipeline is iterated, e.g. by create_mkv_chapters, at which point every chapter passes
+    through all of the transforms once. Transforms yield new Chapter objects instead of modifying
+    the ones they are given, so the source chapters are never changed.
+    Public methods:
+        __init__(chapters):
+            Arguments:
+                chapters: [iterable<Chapter>] The source chapters
+        concat(*sources): Joins chapter sources end to end, e.g. for concatenated discs. Each
+            source is offset by the end of the last chapter of the source before it
+        filter(predicate): Keeps chapters for which predicate(chapter) is true
+        remove_shorter_than(seconds): Drops chapters lasting less than seconds
+        merge_shorter_than(seconds): Folds chapters lasting less than seconds into the chapter
+            before them, or the chapter after them for the first chapter
+        offset(delta): Moves every chapter by delta, either a timedelta or a number of seconds
+        rename(names, repeat=False): Same as rename_chapters. An empty names raises ValueError at
+            once, while mismatched names raise ValueError once the pipeline has been run to its end
+        split(index): Iterates over lists of index chapters each, with the starts of each list
+            rebased so that its first chapter starts at zero. Ends the pipeline. An index below 1
+            raises ValueError at once
+    """
+
+    def __init__(self, chapters):
+        self._chapters = chapters
+
+    def __iter__(self):
+        return iter(self._chapters)
+
+    @staticmethod
+    def concat(*sources):
+        return ChapterPipeline(_concat(sources))
+
+    def filter(self, predicate):
+        return ChapterPipeline(chapter for chapter in self if predicate(chapter))
+
+    def remove_shorter_than(self, seconds):
+        return self.filter(lambda chapter: Chapter.to_seconds(chapter.duration) >= seconds)
+
+    def merge_shorter_than(self, seconds):
+        return ChapterPipeline(_merge_shorter_than(self, seconds))
+
+    def offset(self, delta):
+        if not isinstance(delta, timedelta):
+            delta = timedelta(seconds=delta)
+        return ChapterPipeline(Chapter(chapter.name, chapter.start + delta, chapter.duration)
+                               for chapter in self)
+
+    def rename(self, names, repeat=False):
+        if not names:
+            raise ValueError('Must give at least one name')
+        return ChapterPipeline(_rename(self, names, repeat))
+
+    def split(self, index):
+        # Not a generator itself, so that a bad index raises here rather than on first use
+        if index < 1:
+            raise ValueError('index must be at least 1')
+        return _split(self, index)
+
+
+def _split(chapters, index):
+    group = []
+    delta = timedelta()
+    for chapter in chapters:
+        if len(group) == index:
+            yield group
+            group = []
+        if not group:
+            delta = chapter.start - Chapter.min_time
+        group.append(Chapter(chapter.name, chapter.start - delta, chapter.duration))
+    if group:
+        yield group
+
+
+def _concat(sources):
+    delta = timedelta()
+    for source in sources:
+        end = delta
+        for chapter in source:
+            start = chapter.start + delta
+            end = (start - Chapter.min_time) + (chapter.duration - Chapter.min_time)
+            yield Chapter(chapter.name, start, chapter.duration)
+        delta = end
+
+
+def _merge_shorter_than(chapters, seconds):
+    pending = None
+    for chapter in chapters:
+        if pending is None:
+            pending = Chapter(chapter.name, chapter.start, chapter.duration)
+        elif Chapter.to_seconds(chapter.duration) < seconds \
+                or Chapter.to_seconds(pending.duration) < seconds:
+            pending.duration += chapter.duration - Chapter.min_time
+        else:
+            yield pending
+            pending = Chapter(chapter.name, chapter.start, chapter.duration)
+    if pending is not None:
+        yield pending
+
+
+def _rename(chapters, names, repeat):
+    count = 0
+    for chapter in chapters:
+        if count < len(names) or repeat:
+            chapter = Chapter(names[count % len(names)], chapter.start, chapter.duration)
+        count += 1
+        yield chapter
+    if len(names) > count:
+        raise ValueError('More names provided than there are chapters for')
+    if repeat and count % len(names) != 0:
+        raise ValueError('Number of names does not divide evenly into number of chapters while in '
+                         'repeat mode')
+
+
+TICKS_PER_SECOND = 90000
+
+# libbluray's frame rate codes, which bluread sometimes hands back instead of the rate itself
+_frame_rate_codes = {
+    '1': Fraction(24000, 1001),
+    '2': Fraction(24),
+    '3': Fraction(25),
+    '4': Fraction(30000, 1001),
+    '6': Fraction(50),
+    '7': Fraction(60000, 1001)
+}
+
+# Rounded NTSC rates as they are usually written, e.g. in BlurayTitleInfo.frame_rate
+_ntsc_frame_rates = {
+    '23.976': Fraction(24000, 1001),
+    '29.97': Fraction(30000, 1001),
+    '59.94': Fraction(60000, 1001)
+}
+
+
+def parse_frame_rate(frame_rate):
+    """Exact frame rate from a string such as '23.976', '24000/1001' or '25', or a libbluray frame
+    rate code. Rounded NTSC rates are taken to mean their exact 1000/1001 rate.
+    Raises ValueError if the frame rate can't be understood"""
+
+    if isinstance(frame_rate, Fraction):
+        return frame_rate
+    frame_rate = str(frame_rate).strip()
+    if frame_rate in _ntsc_frame_rates:
+        return _ntsc_frame_rates[frame_rate]
+    if frame_rate in _frame_rate_codes:
+        return _frame_rate_codes[frame_rate]
+    try:
+        ret = Fraction(frame_rate)
+    except (ValueError, ZeroDivisionError):
+        raise ValueError('Unrecognized frame rate: ' + frame_rate) from None
+    if ret <= 0:
+        raise ValueError('Frame rate must be positive: ' + frame_rate)
+    return ret
+
+
+def format_ms(ms):
+    """Milliseconds formatted the way bluread's *Fancy members are, e.g. '01:02:03.456'"""
+    seconds, ms = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0:02d}:{1:02d}:{2:02d}.{3:03d}'.format(hours, minutes, seconds, ms)
+
+
+def ticks_from_timestamp(timestamp):
+    """90 kHz ticks of a timestamp in the form HH:MM:SS.fff. Exact up to microsecond precision"""
+    hours, minutes, seconds = timestamp.split(':')
+    whole, _, fraction = seconds.partition('.')
+    fraction = (fraction + '000000')[:6]
+    microseconds = ((int(hours) * 60 + int(minutes)) * 60 + int(whole)) * 1000000 + int(fraction)
+    return _ticks_from_microseconds(microseconds)
+
+
+def ticks_from_datetime(val):
+    """90 kHz ticks of one of Chapter's datetime values"""
+    return _ticks_from_microseconds((val - Chapter.min_time) // timedelta(microseconds=1))
+
+
+def ticks_to_frames(ticks, framerate):
+    """The nearest frame number to 90 kHz ticks, computed exactly. framerate may be anything
+    parse_frame_rate accepts"""
+    framerate = parse_frame_rate(framerate)
+    numerator = ticks * framerate.numerator
+    denominator = TICKS_PER_SECOND * framerate.denominator
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+def format_ticks(ticks):
+    """90 kHz ticks formatted the way str(datetime.time) would, as used by create_mkv_chapters"""
+    microseconds = (ticks * 100 + 4) // 9
+    seconds, microseconds = divmod(microseconds, 1000000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    if microseconds:
+        return '{0:02d}:{1:02d}:{2:02d}.{3:06d}'.format(hours, minutes, seconds, microseconds)
+    return '{0:02d}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+class ChapterTable:
+
+    """
+    Columnar list of chapters with starts and durations stored as integer 90 kHz ticks, the clock
+    blurays use, so no datetime objects are made and frame math is exact.
+    Operations return new tables rather than modifying the table they are called on.
+    Public methods:
+        __init__(names=None, starts=None, durations=None):
+            Arguments:
+                names: [nullable list<string>] The chapter names
+                starts: [nullable iterable<int>] The start of each chapter in 90 kHz ticks
+                durations: [nullable iterable<int>] The duration of each chapter in 90 kHz ticks
+        from_chapters(chapters): Makes a table from a list of Chapter
+        to_chapters(): Makes a list of Chapter from the table
+        remove_shorter_than(seconds): Equivalent of remove_chapters_shorter_than
+        split(index): Equivalent of split_chapters
+        rename(names, repeat=False): Equivalent of rename_chapters
+        start_frames(framerate): array<int> of the frame each chapter starts on
+        write_mkv(file): Equivalent of create_mkv_chapters
+        write_qpfile(file, framerate, first_frame=0, num_frames=None): Equivalent of
+            create_x264_qpfile
+
+    Public data members:
+        names: [list<string>] The chapter names
+        starts: [array<int>] The start of each chapter in 90 kHz ticks
+        durations: [array<int>] The duration of each chapter in 90 kHz ticks
+    """
+
+    __slots__ = ('names', 'starts', 'durations')
+
+    def __init__(self, names=None, starts=None, durations=None):
+        self.names = list(names) if names else []
+        self.starts = array('q', starts) if starts else array('q')
+        self.durations = array('q', durations) if durations else array('q')
+        if not len(self.names) == len(self.starts) == len(self.durations):
+            raise ValueError('names, starts and durations must be the same length')
+
+    def __len__(self):
+        return len(self.names)
+
+    def __str__(self):
+        return '\n'.join(name + ' starts at ' + format_ticks(start) + ' and lasts '
+                         + format_ticks(duration)
+                         for name, start, duration in zip(self.names, self.starts, self.durations))
+
+    @property
+    def ends(self):
+        return array('q', map(int.__add__, self.starts, self.durations))
+
+    @staticmethod
+    @tracing.traced('chapters.ChapterTable.from_chapters')
+    def from_chapters(chapters):
+        return ChapterTable([chapter.name for chapter in chapters],
+                            [ticks_from_datetime(chapter.start) for chapter in chapters],
+                            [ticks_from_datetime(chapter.duration) for chapter in chapters])
+
+    def to_chapters(self):
+        return [Chapter(name, _datetime_from_ticks(start), _datetime_from_ticks(duration))
+                for name, start, duration in zip(self.names, self.starts, self.durations)]
+
+    def remove_shorter_than(self, seconds):
+        min_ticks = Fraction(seconds) * TICKS_PER_SECOND
+        keep = [i for i, duration in enumerate(self.durations) if duration >= min_ticks]
+        return self._take(keep)
+
+    @tracing.traced('chapters.ChapterTable.split')
+    def split(self, index):
+        if index < 1:
+            raise ValueError('index must be at least 1')
+        ret = []
+        for first in range(0, len(self), index):
+            last = min(first + index, len(self))
+            delta = self.starts[first]
+            ret.append(ChapterTable(self.names[first:last],
+                                    [start - delta for start in self.starts[first:last]],
+                                    self.durations[first:last]))
+        return ret
+
+    def rename(self, names, repeat=False):
+        if len(names) > len(self):
+            raise ValueError('More names provided than there are chapters for')
+        if repeat and len(self) % len(names) != 0:
+            raise ValueError('Number of names does not divide evenly into number of chapters while '
+                             'in repeat mode')
+        if repeat:
+            new_names = list(names) * (len(self) // len(names))
+        else:
+            new_names = list(names) + self.names[len(names):]
+        return ChapterTable(new_names, self.starts, self.durations)
+
+    @tracing.traced('chapters.ChapterTable.start_frames')
+    def start_frames(self, framerate):
+        framerate = parse_frame_rate(framerate)
+        return array('q', (ticks_to_frames(start, framerate) for start in self.starts))
+
+    @tracing.traced('chapters.ChapterTable.write_mkv')
+    def write_mkv(self, file):
+        for i, (name, start) in enumerate(zip(self.names, self.starts)):
+            base_chapter_str = "CHAPTER{0:02d}".format(i+1)
+            file.write(base_chapter_str + "=" + format_ticks(start) + "\n")
+            file.write(base_chapter_str + "NAME=" + name + "\n")
+
+    @tracing.traced('chapters.ChapterTable.write_qpfile')
+    def write_qpfile(self, file, framerate, first_frame=0, num_frames=None):
+        _write_qpfile(file, self.start_frames(framerate), first_frame, num_frames)
+
+    def _take(self, indices):
+        return ChapterTable([self.names[i] for i in indices],
+                            [self.starts[i] for i in indices],
+                            [self.durations[i] for i in indices])
+
+
+def _write_qpfile(file, frames, first_frame, num_frames):
+    end_frame = None if num_frames is None else first_frame + num_frames
+    for frame in sorted(set(frames)):
+        if frame >= first_frame and (end_frame is None or frame < end_frame):
+            file.write(str(frame) + ' I\n')
+
+
+def _ticks_from_microseconds(microseconds):
+    return (microseconds * 9 + 50) // 100
+
+
+def _datetime_from_ticks(ticks):
+    return Chapter.min_time + timedelta(microseconds=(ticks * 100 + 4) // 9)
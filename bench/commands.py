@@ -13,29 +13,141 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import re
+import shlex
+import subprocess
+from bench import tracing
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class Quoted(str):
+
+    """A command line token, usually a file location, that is wrapped in quotes when the command is
+    written to a batch file. It is passed to the program as is when the command is run directly"""
+
+    __slots__ = ()
+
+
+class Command:
+
+    def __init__(self, argv):
+        """Arguments:
+        argv: list of string tokens of the command line, starting with the program.
+            Tokens that are Quoted are wrapped in quotes when written"""
+
+        if not argv:
+            raise ValueError("Must give at least the program for a command")
+
+        self.argv = list(argv)
+
+    def __str__(self):
+        return self.line()
+
+    def line(self):
+        """The command line as it is written to a batch file"""
+        return _line(self.argv)
+
+    def posix_line(self):
+        """The command line quoted for a POSIX shell"""
+        return shlex.join(self.argv)
+
+    def popen(self, **kwargs):
+        """Start the program without a shell. Extra arguments go to subprocess.Popen"""
+        return subprocess.Popen(self._args(), **kwargs)
+
+    def run(self, **kwargs):
+        """Run the program to completion without going through a shell and return its exit status"""
+        return self.popen(**kwargs).wait()
+
+    def _args(self):
+        # Windows programs parse their own command line, so give them exactly what the batch file
+        # would have. Everywhere else the argv is handed over as is.
+        return self.line() if os.name == 'nt' else self.argv
+
+
+class PipedCommand:
+
+    def __init__(self, source, sink, bufsize=1024*1024):
+        """Arguments:
+        source: Command whose standard output is piped into sink
+        sink: Command that reads the standard output of source as its standard input
+        bufsize: int buffer size in bytes used for the pipe when run. On Linux the pipe itself is
+            grown to this size, up to /proc/sys/fs/pipe-max-size"""
+
+        self.source = source
+        self.sink = sink
+        self.bufsize = bufsize
+
+    def __str__(self):
+        return self.line()
+
+    @property
+    def argv(self):
+        return self.source.argv + ['|'] + self.sink.argv
+
+    def line(self):
+        return self.source.line() + ' | ' + self.sink.line()
+
+    def posix_line(self):
+        return self.source.posix_line() + ' | ' + self.sink.posix_line()
+
+    def run(self, **kwargs):
+        """Run both programs with the pipe between them made by Python rather than a shell.
+        Returns the exit status of the sink, or of the source if the sink succeeded but the source
+        did not. Extra arguments go to subprocess.Popen for both programs"""
+
+        source = self.source.popen(stdout=subprocess.PIPE, bufsize=self.bufsize, **kwargs)
+        try:
+            # The programs share the pipe directly, so no data passes through Python
+            _grow_pipe(source.stdout.fileno(), self.bufsize)
+            sink = self.sink.popen(stdin=source.stdout, bufsize=self.bufsize, **kwargs)
+        except BaseException:
+            source.kill()
+            source.wait()
+            raise
+        finally:
+            # The sink holds its own handle now. Closing ours lets the source see a broken pipe if
+            # the sink exits early
+            source.stdout.close()
+        sink_returncode = sink.wait()
+        source_returncode = source.wait()
+        return sink_returncode or source_returncode
+
+
 class MkvTrack:
 
-    def __init__(self, file_loc, args=None):
+    def __init__(self, file_loc, args=None, append=False):
         """Arguments:
         file_loc: string file location of the track you wish to import.
             It is the responsibility of the functions that use objects of this type to wrap
             parentheses around the file location. This class itself should not be constructed with
             parentheses already present.
         args: Nullable string-string dictionary for extra arguments you want for the track
-            e.g. {aspect-ratio: '0:16/9'}. Both abbreviated and full named args are acceptable."""
+            e.g. {aspect-ratio: '0:16/9'}. Both abbreviated and full named args are acceptable.
+        append: Boolean value to append the file to the track before it with mkvmerge's +"""
 
         if not file_loc:
             raise ValueError("Must give file location for track")
 
         self.file_loc = file_loc
         self.args = args
+        self.append = append
+
+    def to_argv(self):
+        argv = _args_from_dict(self.args) if self.args else []
+        if self.append:
+            argv.append('+')
+        argv.append(Quoted(self.file_loc))
+        return argv
 
     def write_to(self, file):
         if self.args:
             _write_args_from_dict(file, self.args)
-        file.write(' "')
-        file.write(self.file_loc)
-        file.write('"')
+        file.write((' + "' if self.append else ' "') + self.file_loc + '"')
 
 
 class MkvAttachment:
@@ -62,23 +174,72 @@ class MkvAttachment:
         self.description = description
         self.attach_once = attach_once
 
+    def to_argv(self):
+        argv = ['--attachment-mime-type', self.mime_type]
+        if self.name:
+            argv += ['--attachment-name', Quoted(self.name)]
+        if self.description:
+            argv += ['--attachment-description', Quoted(self.description)]
+        argv += ['--attach-file-once' if self.attach_once else '--attach-file',
+                 Quoted(self.file_loc)]
+        return argv
+
     def write_to(self, file):
-        file.write(' --attachment-mime-type ')
-        file.write(self.mime_type)
+        file.write(' --attachment-mime-type ' + self.mime_type)
         if self.name:
-            file.write(' --attachment-name "')
-            file.write(self.name)
-            file.write('"')
+            file.write(' --attachment-name "' + self.name + '"')
         if self.description:
-            file.write(' --attachment-description "')
-            file.write(self.description)
-            file.write('"')
-        if self.attach_once:
-            file.write(' --attach-file-once "')
-        else:
-            file.write(' --attach-file "')
-        file.write(self.file_loc)
-        file.write('"')
+            file.write(' --attachment-description "' + self.description + '"')
+        file.write((' --attach-file-once "' if self.attach_once else ' --attach-file "')
+                   + self.file_loc + '"')
+
+
+@tracing.traced('commands.bePipe_neroAAC_command')
+def bePipe_neroAAC_command(bepipe_loc, nero_loc, script, audio_dest_loc, nero_args=None):
+    """PipedCommand of BePipe input into NeroAAC. See write_bePipe_neroAAC_command for the
+    arguments"""
+
+    bepipe = Command([Quoted(bepipe_loc), '--script', Quoted(script)])
+    nero = [Quoted(nero_loc)]
+    if nero_args:
+        nero += _args_from_dict(nero_args, '-')
+    nero += ['-if', '-', '-of', Quoted(audio_dest_loc)]
+    return PipedCommand(bepipe, Command(nero))
+
+
+def script_inputs(script):
+    """The file locations a BePipe script argument imports, e.g. ['myfile.avs'] for
+    'import(^myfile.avs^)'. BePipe reads ^ as a quote"""
+    return _script_import_re.findall(script)
+
+
+_script_import_re = re.compile(r'import\s*\(\s*\^([^^]+)\^', re.IGNORECASE)
+
+
+@tracing.traced('commands.x264_command')
+def x264_command(x264_loc, video_input_loc, video_dest_loc, args=None):
+    """Command of x264. See write_x264_command for the arguments"""
+
+    argv = [Quoted(x264_loc), '--output', Quoted(video_dest_loc)]
+    if args:
+        argv += _args_from_dict(args)
+    argv.append(Quoted(video_input_loc))
+    return Command(argv)
+
+
+@tracing.traced('commands.mkvmerge_command')
+def mkvmerge_command(mkvmerge_loc, mux_output_loc, tracks, attachments=None, global_args=None):
+    """Command of mkvmerge. See write_mkvmerge_command for the arguments"""
+
+    argv = [Quoted(mkvmerge_loc), '--output', Quoted(mux_output_loc)]
+    if global_args:
+        argv += _args_from_dict(global_args)
+    if attachments:
+        for attachment in attachments:
+            argv += attachment.to_argv()
+    for track in tracks:
+        argv += track.to_argv()
+    return Command(argv)
 
 
 def write_bePipe_neroAAC_command(file, bepipe_loc, nero_loc, script, audio_dest_loc,
@@ -96,24 +257,13 @@ def write_bePipe_neroAAC_command(file, bepipe_loc, nero_loc, script, audio_dest_
     nero_args: Nullable string, string dictionary for the arguments to be passed to NeroAAC
         e.g. {'q': '0.65'}"""
 
-    # header
-    file.write('REM Audio ')
-    file.write(audio_dest_loc)
-    file.write('\n')
-
-    # command
-    file.write('"')
-    file.write(bepipe_loc)
-    file.write('" --script "')
-    file.write(script)
-    file.write('" | "')
-    file.write(nero_loc)
-    file.write('"')
+    # Written directly rather than through bePipe_neroAAC_command, which costs more per job than
+    # the write itself. The output is the same as the command's line
+    file.write('REM Audio ' + audio_dest_loc + '\n"' + bepipe_loc + '" --script "' + script
+               + '" | "' + nero_loc + '"')
     if nero_args:
         _write_args_from_dict(file, nero_args, '-')
-    file.write(' -if - -of "')
-    file.write(audio_dest_loc)
-    file.write('"\n\n')
+    file.write(' -if - -of "' + audio_dest_loc + '"\n\n')
 
 
 def write_x264_command(file, x264_loc, video_input_loc, video_dest_loc, args=None):
@@ -127,26 +277,13 @@ def write_x264_command(file, x264_loc, video_input_loc, video_dest_loc, args=Non
     video_input_loc: The string file location of the input video.
     video_dest_loc: The string file location of the output video
     args: Nullable string, string dictionary for the arguments to be passed to x264
-        e.g. {'crf': '16'}"""
-
-    # header
-    file.write('REM Video ')
-    file.write(video_dest_loc)
-    file.write('\n')
-
-    # command
-    file.write('"')
-    file.write(x264_loc)
-    file.write('" --output "')
-    file.write(video_dest_loc)
-    file.write('"')
+        e.g. {'crf': '16'}, or a profiles.Profile"""
 
+    file.write('REM Video ' + video_dest_loc + '\n"' + x264_loc + '" --output "' + video_dest_loc
+               + '"')
     if args:
         _write_args_from_dict(file, args)
-
-    file.write(' "')
-    file.write(video_input_loc)
-    file.write('"\n\n')
+    file.write(' "' + video_input_loc + '"\n\n')
 
 
 def write_mkvmerge_command(file, mkvmerge_loc, mux_output_loc, tracks, attachments=None,
@@ -164,18 +301,8 @@ def write_mkvmerge_command(file, mkvmerge_loc, mux_output_loc, tracks, attachmen
     global_args: string, string dictionary pairs for the global arguments to be passed to mkvmerge
         e.g. title='Hooplah'"""
 
-    # header
-    file.write('REM Mux ')
-    file.write(mux_output_loc)
-    file.write('\n')
-
-    # command
-    file.write('"')
-    file.write(mkvmerge_loc)
-    file.write('" --output "')
-    file.write(mux_output_loc)
-    file.write('"')
-
+    file.write('REM Mux ' + mux_output_loc + '\n"' + mkvmerge_loc + '" --output "' + mux_output_loc
+               + '"')
     if global_args:
         _write_args_from_dict(file, global_args)
     if attachments:
@@ -186,18 +313,63 @@ def write_mkvmerge_command(file, mkvmerge_loc, mux_output_loc, tracks, attachmen
     file.write('\n\n')
 
 
-def _write_args_from_dict(file, args, argument_specifier_override=None):
+def _grow_pipe(fd, size):
+    # Linux pipes hold 64 KiB by default, which makes a fast source wait on the sink far more often
+    set_pipe_size = getattr(fcntl, 'F_SETPIPE_SZ', None)
+    if set_pipe_size is None:
+        return
+    try:
+        fcntl.fcntl(fd, set_pipe_size, size)
+    except OSError:
+        # Too big for an unprivileged process, so settle for the biggest allowed
+        try:
+            with open('/proc/sys/fs/pipe-max-size') as file:
+                fcntl.fcntl(fd, set_pipe_size, min(size, int(file.read())))
+        except (OSError, ValueError):
+            pass
+
+
+def _line(argv):
+    return ' '.join('"' + token + '"' if isinstance(token, Quoted) else token for token in argv)
+
 
-    keys = sorted(args.keys())
-    for key in keys:
-        file.write(' ')
+def _args_from_dict(args, argument_specifier_override=None):
+
+    # A profiles.Profile has its tokens rendered already
+    to_argv = getattr(args, 'to_argv', None)
+    if to_argv:
+        return to_argv(argument_specifier_override)
+    argv = []
+    for key in sorted(args.keys()):
         if argument_specifier_override:
-            file.write(argument_specifier_override)
+            argv.append(argument_specifier_override + key)
         elif len(key) == 1:
-            file.write('-')
+            argv.append('-' + key)
         else:
-            file.write('--')
-        file.write(key)
+            argv.append('--' + key)
         if args[key]:
-            file.write(' ')
-            file.write(args[key])
+            argv.append(args[key])
+    return argv
+
+
+def _write_args_from_dict(file, args, argument_specifier_override=None):
+    # A profiles.Profile has its text rendered already
+    to_line = getattr(args, 'to_line', None)
+    if to_line:
+        line = to_line(argument_specifier_override)
+        if line:
+            file.write(' ' + line)
+        return
+    # Same tokens as _args_from_dict, quoted as they go
+    line = ''
+    for key in sorted(args.keys()):
+        if argument_specifier_override:
+            line += ' ' + argument_specifier_override + key
+        elif len(key) == 1:
+            line += ' -' + key
+        else:
+            line += ' --' + key
+        value = args[key]
+        if value:
+            line += ' "' + value + '"' if isinstance(value, Quoted) else ' ' + value
+    file.write(line)
@@ -0,0 +1,223 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import queue
+import shutil
+from bench import commands, jobs
+
+SYSFS_CPU_ROOT = '/sys/devices/system/cpu'
+# x264 refuses more lookahead threads than this
+MAX_LOOKAHEAD_THREADS = 16
+
+
+class CpuTopology:
+
+    """
+    The logical CPUs this process may run on, grouped into physical cores
+    Public data members:
+        cores: [list<tuple<int>>] The logical CPUs of each physical core, i.e. its hyperthreads,
+            ordered by package and core so that neighbouring cores share a package
+    """
+
+    __slots__ = ('cores',)
+
+    def __init__(self, cores):
+        if not cores:
+            raise ValueError('Must have at least one core')
+        self.cores = [tuple(core) for core in cores]
+
+    def __len__(self):
+        return len(self.cores)
+
+    @property
+    def num_cpus(self):
+        return sum(len(core) for core in self.cores)
+
+    @staticmethod
+    def detect(sysfs_root=SYSFS_CPU_ROOT):
+        """Topology of the host. Uses the CPU affinity of the process and, on Linux, sysfs to pair
+        up hyperthreads. Elsewhere every logical CPU counts as its own core"""
+        if hasattr(os, 'sched_getaffinity'):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(os.cpu_count() or 1))
+        groups = {}
+        for cpu in cpus:
+            topology_dir = os.path.join(sysfs_root, 'cpu' + str(cpu), 'topology')
+            try:
+                key = (_read_int(os.path.join(topology_dir, 'physical_package_id')),
+                       _read_int(os.path.join(topology_dir, 'core_id')))
+            except (OSError, ValueError):
+                key = (-1, cpu)
+            groups.setdefault(key, []).append(cpu)
+        return CpuTopology([groups[key] for key in sorted(groups)])
+
+
+class CpuSlot:
+
+    """
+    The CPUs given to one encode and the x264 threading that suits them
+    Public data members:
+        cpus: [tuple<int>] The logical CPUs of the slot
+        threads: [int] Value for x264's threads. 1.5 per logical CPU, as x264 picks for a whole
+            machine, so frame threads stalled on their references don't leave CPUs idle
+        lookahead_threads: [int] Value for x264's lookahead-threads. A quarter of threads, more
+            than x264's own sixth, since a long rc-lookahead makes the serial lookahead the
+            bottleneck
+    """
+
+    __slots__ = ('cpus', 'threads', 'lookahead_threads')
+
+    def __init__(self, cpus):
+        self.cpus = tuple(cpus)
+        self.threads = max(len(self.cpus) * 3 // 2, 1)
+        self.lookahead_threads = min(max(self.threads // 4, 1), MAX_LOOKAHEAD_THREADS)
+
+    def __repr__(self):
+        return 'CpuSlot(' + repr(self.cpus) + ')'
+
+    def args(self):
+        """The x264 arguments for the slot, e.g. to merge into a job's args"""
+        return {'threads': str(self.threads), 'lookahead-threads': str(self.lookahead_threads)}
+
+
+def plan_slots(topology, num_encodes, cores_per_encode=4):
+    """Share the cores out between concurrent encodes. x264 gains little per thread beyond a few
+    cores, so running several narrower encodes at once gets more frames per second out of a box
+    than one wide one. Each slot gets whole cores from the same package where it can
+
+    Arguments:
+    topology: CpuTopology of the host
+    num_encodes: int number of encodes waiting to run. No more slots than this are made, so that a
+        single encode gets the whole machine
+    cores_per_encode: int number of physical cores each slot aims for
+
+    Returns a list of CpuSlot"""
+
+    if num_encodes < 1 or cores_per_encode < 1:
+        raise ValueError('Must plan for at least one encode of at least one core')
+    num_slots = max(min(num_encodes, len(topology) // cores_per_encode), 1)
+    # Hand out contiguous runs of cores, the first slots taking one extra when they don't divide
+    base, extra = divmod(len(topology), num_slots)
+    ret = []
+    first = 0
+    for i in range(num_slots):
+        count = base + (1 if i < extra else 0)
+        ret.append(CpuSlot(cpu for core in topology.cores[first:first + count] for cpu in core))
+        first += count
+    return ret
+
+
+def with_thread_args(command, slot):
+    """Copy of an x264 Command with the threading of the slot in place of any it had. The arguments
+    go just before the input, which x264 takes last"""
+    argv = []
+    skip = False
+    for token in command.argv[:-1]:
+        if skip:
+            skip = False
+        elif token in ('--threads', '--lookahead-threads'):
+            skip = True
+        else:
+            argv.append(token)
+    argv += ['--threads', str(slot.threads), '--lookahead-threads', str(slot.lookahead_threads),
+             command.argv[-1]]
+    return commands.Command(argv)
+
+
+def run_pinned(command, cpus=None):
+    """Run a Command and return its exit status, with it and every thread it starts kept to the
+    given CPUs where the platform allows it. Uses taskset where it is installed, so the affinity is
+    set before x264 starts any threads. Otherwise the process is pinned just after it starts"""
+    if not cpus or not hasattr(os, 'sched_setaffinity'):
+        return command.run()
+    # Nothing is run in the child between fork and exec, which isn't safe with other threads
+    # running in this process
+    taskset = shutil.which('taskset')
+    if taskset:
+        cpu_list = ','.join(str(cpu) for cpu in sorted(cpus))
+        return commands.Command([taskset, '-c', cpu_list] + command.argv).run()
+    proc = command.popen()
+    try:
+        os.sched_setaffinity(proc.pid, set(cpus))
+    except OSError:
+        # It may have already exited
+        pass
+    return proc.wait()
+
+
+class CoreScheduler:
+
+    """
+    Runs a JobGraph with its x264 jobs spread over the cores of the host, each given its own slot
+    of CPUs and matching threads and lookahead-threads. Other jobs, which are mostly waiting on
+    disks, run alongside without a slot.
+    Public methods:
+        __init__(topology=None, cores_per_encode=4, pin=False, extra_workers=2):
+            Arguments:
+                topology: [nullable CpuTopology] Defaults to CpuTopology.detect()
+                cores_per_encode: [int] See plan_slots
+                pin: [bool] Keep each encode on the CPUs of its slot. Otherwise the slot only sets
+                    its threading and the OS may move it
+                extra_workers: [int] Workers on top of one per slot, for jobs other than x264
+        run(graph, on_result=None, manifest=None, priority=None): Like jobs.run_jobs. Returns its
+            results. No more encodes are started than there are slots, so an encode never waits
+            for a slot in a worker that other jobs could use, and its elapsed time starts with
+            its slot
+        runner(job): The runner given to jobs.run_jobs by run
+
+    Public data members:
+        slots: [list<CpuSlot>] The slots of the last run
+    """
+
+    def __init__(self, topology=None, cores_per_encode=4, pin=False, extra_workers=2):
+        self.topology = topology or CpuTopology.detect()
+        self.cores_per_encode = cores_per_encode
+        self.pin = pin
+        self.extra_workers = extra_workers
+        self.slots = []
+        self._free = queue.SimpleQueue()
+
+    def run(self, graph, on_result=None, manifest=None, priority=None):
+        num_encodes = sum(1 for job in graph if is_video_job(job))
+        self.slots = plan_slots(self.topology, max(num_encodes, 1), self.cores_per_encode)
+        self._free = queue.SimpleQueue()
+        for slot in self.slots:
+            self._free.put(slot)
+        # An encode's slot is back in _free before run_jobs sees it finish, so with this limit
+        # the runner always finds one waiting
+        return jobs.run_jobs(graph, len(self.slots) + self.extra_workers, self.runner, on_result,
+                             manifest, priority, {jobs.Job.VIDEO: len(self.slots)})
+
+    def runner(self, job):
+        if not is_video_job(job) or not isinstance(job.command, commands.Command):
+            return jobs.run_command(job)
+        slot = self._free.get()
+        try:
+            return run_pinned(with_thread_args(job.command, slot),
+                              slot.cpus if self.pin else None)
+        finally:
+            self._free.put(slot)
+
+
+def is_video_job(job):
+    """Whether the job is an x264 encode, i.e. its kind is jobs.Job.VIDEO as set by
+    JobGraph.add_video_job"""
+    return job.kind == jobs.Job.VIDEO
+
+
+def _read_int(path):
+    with open(path) as file:
+        return int(file.read())
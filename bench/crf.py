@@ -0,0 +1,198 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Predict the x264 crf that gives a target file size or bitrate from short sample encodes,
+instead of encoding the whole title, checking its size and encoding it again.
+
+Samples are taken from across the title's chapters and encoded at a few crf values at once. The
+size of an x264 encode falls off close to exponentially with crf, so log(size) is fitted against
+crf with least squares and solved for the target."""
+
+import math
+import os
+import subprocess
+from bench import chapters, jobs
+from bench.segments import Segment
+
+MIN_CRF = 0.0
+MAX_CRF = 51.0
+
+
+class CrfModel:
+
+    """
+    Fitted log(size) = intercept + slope * crf, where size is the predicted size of the whole title
+    in bytes
+    Public methods:
+        size_at(crf): Returns the predicted size in bytes at the crf
+        crf_for(size): Returns the crf predicted to give the size in bytes, clamped to what x264
+            accepts
+    """
+
+    __slots__ = ('intercept', 'slope')
+
+    def __init__(self, intercept, slope):
+        self.intercept = intercept
+        self.slope = slope
+
+    @staticmethod
+    def fit(crfs, sizes):
+        """Least squares fit to at least two distinct crf values and the sizes they gave"""
+        if len(crfs) != len(sizes):
+            raise ValueError('Must give one size per crf')
+        if len(set(crfs)) < 2:
+            raise ValueError('Must give at least two different crf values')
+        if min(sizes) <= 0:
+            raise ValueError('Sizes must be positive')
+        logs = [math.log(size) for size in sizes]
+        mean_crf = sum(crfs) / len(crfs)
+        mean_log = sum(logs) / len(logs)
+        slope = sum((crf - mean_crf) * (log - mean_log) for crf, log in zip(crfs, logs)) \
+            / sum((crf - mean_crf) ** 2 for crf in crfs)
+        return CrfModel(mean_log - slope * mean_crf, slope)
+
+    def size_at(self, crf):
+        return math.exp(self.intercept + self.slope * crf)
+
+    def crf_for(self, size):
+        if size <= 0:
+            raise ValueError('The target size must be positive')
+        if self.slope >= 0:
+            raise ValueError('The samples got bigger as crf went up, so no crf can be predicted')
+        crf = (math.log(size) - self.intercept) / self.slope
+        return min(max(crf, MIN_CRF), MAX_CRF)
+
+
+def plan_samples(chapter_table, frame_rate, num_samples, sample_frames):
+    """Spread num_samples samples of sample_frames frames evenly across a title. Each sample is
+    kept within the chapter it lands in when the chapter is long enough, so that samples don't
+    straddle the hard cuts chapters usually start on
+
+    Arguments:
+    chapter_table: chapters.ChapterTable of the title, e.g. BlurayTitleInfo.chapter_table
+    frame_rate: The frame rate of the title in any form chapters.parse_frame_rate accepts
+    num_samples: int number of samples
+    sample_frames: int length of each sample in frames
+
+    Returns a list of segments.Segment in order. A title too short to sample is a single segment"""
+
+    if num_samples < 1 or sample_frames < 1:
+        raise ValueError('Must take at least one sample of at least one frame')
+    if not len(chapter_table):
+        raise ValueError('Can not sample a title without chapters')
+
+    frame_rate = chapters.parse_frame_rate(frame_rate)
+    starts = chapter_table.start_frames(frame_rate)
+    ends = [chapters.ticks_to_frames(end, frame_rate) for end in chapter_table.ends]
+    total_frames = max(ends)
+    if num_samples * sample_frames >= total_frames:
+        return [Segment(0, total_frames)]
+
+    ret = []
+    for i in range(num_samples):
+        center = total_frames * (2 * i + 1) // (2 * num_samples)
+        low, high = 0, total_frames
+        for start, end in zip(starts, ends):
+            if start <= center < end and end - start >= sample_frames:
+                low, high = start, end
+                break
+        first = min(max(center - sample_frames // 2, low), high - sample_frames)
+        ret.append(Segment(first, sample_frames))
+    return ret
+
+
+def sample_dest_loc(sample_dir_loc, crf, index):
+    """The file location a sample is encoded to"""
+    return os.path.join(sample_dir_loc, 'sample.crf{0}.part{1:02d}.264'.format(crf, index + 1))
+
+
+def add_sample_jobs(graph, x264_loc, video_input_loc, sample_dir_loc, samples, crfs, args=None):
+    """Add an x264 job for every sample at every crf. None of them depend on each other, so
+    run_jobs encodes them all concurrently
+
+    Arguments:
+    graph: The jobs.JobGraph
+    x264_loc: The string file location of the x264 executable
+    video_input_loc: The string file location of the input video. It must support seeking
+    sample_dir_loc: The string directory the samples are encoded to
+    samples: list of segments.Segment, e.g. from plan_samples
+    crfs: list of crf values to encode at
+    args: Nullable string, string dictionary for the arguments to be passed to x264, e.g. the
+        ones the full encode will use. crf, seek and frames are set per sample
+
+    Returns a dictionary of crf to the list of jobs encoding the samples at it"""
+
+    ret = {}
+    for crf in crfs:
+        ret[crf] = []
+        for i, sample in enumerate(samples):
+            sample_args = dict(args) if args else {}
+            sample_args['crf'] = str(crf)
+            sample_args['frames'] = str(sample.num_frames)
+            if sample.first_frame:
+                sample_args['seek'] = str(sample.first_frame)
+            else:
+                sample_args.pop('seek', None)
+            ret[crf].append(graph.add_video_job(x264_loc, video_input_loc,
+                                                sample_dest_loc(sample_dir_loc, crf, i),
+                                                sample_args))
+    return ret
+
+
+def predict_crf(x264_loc, video_input_loc, sample_dir_loc, chapter_table, frame_rate, args=None,
+                target_size=None, target_bitrate=None, crfs=(14, 18, 22, 26), num_samples=8,
+                sample_seconds=10, max_workers=None, runner=jobs.run_command):
+    """Encode samples of a title to find the crf that hits a target size or bitrate
+
+    Arguments:
+    x264_loc, video_input_loc, sample_dir_loc, args: See add_sample_jobs. The samples are left in
+        sample_dir_loc
+    chapter_table, frame_rate: See plan_samples
+    target_size: Nullable int target size of the encoded video in bytes
+    target_bitrate: Nullable float target bitrate of the encoded video in kbit/s. Give exactly one
+        of target_size and target_bitrate
+    crfs: The crf values the samples are encoded at. Pick ones around the expected answer
+    num_samples: int number of samples per crf
+    sample_seconds: float length of each sample in seconds
+    max_workers, runner: See jobs.run_jobs
+
+    Returns a copy of args with crf set to the prediction, rounded to a tenth.
+    Raises subprocess.CalledProcessError if a sample fails to encode"""
+
+    if (target_size is None) == (target_bitrate is None):
+        raise ValueError('Must give exactly one of target_size and target_bitrate')
+
+    frame_rate = chapters.parse_frame_rate(frame_rate)
+    total_frames = chapters.ticks_to_frames(max(chapter_table.ends), frame_rate)
+    if target_size is None:
+        target_size = target_bitrate * 1000 / 8 * total_frames / frame_rate
+
+    samples = plan_samples(chapter_table, frame_rate, num_samples,
+                           max(int(sample_seconds * frame_rate), 1))
+    sampled_frames = sum(sample.num_frames for sample in samples)
+    graph = jobs.JobGraph()
+    sample_jobs = add_sample_jobs(graph, x264_loc, video_input_loc, sample_dir_loc, samples,
+                                  crfs, args)
+    results = jobs.run_jobs(graph, max_workers, runner)
+    for job in graph:
+        if not results[job.name].succeeded:
+            argv = job.command if isinstance(job.command, str) else job.command.argv
+            raise subprocess.CalledProcessError(results[job.name].returncode, argv)
+
+    sizes = [sum(os.path.getsize(job.outputs[0]) for job in sample_jobs[crf])
+             * total_frames / sampled_frames for crf in crfs]
+    model = CrfModel.fit([float(crf) for crf in crfs], sizes)
+    ret = dict(args) if args else {}
+    ret['crf'] = '{0:.1f}'.format(model.crf_for(target_size))
+    return ret
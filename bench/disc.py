@@ -12,9 +12,13 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-from bluread import Bluray
-from datetime import datetime
-import chapters
+from collections import deque
+from contextlib import ExitStack
+from datetime import datetime, timedelta
+import multiprocessing
+import threading
+import time
+from bench import chapters, mpls, tracing
 
 
 class BlurayTitleInfo:
@@ -22,7 +26,7 @@ class BlurayTitleInfo:
     """
     Useful information for encoding the given bluray title
     Public methods:
-        __init__(bd_loc, title_num=-1, bd_key_loc=None, bd=None):
+        __init__(bd_loc, title_num=-1, bd_key_loc=None, bd=None, cache=None, backend='bluread'):
             Arguments:
                 bd_loc: [string] The root directory of the bluray, i.e. the one that contains the
                     directories BDMV and CERTIFICATE. You must always supply this
@@ -31,6 +35,11 @@ class BlurayTitleInfo:
                 bd_key_loc: [nullable string] The file location of KEYDB.cfg.
                     Requires libaacs and libbdplus
                 bd: [nullable bluread.Bluray] Opened Bluray object to be reused
+                cache: [nullable cache.TitleInfoCache] Cache to read the title from, and to
+                    store it in after the disc has been read. The disc is not opened on a hit
+                backend: [string] How to read the disc when bd is None. 'bluread' uses
+                    libbluray, 'mpls' parses the playlist and clip information files directly.
+                    See the mpls module for how their title numbers differ
 
     Public data members:
         title_num: [int] The value of the selected title
@@ -41,18 +50,34 @@ class BlurayTitleInfo:
         num_audio_tracks: [int] The number of audio tracks in the title
         clip_files: [list<string>] The m2ts files that the playlist points to
         chapters: [list<Chapter>] list of chapters of the title. See the Chapter class for details
+        chapter_table: [ChapterTable] The chapters as a table of 90 kHz ticks. See the ChapterTable
+            class for details
     """
 
-    def __init__(self, bd_loc, title_num=-1, bd_key_loc=None, bd=None):
+    def __init__(self, bd_loc, title_num=-1, bd_key_loc=None, bd=None, cache=None,
+                 backend='bluread'):
         if bd_loc.endswith('/') or bd_loc.endswith('\\'):
             bd_loc = bd_loc[:-1]
 
-        if bd:
-            self._create(bd_loc, title_num, bd)
-        else:
-            with Bluray(bd_loc, bd_key_loc) as bd:
-                bd.Open()
+        with tracing.span('disc.title_info', {'bd_loc': bd_loc, 'title_num': title_num}):
+            if cache:
+                data = cache.get(bd_loc, title_num)
+                if data:
+                    tracing.count('disc.cache_hits')
+                    self._load(data)
+                    return
+                tracing.count('disc.cache_misses')
+
+            if bd:
                 self._create(bd_loc, title_num, bd)
+            else:
+                with open_bluray(bd_loc, bd_key_loc, backend) as bd:
+                    with tracing.span('disc.open'):
+                        bd.Open()
+                    self._create(bd_loc, title_num, bd)
+
+        if cache:
+            cache.put(bd_loc, title_num, self._dump())
 
     def __str__(self):
         ret = 'title_num: ' + str(self.title_num) + '\n'
@@ -71,30 +96,444 @@ class BlurayTitleInfo:
             i += 1
         return ret
 
+    @property
+    def chapter_table(self):
+        return chapters.ChapterTable.from_chapters(self.chapters)
+
     def _create(self, bd_loc, title_num, bd):
-        time_format = chapters.Chapter.time_format
-        if title_num < 0:
-            self.title_num = bd.MainTitleNumber
+        self.title_num = bd.MainTitleNumber if title_num < 0 else title_num
         title = bd.GetTitle(self.title_num)
         self.playlist = title.Playlist
-        self.run_length = datetime.strptime(title.LengthFancy, time_format)
-        video = title.GetClip(0).GetVideo(0)
-        # Because of an error in bluread where they forgot to account for 1080i
-        self.resolution = '1080i' if video.Format == '4' else video.Format
-        self.frame_rate = video.Rate
+        self.run_length = _read_run_length(title)
+        self.resolution, self.frame_rate = _read_video(title)
         self.num_audio_tracks = title.GetClip(0).NumberOfAudiosPrimary
-        first_chapter = title.GetChapter(1)
-        self.chapters = [chapters.Chapter(
-            name='Chapter 1',
-            start=chapters.Chapter.min_time,
-            duration=datetime.strptime(first_chapter.StartFancy, time_format))]
-        for chapter_num in range(1, title.NumberOfChapters):
-            chapter = title.GetChapter(chapter_num)
-            self.chapters.append(chapters.Chapter(
-                name='Chapter ' + str(chapter_num+1),
-                start=datetime.strptime(chapter.StartFancy, time_format),
-                duration=datetime.strptime(chapter.LengthFancy, time_format)))
-        self.clip_files = []
-        for i in range(title.NumberOfClips):
-            clip = title.GetClip(i)
-            self.clip_files.append(clip.ClipId + '.m2ts')
+        self.chapters = _read_chapters(title)
+        self.clip_files = _read_clip_files(title)
+
+    def _dump(self):
+        return {
+            'title_num': self.title_num,
+            'playlist': self.playlist,
+            'run_length': _to_microseconds(self.run_length),
+            'resolution': self.resolution,
+            'frame_rate': self.frame_rate,
+            'num_audio_tracks': self.num_audio_tracks,
+            'clip_files': self.clip_files,
+            'chapters': [[chapter.name, _to_microseconds(chapter.start),
+                          _to_microseconds(chapter.duration)] for chapter in self.chapters]
+        }
+
+    def _load(self, data):
+        self.title_num = data['title_num']
+        self.playlist = data['playlist']
+        self.run_length = _from_microseconds(data['run_length'])
+        self.resolution = data['resolution']
+        self.frame_rate = data['frame_rate']
+        self.num_audio_tracks = data['num_audio_tracks']
+        self.clip_files = data['clip_files']
+        self.chapters = [chapters.Chapter(name=name, start=_from_microseconds(start),
+                                          duration=_from_microseconds(duration))
+                         for name, start, duration in data['chapters']]
+
+
+class BlurayDisc:
+
+    """
+    Every title of a bluray, read through a single libbluray session
+    Public methods:
+        __init__(bd_loc, bd_key_loc=None, backend='bluread'):
+            Arguments:
+                bd_loc: [string] The root directory of the bluray, i.e. the one that contains the
+                    directories BDMV and CERTIFICATE
+                bd_key_loc: [nullable string] The file location of KEYDB.cfg.
+                    Requires libaacs and libbdplus
+                backend: [string] 'bluread' or 'mpls'. See BlurayTitleInfo
+        close(): Closes the disc. Also done when used as a context manager
+        title(title_num=-1): Returns the DiscTitle for the title. -1 means the main title
+        titles(): Iterates over the DiscTitle of every title on the disc
+        title_info(title_num=-1): Returns a BlurayTitleInfo for the title without reopening the disc
+
+    Public data members:
+        bd_loc: [string] The root directory of the bluray
+        num_titles: [int] The number of titles on the disc
+        main_title_num: [int] The title number of the main title
+    """
+
+    __slots__ = ('bd_loc', 'num_titles', 'main_title_num', '_stack', '_bd', '_titles')
+
+    def __init__(self, bd_loc, bd_key_loc=None, backend='bluread'):
+        if bd_loc.endswith('/') or bd_loc.endswith('\\'):
+            bd_loc = bd_loc[:-1]
+        self.bd_loc = bd_loc
+        self._stack = ExitStack()
+        self._bd = self._stack.enter_context(open_bluray(bd_loc, bd_key_loc, backend))
+        try:
+            with tracing.span('disc.open', {'bd_loc': bd_loc}):
+                self._bd.Open()
+            self.num_titles = self._bd.NumberOfTitles
+            self.main_title_num = self._bd.MainTitleNumber
+        except BaseException:
+            self._stack.close()
+            raise
+        self._titles = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.num_titles
+
+    def close(self):
+        self._titles.clear()
+        self._stack.close()
+
+    def title(self, title_num=-1):
+        if title_num < 0:
+            title_num = self.main_title_num
+        if title_num >= self.num_titles:
+            raise ValueError('Title ' + str(title_num) + ' does not exist. The disc has '
+                             + str(self.num_titles) + ' titles')
+        title = self._titles.get(title_num)
+        if title is None:
+            title = self._titles[title_num] = DiscTitle(self._bd, title_num)
+        return title
+
+    def titles(self):
+        for title_num in range(self.num_titles):
+            yield self.title(title_num)
+
+    def title_info(self, title_num=-1):
+        return BlurayTitleInfo(self.bd_loc, title_num, bd=self._bd)
+
+
+class DiscTitle:
+
+    """
+    A single title of a BlurayDisc. Has the same public data members as BlurayTitleInfo, but only
+    asks libbluray for the title when one of them is first used, and only reads the chapters and
+    clips when those members are first used. chapter_table is read straight from libbluray without
+    making any datetime objects, so prefer it over chapters for large discs.
+    """
+
+    __slots__ = ('title_num', '_bd', '_title', '_run_length', '_video', '_chapters',
+                 '_chapter_table', '_clip_files')
+
+    def __init__(self, bd, title_num):
+        self.title_num = title_num
+        self._bd = bd
+        self._title = None
+        self._run_length = None
+        self._video = None
+        self._chapters = None
+        self._chapter_table = None
+        self._clip_files = None
+
+    def __str__(self):
+        return 'title ' + str(self.title_num) + ': ' + self.playlist + ' ' \
+            + str(self.run_length.time())
+
+    @property
+    def playlist(self):
+        return self._get_title().Playlist
+
+    @property
+    def run_length(self):
+        if self._run_length is None:
+            self._run_length = _read_run_length(self._get_title())
+        return self._run_length
+
+    @property
+    def resolution(self):
+        return self._get_video()[0]
+
+    @property
+    def frame_rate(self):
+        return self._get_video()[1]
+
+    @property
+    def num_audio_tracks(self):
+        return self._get_title().GetClip(0).NumberOfAudiosPrimary
+
+    @property
+    def chapters(self):
+        if self._chapters is None:
+            self._chapters = _read_chapters(self._get_title())
+        return self._chapters
+
+    @property
+    def chapter_table(self):
+        if self._chapter_table is None:
+            self._chapter_table = _read_chapter_table(self._get_title())
+        return self._chapter_table
+
+    @property
+    def clip_files(self):
+        if self._clip_files is None:
+            self._clip_files = _read_clip_files(self._get_title())
+        return self._clip_files
+
+    def _get_title(self):
+        if self._title is None:
+            self._title = self._bd.GetTitle(self.title_num)
+        return self._title
+
+    def _get_video(self):
+        if self._video is None:
+            self._video = _read_video(self._get_title())
+        return self._video
+
+
+class DiscScan:
+
+    """
+    Outcome of scanning one disc with scan_discs
+    Public data members:
+        bd_loc: [string] The root directory of the bluray
+        titles: [list<BlurayTitleInfo>] The titles read from the disc. Empty if the scan failed
+        error: [nullable Exception] Why the scan failed. A TimeoutError if it ran out of time
+        elapsed: [float] Wall-clock seconds from the start of the disc's own scan until it
+            finished or was given up on. 0 if it never started
+    """
+
+    __slots__ = ('bd_loc', 'titles', 'error', 'elapsed')
+
+    def __init__(self, bd_loc, titles=None, error=None, elapsed=0.0):
+        self.bd_loc = bd_loc
+        self.titles = titles if titles else []
+        self.error = error
+        self.elapsed = elapsed
+
+    def __str__(self):
+        if self.error:
+            return self.bd_loc + ': ' + type(self.error).__name__ + ': ' + str(self.error)
+        return self.bd_loc + ': ' + str(len(self.titles)) + ' titles'
+
+
+def scan_discs(bd_locs, bd_key_loc=None, title_num=-1, all_titles=False, max_workers=None,
+               timeout=None, use_processes=False, cache=None, backend='bluread',
+               batch_timeout=None):
+    """Scan many discs at once, so a batch takes as long as its slowest disc rather than the sum of
+    all of them. A disc that fails or times out doesn't affect the others.
+
+    Arguments:
+    bd_locs: list of either string root directories of blurays, or (bd_loc, bd_key_loc) tuples for
+        discs that need their own KEYDB.cfg
+    bd_key_loc: Nullable string file location of the KEYDB.cfg for discs given without one
+    title_num: int title to read from each disc. -1 means the main title
+    all_titles: Boolean value to read every title of each disc instead of only title_num
+    max_workers: Nullable int number of discs scanned at once. Defaults to all of them
+    timeout: Nullable float seconds each disc's scan may take, counted from when that scan starts,
+        so discs waiting for a worker aren't charged for the wait. With threads, scans given up on
+        keep running in the background until libbluray returns, but their results are thrown away
+        and they don't keep the interpreter from exiting. Another worker takes their place, so
+        the discs behind them still get scanned. With processes they are killed
+    use_processes: Boolean value to scan each disc in its own process rather than a thread, so
+        that a disc that crashes libbluray fails only its own scan and can't take down the caller.
+        cache and the results must then be picklable
+    cache: Nullable cache.TitleInfoCache used when reading single titles
+    backend: String 'bluread' or 'mpls'. See BlurayTitleInfo
+    batch_timeout: Nullable float seconds, counted from the start of the call, after which every
+        disc that hasn't finished is given up on, including those that never started
+
+    Returns a list of DiscScan in the same order as bd_locs"""
+
+    discs = [(loc, bd_key_loc) if isinstance(loc, str) else tuple(loc) for loc in bd_locs]
+    if not discs:
+        return []
+    if max_workers is not None and max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+    batch_deadline = None if batch_timeout is None else time.monotonic() + batch_timeout
+    pending = deque(enumerate(discs))
+    # Index of each disc being scanned to when its scan started
+    running = {}
+    ret = [None] * len(discs)
+    cond = threading.Condition()
+    given_up = False
+
+    def work():
+        while True:
+            with cond:
+                if not pending or given_up:
+                    return
+                index, (loc, key_loc) = pending.popleft()
+                started = running[index] = time.monotonic()
+                # The clock of the new scan has to be watched
+                cond.notify_all()
+            args = (loc, key_loc, title_num, all_titles, cache, backend)
+            try:
+                if use_processes:
+                    deadline = min((limit for limit in (
+                        None if timeout is None else started + timeout, batch_deadline)
+                        if limit is not None), default=None)
+                    titles = _scan_in_process(deadline, *args)
+                else:
+                    titles = _scan_disc(*args)
+                scan = DiscScan(loc, titles, elapsed=time.monotonic() - started)
+            except Exception as error:
+                scan = DiscScan(loc, error=error, elapsed=time.monotonic() - started)
+            with cond:
+                if index not in running:
+                    # Given up on, and another worker has taken this one's place
+                    return
+                del running[index]
+                ret[index] = scan
+                cond.notify_all()
+
+    def start_worker():
+        # Daemon threads rather than an executor, whose threads are joined at exit, so that a scan
+        # stuck in libbluray can't hang the interpreter after it has been given up on
+        threading.Thread(target=work, daemon=True).start()
+
+    for _ in range(min(max_workers or len(discs), len(discs))):
+        start_worker()
+
+    with cond:
+        while True:
+            now = time.monotonic()
+            limits = [] if batch_deadline is None else [batch_deadline]
+            if timeout is not None:
+                for index, started in list(running.items()):
+                    if now - started >= timeout:
+                        del running[index]
+                        ret[index] = DiscScan(discs[index][0], error=TimeoutError(
+                            'Scan took longer than ' + str(timeout) + ' seconds'),
+                            elapsed=now - started)
+                        if pending:
+                            start_worker()
+                    else:
+                        limits.append(started + timeout)
+            if all(scan is not None for scan in ret) \
+                    or batch_deadline is not None and now >= batch_deadline:
+                break
+            cond.wait(max(min(limits) - now, 0) if limits else None)
+        given_up = True
+        now = time.monotonic()
+        for index, started in running.items():
+            ret[index] = DiscScan(discs[index][0], error=TimeoutError(
+                'Scan took longer than the batch timeout of ' + str(batch_timeout) + ' seconds'),
+                elapsed=now - started)
+        running.clear()
+        for index, _ in pending:
+            ret[index] = DiscScan(discs[index][0], error=TimeoutError(
+                'Scan never started within the batch timeout of ' + str(batch_timeout)
+                + ' seconds'))
+        pending.clear()
+    return ret
+
+
+def _scan_in_process(deadline, *args):
+    # Spawned rather than forked, as forking a process with threads running can deadlock the child
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_scan_child, args=(sender,) + args, daemon=True)
+    process.start()
+    sender.close()
+    try:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        # poll is also true once the child has exited without sending anything
+        if not receiver.poll(timeout):
+            raise TimeoutError('Scan did not finish in time')
+        try:
+            succeeded, value = receiver.recv()
+        except EOFError:
+            process.join()
+            raise RuntimeError('Scan process exited with status ' + str(process.exitcode)) \
+                from None
+        if not succeeded:
+            raise value
+        return value
+    finally:
+        receiver.close()
+        if process.is_alive():
+            process.kill()
+        process.join()
+
+
+def _scan_child(sender, *args):
+    try:
+        try:
+            result = (True, _scan_disc(*args))
+        except Exception as error:
+            result = (False, error)
+        try:
+            sender.send(result)
+        except Exception as error:
+            # The result or error couldn't be pickled
+            sender.send((False, RuntimeError(repr(error))))
+    finally:
+        sender.close()
+
+
+def open_bluray(bd_loc, bd_key_loc=None, backend='bluread'):
+    """Unopened Bluray object for the backend. bluread is only imported when it is used"""
+    if backend == 'mpls':
+        return mpls.MplsBluray(bd_loc, bd_key_loc)
+    if backend != 'bluread':
+        raise ValueError('Unknown disc backend ' + repr(backend))
+    from bluread import Bluray
+    return Bluray(bd_loc, bd_key_loc)
+
+
+@tracing.traced('disc.scan')
+def _scan_disc(bd_loc, bd_key_loc, title_num, all_titles, cache, backend):
+    if not all_titles:
+        return [BlurayTitleInfo(bd_loc, title_num, bd_key_loc, cache=cache, backend=backend)]
+    with BlurayDisc(bd_loc, bd_key_loc, backend) as disc:
+        return [disc.title_info(num) for num in range(disc.num_titles)]
+
+
+def _read_run_length(title):
+    return datetime.strptime(title.LengthFancy, chapters.Chapter.time_format)
+
+
+def _read_video(title):
+    video = title.GetClip(0).GetVideo(0)
+    # Because of an error in bluread where they forgot to account for 1080i
+    resolution = '1080i' if video.Format == '4' else video.Format
+    return resolution, video.Rate
+
+
+@tracing.traced('disc.read_chapters')
+def _read_chapters(title):
+    time_format = chapters.Chapter.time_format
+    first_chapter = title.GetChapter(1)
+    ret = [chapters.Chapter(
+        name='Chapter 1',
+        start=chapters.Chapter.min_time,
+        duration=datetime.strptime(first_chapter.StartFancy, time_format))]
+    for chapter_num in range(1, title.NumberOfChapters):
+        chapter = title.GetChapter(chapter_num)
+        ret.append(chapters.Chapter(
+            name='Chapter ' + str(chapter_num+1),
+            start=datetime.strptime(chapter.StartFancy, time_format),
+            duration=datetime.strptime(chapter.LengthFancy, time_format)))
+    return ret
+
+
+@tracing.traced('disc.read_chapter_table')
+def _read_chapter_table(title):
+    # Mirrors _read_chapters
+    starts = [0]
+    durations = [chapters.ticks_from_timestamp(title.GetChapter(1).StartFancy)]
+    for chapter_num in range(1, title.NumberOfChapters):
+        chapter = title.GetChapter(chapter_num)
+        starts.append(chapters.ticks_from_timestamp(chapter.StartFancy))
+        durations.append(chapters.ticks_from_timestamp(chapter.LengthFancy))
+    names = ['Chapter ' + str(chapter_num+1) for chapter_num in range(len(starts))]
+    return chapters.ChapterTable(names, starts, durations)
+
+
+@tracing.traced('disc.read_clip_files')
+def _read_clip_files(title):
+    return [title.GetClip(i).ClipId + '.m2ts' for i in range(title.NumberOfClips)]
+
+
+def _to_microseconds(val):
+    return (val - chapters.Chapter.min_time) // timedelta(microseconds=1)
+
+
+def _from_microseconds(val):
+    return chapters.Chapter.min_time + timedelta(microseconds=val)
@@ -0,0 +1,109 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory stand-in for bluread.Bluray that makes up a synthetic disc, for benchmarks and tests
+that can't use a real drive. Pass a FakeBluray as the bd argument of disc.BlurayTitleInfo, or put
+this module in sys.modules as 'bluread' to have bench.disc open FakeBluray discs."""
+
+from bench.chapters import format_ms
+
+
+class FakeVideo:
+
+    def __init__(self, video_format, rate):
+        self.Format = video_format
+        self.Rate = rate
+
+
+class FakeClip:
+
+    def __init__(self, clip_id, num_audio_tracks, video):
+        self.ClipId = clip_id
+        self.NumberOfAudiosPrimary = num_audio_tracks
+        self._video = video
+
+    def GetVideo(self, index):
+        return self._video
+
+
+class FakeChapter:
+
+    def __init__(self, start_ms, length_ms):
+        self.StartFancy = format_ms(start_ms)
+        self.LengthFancy = format_ms(length_ms)
+
+
+class FakeTitle:
+
+    def __init__(self, title_num, num_chapters, chapter_ms, num_clips, num_audio_tracks, video):
+        self.Playlist = '{0:05d}.mpls'.format(title_num)
+        self.NumberOfChapters = num_chapters
+        self.NumberOfClips = num_clips
+        self.LengthFancy = format_ms(num_chapters * chapter_ms)
+        self._title_num = title_num
+        self._chapter_ms = chapter_ms
+        self._num_audio_tracks = num_audio_tracks
+        self._video = video
+
+    def GetChapter(self, chapter_num):
+        return FakeChapter(chapter_num * self._chapter_ms, self._chapter_ms)
+
+    def GetClip(self, clip_num):
+        clip_id = '{0:05d}'.format(self._title_num * self.NumberOfClips + clip_num)
+        return FakeClip(clip_id, self._num_audio_tracks, self._video)
+
+
+class FakeBluray:
+
+    def __init__(self, bd_loc='fake', bd_key_loc=None, num_titles=1, main_title_num=0,
+                 num_chapters=12, chapter_ms=300000, num_clips=1, num_audio_tracks=2,
+                 video_format='6', rate='23.976'):
+        """Arguments:
+        bd_loc, bd_key_loc: Ignored. Accepted so this can be constructed like bluread.Bluray
+        num_titles: int number of titles on the disc
+        main_title_num: int title number reported as the main title
+        num_chapters: int number of chapters in every title
+        chapter_ms: int length of every chapter in milliseconds
+        num_clips: int number of m2ts clips in every title
+        num_audio_tracks: int number of primary audio tracks in every clip
+        video_format: string libbluray video format code, e.g. '6' for 1080p
+        rate: string frame rate of the video"""
+
+        self.NumberOfTitles = num_titles
+        self.MainTitleNumber = main_title_num
+        self._num_chapters = num_chapters
+        self._chapter_ms = chapter_ms
+        self._num_clips = num_clips
+        self._num_audio_tracks = num_audio_tracks
+        self._video = FakeVideo(video_format, rate)
+        self.opened = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.opened = False
+
+    def Open(self):
+        self.opened = True
+
+    def GetTitle(self, title_num):
+        if not 0 <= title_num < self.NumberOfTitles:
+            raise IndexError('No title ' + str(title_num))
+        return FakeTitle(title_num, self._num_chapters, self._chapter_ms, self._num_clips,
+                         self._num_audio_tracks, self._video)
+
+
+# So that this module can stand in for bluread itself
+Bluray = FakeBluray
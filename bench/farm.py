@@ -0,0 +1,426 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Run the jobs of a JobGraph on worker machines over TCP.
+
+A JobServer hands out jobs whose dependencies have finished to whichever worker asks next, so
+throughput grows with the number of workers. Start workers on each machine with
+
+    python -m bench.farm HOST PORT [--slots N] [--stage-dir DIR]
+
+Every message is a line of JSON. A worker sends 'request' and gets back a 'job', 'wait' or 'done'.
+While running a job it sends a 'heartbeat' every few seconds, and then its 'result'. Workers that
+don't share storage with the server give a stage directory: they 'fetch' the inputs of each job
+into it and 'upload' the outputs back, each file sent as raw bytes after its line. A worker that
+disconnects or goes quiet for heartbeat_timeout seconds has its job given to another worker."""
+
+import argparse
+import json
+import os
+import re
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from bench import commands, jobs
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class JobServer:
+
+    """
+    Queue of the jobs of a JobGraph served to workers
+    Public methods:
+        __init__(graph, host='127.0.0.1', port=0, heartbeat_timeout=30.0, max_attempts=3):
+            Arguments:
+                graph: [jobs.JobGraph] The jobs to run
+                host, port: [string, int] The address to listen on. Port 0 picks a free port
+                heartbeat_timeout: [float] Seconds a worker may go without a message before its
+                    job is given to another worker
+                max_attempts: [int] How many times a job is handed out before losing its worker
+                    counts as a failure
+        start(): Starts serving in the background. Also done when used as a context manager
+        wait(timeout=None): Blocks until every job has a result, like jobs.run_jobs. Returns the
+            dictionary of job name to jobs.JobResult, or None if timeout seconds passed first
+        close(): Stops serving
+
+    Public data members:
+        address: [(string, int)] The address workers connect to
+        results: [dictionary] Job name to jobs.JobResult for the jobs finished so far
+        workers: [dictionary] Job name to the name of the worker that ran it
+        attempts: [dictionary] Job name to the number of times it has been handed out
+    """
+
+    def __init__(self, graph, host='127.0.0.1', port=0, heartbeat_timeout=30.0, max_attempts=3):
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1')
+        self.graph = graph
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.results = {}
+        self.workers = {}
+        self.attempts = {}
+
+        order = graph.topological_order()
+        self._remaining = {job.name: set(graph.dependencies(job.name)) for job in order}
+        self._dependents = {job.name: [] for job in order}
+        for name, deps in self._remaining.items():
+            for dep in deps:
+                self._dependents[dep].append(name)
+        self._ready = deque(job.name for job in order if not self._remaining[job.name])
+        self._changed = threading.Condition()
+
+        self._server = _Server((host, port), _Handler)
+        self._server.job_server = self
+        self.address = self._server.server_address[:2]
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+            self._thread.start()
+
+    def wait(self, timeout=None):
+        with self._changed:
+            if not self._changed.wait_for(self._all_done, timeout):
+                return None
+        return {job.name: self.results[job.name] for job in self.graph}
+
+    def close(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def _all_done(self):
+        return len(self.results) == len(self.graph)
+
+    def _next_job(self, worker):
+        """The name of the job for the worker, or None to wait, or '' if every job is done"""
+        with self._changed:
+            self._changed.wait_for(lambda: self._ready or self._all_done(),
+                                   min(1.0, self.heartbeat_timeout / 2))
+            if not self._ready:
+                return '' if self._all_done() else None
+            name = self._ready.popleft()
+            self.attempts[name] = self.attempts.get(name, 0) + 1
+            self.workers[name] = worker
+            return name
+
+    def _finish(self, result):
+        with self._changed:
+            self._record(result)
+            if result.succeeded:
+                for dependent in self._dependents[result.name]:
+                    self._remaining[dependent].discard(result.name)
+                    if not self._remaining[dependent] and dependent not in self.results:
+                        self._ready.append(dependent)
+            self._changed.notify_all()
+
+    def _lost(self, name):
+        with self._changed:
+            if name in self.results:
+                return
+            if self.attempts[name] >= self.max_attempts:
+                self._record(jobs.JobResult(name, jobs.JobResult.FAILED))
+            else:
+                self._ready.appendleft(name)
+            self._changed.notify_all()
+
+    def _record(self, result):
+        self.results[result.name] = result
+        if not result.succeeded:
+            for dependent in self._dependents[result.name]:
+                if dependent not in self.results:
+                    self._record(jobs.JobResult(dependent, jobs.JobResult.SKIPPED))
+
+
+class _Server(socketserver.ThreadingTCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server.job_server
+        self.connection.settimeout(server.heartbeat_timeout)
+        worker = '{0}:{1}'.format(*self.client_address[:2])
+        job = None
+        try:
+            while True:
+                message = _read_message(self.rfile)
+                if message is None:
+                    break
+                kind = message.get('type')
+                if kind == 'hello':
+                    worker = message.get('worker') or worker
+                elif kind == 'request':
+                    name = server._next_job(worker)
+                    if name:
+                        job = server.graph[name]
+                        _send_message(self.connection, {
+                            'type': 'job', 'name': name, 'command': command_to_message(job.command),
+                            'inputs': job.inputs, 'outputs': job.outputs, 'kind': job.kind,
+                            'attempt': server.attempts[name]})
+                    else:
+                        _send_message(self.connection, {'type': 'done' if name == '' else 'wait'})
+                elif kind == 'fetch':
+                    self._send_file(message['path'], job and job.inputs)
+                elif kind == 'upload':
+                    self._receive_file(message['path'], message['size'], job and job.outputs)
+                elif kind == 'result' and job and message.get('name') == job.name:
+                    returncode = message.get('returncode')
+                    status = jobs.JobResult.OK if returncode == 0 else jobs.JobResult.FAILED
+                    server._finish(jobs.JobResult(job.name, status, returncode,
+                                                  message.get('elapsed', 0.0)))
+                    job = None
+                # Heartbeats need no reply. Reading them is enough to reset the timeout
+        except (OSError, ValueError):
+            pass
+        finally:
+            if job:
+                server._lost(job.name)
+
+    def _send_file(self, path, allowed):
+        if not allowed or path not in allowed or not os.path.isfile(path):
+            _send_message(self.connection, {'type': 'missing', 'path': path})
+            return
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            _send_message(self.connection, {'type': 'file', 'path': path, 'size': size})
+            if size:
+                self.connection.sendfile(file)
+
+    def _receive_file(self, path, size, allowed):
+        if not allowed or path not in allowed:
+            # Drain it so the stream stays in step
+            _copy_exactly(self.rfile, None, size)
+            _send_message(self.connection, {'type': 'refused', 'path': path})
+            return
+        temp_path = path + '.part'
+        with open(temp_path, 'wb') as file:
+            _copy_exactly(self.rfile, file, size)
+        os.replace(temp_path, path)
+        _send_message(self.connection, {'type': 'ok', 'path': path})
+
+
+def command_to_message(command):
+    """JSON-able form of a Job's command that keeps which tokens are Quoted"""
+    if isinstance(command, str):
+        return {'shell': command}
+    if isinstance(command, commands.PipedCommand):
+        return {'source': _argv_to_message(command.source.argv),
+                'sink': _argv_to_message(command.sink.argv), 'bufsize': command.bufsize}
+    return {'argv': _argv_to_message(command.argv)}
+
+
+def command_from_message(message, path_map=None):
+    """The command of command_to_message, with every token that is a key of the nullable
+    path_map dictionary replaced by its value"""
+    path_map = path_map or {}
+    if 'shell' in message:
+        line = message['shell']
+        for path in sorted(path_map, key=len, reverse=True):
+            line = line.replace(path, path_map[path])
+        return line
+    if 'source' in message:
+        return commands.PipedCommand(_argv_from_message(message['source'], path_map),
+                                     _argv_from_message(message['sink'], path_map),
+                                     message['bufsize'])
+    return _argv_from_message(message['argv'], path_map)
+
+
+def run_worker(host, port, name=None, stage_dir=None, runner=jobs.run_command,
+               heartbeat_interval=5.0):
+    """Run jobs from a JobServer one at a time until it has none left
+
+    Arguments:
+    host, port: The address of the JobServer
+    name: Nullable string name of the worker. Defaults to the host name and process id
+    stage_dir: Nullable string directory that inputs are fetched to and outputs are written to
+        before being uploaded. None when the worker sees the same files as the server
+    runner: callable taking a jobs.Job and returning its int exit status, as for jobs.run_jobs
+    heartbeat_interval: float seconds between heartbeats while a job runs. Must be well below the
+        server's heartbeat_timeout
+
+    Returns the number of jobs run"""
+
+    if name is None:
+        name = socket.gethostname() + ':' + str(os.getpid())
+    count = 0
+    with socket.create_connection((host, port)) as sock, sock.makefile('rb') as reader:
+        send_lock = threading.Lock()
+
+        def send(message):
+            with send_lock:
+                _send_message(sock, message)
+
+        send({'type': 'hello', 'worker': name})
+        while True:
+            send({'type': 'request'})
+            message = _read_message(reader)
+            if message is None or message['type'] == 'done':
+                break
+            if message['type'] != 'job':
+                continue
+            returncode, elapsed = _run_job(sock, reader, send, message, stage_dir, runner,
+                                           heartbeat_interval)
+            send({'type': 'result', 'name': message['name'], 'returncode': returncode,
+                  'elapsed': elapsed})
+            count += 1
+    return count
+
+
+def _run_job(sock, reader, send, message, stage_dir, runner, heartbeat_interval):
+    job_dir = None
+    path_map = {}
+    try:
+        if stage_dir:
+            job_dir = tempfile.mkdtemp(dir=stage_dir)
+            for i, path in enumerate(message['inputs'] + message['outputs']):
+                path_map[path] = os.path.join(job_dir, str(i) + '_' + _basename(path))
+            for path in message['inputs']:
+                send({'type': 'fetch', 'path': path})
+                # Inputs that aren't files on the server, e.g. ones made by the job itself, are
+                # left as they are
+                if not _receive_fetched(reader, path_map[path]):
+                    del path_map[path]
+
+        job = jobs.Job(message['name'], command_from_message(message['command'], path_map),
+                       [path_map.get(path, path) for path in message['inputs']],
+                       [path_map.get(path, path) for path in message['outputs']],
+                       message.get('kind'))
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(heartbeat_interval):
+                send({'type': 'heartbeat', 'name': job.name})
+
+        beater = threading.Thread(target=heartbeat, daemon=True)
+        beater.start()
+        start = time.perf_counter()
+        try:
+            returncode = runner(job)
+        except OSError:
+            returncode = None
+        finally:
+            stop.set()
+            beater.join()
+        elapsed = time.perf_counter() - start
+
+        if stage_dir and returncode == 0:
+            for path in message['outputs']:
+                if os.path.isfile(path_map[path]):
+                    _upload(sock, reader, send, path, path_map[path])
+        return returncode, elapsed
+    finally:
+        if job_dir:
+            shutil.rmtree(job_dir, ignore_errors=True)
+
+
+def _receive_fetched(reader, local_path):
+    reply = _read_message(reader)
+    if reply is None:
+        raise ConnectionError('The server closed the connection')
+    if reply['type'] != 'file':
+        return False
+    with open(local_path, 'wb') as file:
+        _copy_exactly(reader, file, reply['size'])
+    return True
+
+
+def _upload(sock, reader, send, path, local_path):
+    with open(local_path, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        send({'type': 'upload', 'path': path, 'size': size})
+        if size:
+            sock.sendfile(file)
+    reply = _read_message(reader)
+    if reply is None or reply['type'] != 'ok':
+        raise ConnectionError('The server did not accept ' + path)
+
+
+def _argv_to_message(argv):
+    return [[token, isinstance(token, commands.Quoted)] for token in argv]
+
+
+def _argv_from_message(tokens, path_map):
+    return commands.Command([commands.Quoted(path_map.get(token, token)) if quoted
+                             else path_map.get(token, token) for token, quoted in tokens])
+
+
+def _basename(path):
+    # Paths from the server may use either separator whatever the worker runs on
+    return re.split(r'[\\/]', path)[-1]
+
+
+def _send_message(sock, message):
+    sock.sendall(json.dumps(message).encode() + b'\n')
+
+
+def _read_message(reader):
+    line = reader.readline()
+    if not line:
+        return None
+    return json.loads(line)
+
+
+def _copy_exactly(reader, file, size):
+    while size:
+        chunk = reader.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            raise ConnectionError('The connection closed part way through a file')
+        if file is not None:
+            file.write(chunk)
+        size -= len(chunk)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run jobs from a bench.farm.JobServer')
+    parser.add_argument('host')
+    parser.add_argument('port', type=int)
+    parser.add_argument('--name', help='name of the worker in results')
+    parser.add_argument('--slots', type=int, default=1, help='jobs to run at once')
+    parser.add_argument('--stage-dir', help='directory to copy inputs and outputs through')
+    parser.add_argument('--heartbeat', type=float, default=5.0, help='seconds between heartbeats')
+    args = parser.parse_args(argv)
+
+    name = args.name or socket.gethostname() + ':' + str(os.getpid())
+    threads = [threading.Thread(target=run_worker, args=(
+        args.host, args.port, name + '/' + str(slot), args.stage_dir, jobs.run_command,
+        args.heartbeat)) for slot in range(args.slots)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
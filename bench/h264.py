@@ -0,0 +1,127 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Check that raw H.264 streams written by x264 are complete by counting their frames from the NAL
+unit headers, without decoding anything.
+
+A frame starts with the slice whose first_mb_in_slice is 0. That is the first field of the slice
+header, coded so that 0 is a single 1 bit, so only the byte after each slice's NAL header needs
+looking at. Streams coded as separate fields, rather than x264's frames or MBAFF, count each
+field as a frame."""
+
+import mmap
+import os
+import re
+from datetime import datetime, timedelta
+from bench import chapters, tracing
+
+# Expected frame counts come from run lengths that the disc may only give to the millisecond
+DEFAULT_TOLERANCE = 2
+
+# A start code, then the NAL header of a coded slice (type 1) or IDR slice (type 5) with any
+# nal_ref_idc, then the first byte of a slice header with first_mb_in_slice 0. Emulation prevention
+# keeps start codes out of the NAL payloads, so matches can't come from inside slice data
+_frame_start_re = re.compile(rb'\x00\x00\x01([\x01\x21\x41\x61\x05\x25\x45\x65])[\x80-\xff]')
+
+
+class StreamCheck:
+
+    """
+    The frames counted in a stream, and whether they match the frames expected
+    Public data members:
+        stream_loc: [string] The location of the stream
+        frames: [int] The number of frames in the stream
+        idr_frames: [int] How many of them are IDR frames
+        size: [int] The size of the stream in bytes
+        expected_frames: [nullable int] The number of frames the stream should have
+        tolerance: [int] How many frames the count may differ from expected_frames by
+        ok: [bool] Whether the count is within tolerance of expected_frames, or there are any
+            frames when none are expected
+    """
+
+    __slots__ = ('stream_loc', 'frames', 'idr_frames', 'size', 'expected_frames', 'tolerance')
+
+    def __init__(self, stream_loc, frames, idr_frames, size, expected_frames=None,
+                 tolerance=DEFAULT_TOLERANCE):
+        self.stream_loc = stream_loc
+        self.frames = frames
+        self.idr_frames = idr_frames
+        self.size = size
+        self.expected_frames = expected_frames
+        self.tolerance = tolerance
+
+    def __str__(self):
+        ret = '{0}: {1} frames'.format(self.stream_loc, self.frames)
+        if self.expected_frames is not None:
+            ret += ' of {0} expected'.format(self.expected_frames)
+        return ret + (' ok' if self.ok else ' INCOMPLETE')
+
+    @property
+    def ok(self):
+        if self.expected_frames is None:
+            return self.frames > 0
+        return abs(self.frames - self.expected_frames) <= self.tolerance
+
+
+def count_frames(buffer):
+    """Count the frames in a buffer holding a raw H.264 stream, such as an mmap, without copying
+    it. Returns (frames, IDR frames)"""
+    frames = idr_frames = 0
+    for match in _frame_start_re.finditer(buffer):
+        frames += 1
+        if match.group(1)[0] & 0x1f == 5:
+            idr_frames += 1
+    return frames, idr_frames
+
+
+def expected_frames(run_length, frame_rate):
+    """The number of frames in a title
+
+    Arguments:
+    run_length: The run length of the title, either a datetime like BlurayTitleInfo.run_length,
+        a timedelta, or float seconds
+    frame_rate: Frame rate in any form chapters.parse_frame_rate accepts"""
+
+    if isinstance(run_length, datetime):
+        run_length -= chapters.Chapter.min_time
+    if isinstance(run_length, timedelta):
+        run_length = run_length.total_seconds()
+    return round(run_length * chapters.parse_frame_rate(frame_rate))
+
+
+@tracing.traced('h264.verify_stream')
+def verify_stream(stream_loc, expected=None, tolerance=DEFAULT_TOLERANCE):
+    """Count the frames of the stream at stream_loc and check them against the expected number.
+    Returns a StreamCheck. Raises OSError if the stream can't be read
+
+    Arguments:
+    stream_loc: string file location of a raw H.264 stream, e.g. a .264 output of x264
+    expected: Nullable int number of frames, e.g. from expected_frames
+    tolerance: int number of frames the count may differ by"""
+
+    with open(stream_loc, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                frames, idr_frames = count_frames(buffer)
+        else:
+            # Empty files can't be mapped
+            frames = idr_frames = 0
+    return StreamCheck(stream_loc, frames, idr_frames, size, expected, tolerance)
+
+
+def verify_title_stream(stream_loc, title_info, tolerance=DEFAULT_TOLERANCE):
+    """verify_stream for an encode of a whole disc.BlurayTitleInfo or disc.DiscTitle"""
+    return verify_stream(stream_loc, expected_frames(title_info.run_length, title_info.frame_rate),
+                         tolerance)
@@ -0,0 +1,308 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from bench import commands, tracing
+
+
+class Job:
+
+    AUDIO = 'Audio'
+    VIDEO = 'Video'
+    MUX = 'Mux'
+
+    def __init__(self, name, command, inputs=None, outputs=None, kind=None):
+        """Arguments:
+        name: string unique name of the job. Used as the REM header when written to a batch file
+        command: commands.Command or commands.PipedCommand to be run, or a string command line
+            to be run by the shell
+        inputs: Nullable list of string file locations the job reads. A job depends on every other
+            job that outputs one of its inputs
+        outputs: Nullable list of string file locations the job writes
+        kind: Nullable string. Job.AUDIO for BePipe into NeroAAC, Job.VIDEO for x264 or Job.MUX
+            for mkvmerge, as set by the JobGraph.add_* methods. None for other jobs"""
+
+        if not name:
+            raise ValueError('Must give a name for the job')
+        if not command:
+            raise ValueError('Must give a command for the job')
+
+        self.name = name
+        self.command = command
+        self.inputs = list(inputs) if inputs else []
+        self.outputs = list(outputs) if outputs else []
+        self.kind = kind
+
+    def __str__(self):
+        return self.name
+
+
+class JobResult:
+
+    """
+    Outcome of running a single job
+    Public data members:
+        name: [string] The name of the job
+        status: [string] One of JobResult.OK, JobResult.FAILED, JobResult.SKIPPED or
+            JobResult.UP_TO_DATE
+        returncode: [nullable int] The exit status of the command. None if it never ran
+        elapsed: [float] Wall-clock seconds spent running the command
+        succeeded: [bool] Whether jobs that depend on this one can run
+    """
+
+    OK = 'ok'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+    UP_TO_DATE = 'up to date'
+
+    def __init__(self, name, status, returncode=None, elapsed=0.0):
+        self.name = name
+        self.status = status
+        self.returncode = returncode
+        self.elapsed = elapsed
+
+    def __str__(self):
+        return self.name + ': ' + self.status + ' (exit status ' + str(self.returncode) + ')'
+
+    @property
+    def succeeded(self):
+        return self.status in (JobResult.OK, JobResult.UP_TO_DATE)
+
+
+class JobGraph:
+
+    """
+    Audio, video and mux jobs along with the dependencies between them. A job depends on whichever
+    job outputs a file that it takes as input, e.g. a mux depends on its own video and audio
+    encodes.
+    Jobs are kept in the order they were added.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._producers = {}
+
+    def __iter__(self):
+        return iter(self._jobs.values())
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __getitem__(self, name):
+        return self._jobs[name]
+
+    def add(self, job):
+        if job.name in self._jobs:
+            raise ValueError('A job named ' + job.name + ' already exists')
+        for output in job.outputs:
+            if output in self._producers:
+                raise ValueError(output + ' is already the output of ' + self._producers[output])
+        self._jobs[job.name] = job
+        for output in job.outputs:
+            self._producers[output] = job.name
+        return job
+
+    def add_audio_job(self, bepipe_loc, nero_loc, script, audio_dest_loc, nero_args=None):
+        """Add a BePipe into NeroAAC job. See commands.write_bePipe_neroAAC_command. The files
+        the script imports are the job's inputs"""
+        command = commands.bePipe_neroAAC_command(bepipe_loc, nero_loc, script, audio_dest_loc,
+                                                  nero_args)
+        return self.add(Job('Audio ' + audio_dest_loc, command,
+                            inputs=commands.script_inputs(script), outputs=[audio_dest_loc],
+                            kind=Job.AUDIO))
+
+    def add_video_job(self, x264_loc, video_input_loc, video_dest_loc, args=None,
+                      qpfile_loc=None):
+        """Add an x264 job. See commands.write_x264_command. qpfile_loc is the nullable string
+        file location of a qpfile, e.g. from chapters.create_x264_qpfile, to pass as --qpfile"""
+        inputs = [video_input_loc]
+        if qpfile_loc:
+            args = dict(args) if args else {}
+            args['qpfile'] = commands.Quoted(qpfile_loc)
+            inputs.append(qpfile_loc)
+        command = commands.x264_command(x264_loc, video_input_loc, video_dest_loc, args)
+        return self.add(Job('Video ' + video_dest_loc, command, inputs=inputs,
+                            outputs=[video_dest_loc], kind=Job.VIDEO))
+
+    def add_mux_job(self, mkvmerge_loc, mux_output_loc, tracks, attachments=None,
+                    global_args=None):
+        """Add an mkvmerge job. See commands.write_mkvmerge_command"""
+        command = commands.mkvmerge_command(mkvmerge_loc, mux_output_loc, tracks, attachments,
+                                            global_args)
+        inputs = [track.file_loc for track in tracks]
+        if attachments:
+            inputs.extend(attachment.file_loc for attachment in attachments)
+        return self.add(Job('Mux ' + mux_output_loc, command, inputs=inputs,
+                            outputs=[mux_output_loc], kind=Job.MUX))
+
+    def dependencies(self, name):
+        """Names of the jobs that must finish before the given job can start"""
+        deps = []
+        for input_loc in self._jobs[name].inputs:
+            producer = self._producers.get(input_loc)
+            if producer and producer != name and producer not in deps:
+                deps.append(producer)
+        return deps
+
+    def topological_order(self):
+        """List of jobs where every job comes after the jobs it depends on.
+        Raises ValueError if the dependencies are cyclic"""
+        order = []
+        state = {}
+
+        def visit(name):
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError('Cyclic dependency involving ' + name)
+            state[name] = 'visiting'
+            for dep in self.dependencies(name):
+                visit(dep)
+            state[name] = 'done'
+            order.append(self._jobs[name])
+
+        for name in self._jobs:
+            visit(name)
+        return order
+
+    def write_to(self, file):
+        """Write every job to file as a serial batch script in dependency order"""
+        for job in self.topological_order():
+            file.write('REM ')
+            file.write(job.name)
+            file.write('\n')
+            file.write(str(job.command))
+            file.write('\n\n')
+
+
+def run_command(job):
+    """Default runner for run_jobs. Runs the job's command directly, or through the shell if it is a
+    string, and returns its exit status"""
+    if isinstance(job.command, str):
+        return subprocess.call(job.command, shell=True)
+    return job.command.run()
+
+
+def run_jobs(graph, max_workers=None, runner=run_command, on_result=None, manifest=None,
+             priority=None, limits=None):
+    """Run every job in the graph, running jobs whose dependencies have finished concurrently
+
+    Arguments:
+    graph: The JobGraph
+    max_workers: Nullable int maximum number of jobs running at once. Defaults to the number of CPUs
+    runner: callable taking a Job and returning its int exit status. Nonzero means failure, as
+        does raising an exception
+    on_result: Nullable callable given each JobResult as soon as its job finishes or is skipped
+    manifest: Nullable manifest.Manifest. Jobs it finds up to date aren't run, and jobs that
+        succeed are recorded in it
+    priority: Nullable callable taking a Job and returning a number. Of the jobs ready to run, the
+        ones with the highest priority start first, e.g. from metrics.MetricsStore.priorities.
+        Otherwise they start in the order they were added
+    limits: Nullable dictionary of Job.kind to the most jobs of that kind running at once, e.g.
+        {Job.VIDEO: 2}. They still count towards max_workers. Ready jobs of a kind at its limit
+        wait without taking a worker, so jobs of other kinds can start in the meantime
+
+    Returns a dictionary of job name to JobResult, in the order the jobs were added to the graph.
+    Jobs that depend on a failed or skipped job are skipped rather than run."""
+
+    order = graph.topological_order()
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers < 1:
+        raise ValueError('max_workers must be at least 1')
+
+    remaining = {job.name: set(graph.dependencies(job.name)) for job in order}
+    dependents = {job.name: [] for job in order}
+    for name, deps in remaining.items():
+        for dep in deps:
+            dependents[dep].append(name)
+    results = {}
+
+    def finish(result):
+        results[result.name] = result
+        tracing.count('jobs.' + result.status.replace(' ', '_'))
+        if on_result:
+            on_result(result)
+        if not result.succeeded:
+            for dependent in dependents[result.name]:
+                if dependent not in results:
+                    finish(JobResult(dependent, JobResult.SKIPPED))
+
+    def timed_run(job):
+        # The fingerprint is taken once every dependency has finished, so it sees their new outputs
+        fingerprint = None
+        if manifest:
+            with tracing.span('jobs.fingerprint', {'job': job.name}):
+                fingerprint = manifest.fingerprint(job)
+                up_to_date = manifest.is_up_to_date(job, fingerprint)
+            if up_to_date:
+                return None, 0.0
+        start = time.perf_counter()
+        with tracing.span('jobs.run', {'job': job.name}):
+            returncode = runner(job)
+        elapsed = time.perf_counter() - start
+        if manifest and returncode == 0:
+            manifest.record(job, fingerprint)
+        return returncode, elapsed
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+
+        def submit_ready():
+            # Jobs are only handed to the pool as workers free up, so a high priority job that
+            # becomes ready later doesn't queue behind ones that were ready earlier
+            ready = [job for job in order if job.name not in results
+                     and job.name not in running.values() and not remaining[job.name]]
+            if priority:
+                ready.sort(key=priority, reverse=True)
+            if limits:
+                kinds = Counter(graph[name].kind for name in running.values())
+            for job in ready:
+                if len(running) >= max_workers:
+                    break
+                if limits and job.kind in limits:
+                    if kinds[job.kind] >= limits[job.kind]:
+                        continue
+                    kinds[job.kind] += 1
+                running[pool.submit(timed_run, job)] = job.name
+
+        submit_ready()
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    returncode, elapsed = future.result()
+                except Exception:
+                    # The runner couldn't run the job, e.g. its program is missing. Only this
+                    # job fails, not the batch
+                    finish(JobResult(name, JobResult.FAILED))
+                    continue
+                if returncode is None:
+                    result = JobResult(name, JobResult.UP_TO_DATE)
+                elif returncode == 0:
+                    result = JobResult(name, JobResult.OK, returncode, elapsed)
+                else:
+                    result = JobResult(name, JobResult.FAILED, returncode, elapsed)
+                finish(result)
+                if result.succeeded:
+                    for dependent in dependents[name]:
+                        remaining[dependent].discard(name)
+            submit_ready()
+
+    return {job.name: results[job.name] for job in graph}
@@ -0,0 +1,270 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import re
+import struct
+from array import array
+from bisect import bisect_left
+
+PACKET_SIZE = 192
+TS_OFFSET = 4
+PTS_WRAP = 1 << 33
+
+_index_magic = b'PBIX'
+_index_version = 1
+# magic, version, pid, clip size, clip mtime, number of entries
+_index_header = struct.Struct('<4sHHQqQ')
+
+
+def clip_loc(bd_loc, clip_file):
+    """The file location of one of BlurayTitleInfo.clip_files"""
+    return os.path.join(bd_loc, 'BDMV', 'STREAM', clip_file)
+
+
+class ClipIndex:
+
+    """
+    Presentation timestamps of the video in an m2ts clip and the byte offsets of the packets that
+    start them
+    Public data members:
+        pid: [int] The PID of the video stream
+        pts: [array<int>] The PTS of each video PES packet in 90 kHz ticks, in file order
+        offsets: [array<int>] The byte offset of the 192 byte packet starting each PES packet
+        keyframes: [array<int>] 1 where the packet is flagged as a random access point
+        size: [int] The size of the clip the index was built from
+        first_pts: [int] The earliest PTS, which chapter times are measured from
+    """
+
+    __slots__ = ('pid', 'pts', 'offsets', 'keyframes', 'size', 'first_pts', '_reached')
+
+    def __init__(self, pid, pts, offsets, keyframes, size):
+        self.pid = pid
+        self.pts = pts
+        self.offsets = offsets
+        self.keyframes = keyframes
+        self.size = size
+        self.first_pts = min(pts) if pts else 0
+        # The latest PTS seen by each point in the file. PTS aren't in order because of B-frames,
+        # but this is, so it can be bisected
+        self._reached = array('Q')
+        latest = 0
+        for pts_val in pts:
+            latest = max(latest, pts_val)
+            self._reached.append(latest)
+
+    def __len__(self):
+        return len(self.pts)
+
+    @staticmethod
+    def build(buffer, pid=None):
+        """Index a buffer holding a whole m2ts clip, such as an mmap, without copying it.
+        pid is the video PID, or None to use the first video stream found"""
+        if pid is None:
+            pid = find_video_pid(buffer)
+        pts, offsets, keyframes = array('Q'), array('Q'), array('B')
+        first_pts = None
+        # Only packets of the video PID that start a PES packet matter, and a regex over the buffer
+        # finds their headers without a Python loop over every packet. The pattern is a lookahead,
+        # so a false match in a payload or arrival timestamp can't swallow a header overlapping it
+        for match in _pes_start_re(pid).finditer(buffer):
+            packet = match.start() - TS_OFFSET
+            if packet < 0 or packet % PACKET_SIZE:
+                continue
+            parsed = _parse_pes_start(buffer, packet)
+            if parsed is None:
+                continue
+            pts_val, keyframe = parsed
+            if first_pts is None:
+                first_pts = pts_val
+            elif pts_val + PTS_WRAP // 2 < first_pts:
+                pts_val += PTS_WRAP
+            pts.append(pts_val)
+            offsets.append(packet)
+            keyframes.append(keyframe)
+        return ClipIndex(pid, pts, offsets, keyframes, len(buffer))
+
+    def save(self, index_loc, clip_mtime_ns=0):
+        with open(index_loc, 'wb') as file:
+            file.write(_index_header.pack(_index_magic, _index_version, self.pid, self.size,
+                                          clip_mtime_ns, len(self)))
+            self.pts.tofile(file)
+            self.offsets.tofile(file)
+            self.keyframes.tofile(file)
+
+    @staticmethod
+    def load(index_loc, size=None, clip_mtime_ns=None):
+        """Read a saved index. Returns None if it is missing, corrupt or was saved for a clip of a
+        different size or modification time"""
+        try:
+            with open(index_loc, 'rb') as file:
+                header = file.read(_index_header.size)
+                magic, version, pid, saved_size, saved_mtime, count = _index_header.unpack(header)
+                if magic != _index_magic or version != _index_version:
+                    return None
+                if (size is not None and size != saved_size) or \
+                        (clip_mtime_ns is not None and clip_mtime_ns != saved_mtime):
+                    return None
+                pts, offsets, keyframes = array('Q'), array('Q'), array('B')
+                pts.fromfile(file, count)
+                offsets.fromfile(file, count)
+                keyframes.fromfile(file, count)
+        except (OSError, EOFError, struct.error):
+            return None
+        return ClipIndex(pid, pts, offsets, keyframes, saved_size)
+
+    def byte_range(self, start_ticks, end_ticks=None):
+        """(start, end) byte offsets covering the presentation from start_ticks up to end_ticks,
+        both measured from the first PTS of the clip. start is the last random access point at or
+        before start_ticks, so decoding can begin there.
+        Chapter starts are measured from the start of the playlist instead, so they can only be
+        given as they are for a title of a single clip that plays from its first frame. For other
+        titles, take off the length of the play items before the clip and add the clip's in time
+        less its first PTS, e.g. from mpls.PlayItem"""
+        if not self.pts:
+            raise ValueError('The clip has no indexed video')
+        first_pts = self.first_pts
+        # The frame at start_ticks can't come before the point where the PTS first reach it
+        start_pts = first_pts + start_ticks
+        start = min(bisect_left(self._reached, start_pts), len(self.pts) - 1)
+        while start > 0 and not (self.keyframes[start] and self.pts[start] <= start_pts):
+            start -= 1
+        end = self.size
+        if end_ticks is not None:
+            end_index = bisect_left(self._reached, first_pts + end_ticks)
+            if end_index < len(self.offsets):
+                end = self.offsets[end_index]
+        return self.offsets[start], end
+
+
+class M2tsClip:
+
+    """
+    A memory-mapped m2ts clip and its PTS index, for slicing out time ranges without decoding or
+    copying, e.g. to feed a chapter range straight to an encoder
+    Public methods:
+        __init__(clip_loc, index_loc=None, pid=None):
+            Arguments:
+                clip_loc: [string] The file location of the clip, e.g. from clip_loc()
+                index_loc: [nullable string] Where to keep the index. It is loaded from here if it
+                    was saved for the clip as it is now, otherwise built and saved here. The
+                    index is only kept in memory when None, since discs are read-only
+                pid: [nullable int] The video PID. The first video stream is used when None
+        view(start_ticks, end_ticks=None): memoryview of the bytes of the range. See
+            ClipIndex.byte_range. It must be released before the clip is closed
+        stream_to(file, start_ticks, end_ticks=None, chunk_size=4194304): Writes the range to
+            file, e.g. an encoder's stdin, in chunks. Returns the number of bytes written
+        close(): Unmaps the clip. Also done when used as a context manager
+
+    Public data members:
+        index: [ClipIndex] The index of the clip
+    """
+
+    def __init__(self, clip_loc, index_loc=None, pid=None):
+        with open(clip_loc, 'rb') as file:
+            stat = os.fstat(file.fileno())
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.index = None
+            if index_loc:
+                self.index = ClipIndex.load(index_loc, stat.st_size, stat.st_mtime_ns)
+                if self.index and pid is not None and self.index.pid != pid:
+                    self.index = None
+            if self.index is None:
+                self.index = ClipIndex.build(self._mmap, pid)
+                if index_loc:
+                    self.index.save(index_loc, stat.st_mtime_ns)
+        except BaseException:
+            self._mmap.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._mmap.close()
+
+    def view(self, start_ticks, end_ticks=None):
+        start, end = self.index.byte_range(start_ticks, end_ticks)
+        return memoryview(self._mmap)[start:end]
+
+    def stream_to(self, file, start_ticks, end_ticks=None, chunk_size=4 * 1024 * 1024):
+        written = 0
+        with self.view(start_ticks, end_ticks) as view:
+            for offset in range(0, len(view), chunk_size):
+                with view[offset:offset + chunk_size] as chunk:
+                    file.write(chunk)
+                    written += len(chunk)
+        return written
+
+
+def find_video_pid(buffer, max_packets=10000):
+    """PID of the first video PES stream in an m2ts buffer. Raises ValueError if there isn't one
+    within the first max_packets packets"""
+    for packet in range(0, min(len(buffer), max_packets * PACKET_SIZE) - PACKET_SIZE + 1,
+                        PACKET_SIZE):
+        ts = packet + TS_OFFSET
+        if buffer[ts] != 0x47 or not buffer[ts + 1] & 0x40:
+            continue
+        payload = _payload_offset(buffer, packet)
+        if payload is None or buffer[payload:payload + 3] != b'\x00\x00\x01':
+            continue
+        stream_id = buffer[payload + 3]
+        # MPEG video streams, or the extended stream id VC-1 uses
+        if 0xE0 <= stream_id <= 0xEF or stream_id == 0xFD:
+            return ((buffer[ts + 1] & 0x1F) << 8) | buffer[ts + 2]
+    raise ValueError('No video stream found')
+
+
+def _pes_start_re(pid):
+    # Sync byte, then transport error clear, payload unit start set, priority either way
+    high = pid >> 8
+    return re.compile(b'(?=\\x47[' + re.escape(bytes([0x40 | high]))
+                      + re.escape(bytes([0x60 | high])) + b']' + re.escape(bytes([pid & 0xFF]))
+                      + b')', re.DOTALL)
+
+
+def _payload_offset(buffer, packet):
+    ts = packet + TS_OFFSET
+    adaptation_field_control = (buffer[ts + 3] >> 4) & 0x3
+    if not adaptation_field_control & 0x1:
+        return None
+    payload = ts + 4
+    if adaptation_field_control & 0x2:
+        payload += 1 + buffer[payload]
+    if payload >= packet + PACKET_SIZE:
+        return None
+    return payload
+
+
+def _parse_pes_start(buffer, packet):
+    ts = packet + TS_OFFSET
+    if packet + PACKET_SIZE > len(buffer):
+        return None
+    payload = _payload_offset(buffer, packet)
+    if payload is None or buffer[payload:payload + 3] != b'\x00\x00\x01':
+        return None
+    if not buffer[payload + 7] & 0x80:
+        return None
+    b = buffer[payload + 9:payload + 14]
+    pts = (((b[0] >> 1) & 0x7) << 30) | (b[1] << 22) | ((b[2] >> 1) << 15) | (b[3] << 7) \
+        | (b[4] >> 1)
+    keyframe = 0
+    if (buffer[ts + 3] >> 4) & 0x2 and buffer[ts + 4] > 0:
+        keyframe = 1 if buffer[ts + 5] & 0x40 else 0
+    return pts, keyframe
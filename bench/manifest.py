@@ -0,0 +1,116 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+import os
+import threading
+
+SAMPLE_SIZE = 1024 * 1024
+
+
+def file_identity(path, sample_hash=False):
+    """String identifying the current contents of a file without reading all of it. By default this
+    is its size and modification time. With sample_hash it is its size and a hash of its first,
+    middle and last SAMPLE_SIZE bytes, which survives copies that don't keep modification times.
+    Returns 'missing' if there is no such file"""
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 'missing'
+    if not sample_hash:
+        return '{0}:{1}'.format(stat.st_size, stat.st_mtime_ns)
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for offset in sorted({0, max(stat.st_size // 2 - SAMPLE_SIZE // 2, 0),
+                              max(stat.st_size - SAMPLE_SIZE, 0)}):
+            file.seek(offset)
+            digest.update(file.read(SAMPLE_SIZE))
+    return '{0}:{1}'.format(stat.st_size, digest.hexdigest())
+
+
+class Manifest:
+
+    """
+    Record of the jobs that have finished, kept in a JSON file so reruns can skip jobs whose inputs
+    and arguments haven't changed, like make. Pass one as the manifest argument of jobs.run_jobs.
+    A job is fingerprinted from its full command line, which has its arguments in sorted order,
+    and the identity of each of its inputs. It is up to date when its fingerprint matches the one
+    recorded when it last succeeded and its outputs haven't changed since. Since a rerun job
+    changes its outputs, and those are the inputs of the jobs after it, only the jobs downstream of
+    a change are rerun.
+    Public methods:
+        __init__(path, sample_hash=False):
+            Arguments:
+                path: [string] The file location of the manifest. Created when first saved. A
+                    manifest that can't be read, e.g. one cut short, is treated as empty so every
+                    job runs again
+                sample_hash: [bool] Identify files by sampled hash rather than modification time.
+                    See file_identity
+        fingerprint(job): Returns the fingerprint of the job as its inputs are now
+        is_up_to_date(job, fingerprint): Whether the job can be skipped
+        record(job, fingerprint): Records the job as finished and saves the manifest
+        forget(job): Removes the job so that it runs next time and saves the manifest
+    """
+
+    def __init__(self, path, sample_hash=False):
+        self.path = path
+        self.sample_hash = sample_hash
+        self._lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self._entries = json.load(file)
+        except (FileNotFoundError, ValueError):
+            self._entries = {}
+        if not isinstance(self._entries, dict):
+            self._entries = {}
+
+    def fingerprint(self, job):
+        digest = hashlib.sha256()
+        command = job.command
+        argv = [command] if isinstance(command, str) else command.argv
+        digest.update(json.dumps(argv).encode())
+        for input_loc in sorted(job.inputs):
+            digest.update(json.dumps([input_loc, self._identity(input_loc)]).encode())
+        return digest.hexdigest()
+
+    def is_up_to_date(self, job, fingerprint):
+        with self._lock:
+            entry = self._entries.get(job.name)
+        if not entry or entry['fingerprint'] != fingerprint:
+            return False
+        return all(self._identity(output) == identity
+                   for output, identity in entry['outputs'].items()) \
+            and set(entry['outputs']) == set(job.outputs)
+
+    def record(self, job, fingerprint):
+        outputs = {output: self._identity(output) for output in job.outputs}
+        with self._lock:
+            self._entries[job.name] = {'fingerprint': fingerprint, 'outputs': outputs}
+            self._save()
+
+    def forget(self, job):
+        with self._lock:
+            if self._entries.pop(job.name, None):
+                self._save()
+
+    def _identity(self, path):
+        return file_identity(path, self.sample_hash)
+
+    def _save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self._entries, file, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
@@ -0,0 +1,190 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sqlite3
+import statistics
+import threading
+import time
+from bench import chapters
+
+_schema = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    finished REAL NOT NULL,
+    status TEXT NOT NULL,
+    returncode INTEGER,
+    elapsed REAL NOT NULL,
+    run_length REAL,
+    resolution TEXT,
+    profile TEXT,
+    frames INTEGER,
+    fps REAL,
+    output_size INTEGER,
+    argv TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_kind ON jobs (kind, resolution, profile);
+'''
+
+
+class JobFeatures:
+
+    """
+    What is known about a job before it runs, which its runtime is predicted from
+    Public data members:
+        kind: [string] 'Audio', 'Video' or 'Mux', as in the job names JobGraph gives
+        run_length: [nullable float] Seconds of the title the job encodes
+        resolution: [nullable string] e.g. '1080p'
+        frame_rate: [nullable string] Frame rate of the title, used to work out frames per second
+        profile: [nullable string] The name of the profiles.Profile the job uses
+    """
+
+    __slots__ = ('kind', 'run_length', 'resolution', 'frame_rate', 'profile')
+
+    def __init__(self, kind, run_length=None, resolution=None, frame_rate=None, profile=None):
+        self.kind = kind
+        self.run_length = run_length
+        self.resolution = resolution
+        self.frame_rate = frame_rate
+        self.profile = profile
+
+    @staticmethod
+    def from_title(kind, title_info, profile=None):
+        """Features of a job encoding a whole disc.BlurayTitleInfo or disc.DiscTitle"""
+        run_length = (title_info.run_length - chapters.Chapter.min_time).total_seconds()
+        return JobFeatures(kind, run_length, title_info.resolution, title_info.frame_rate,
+                           profile.name if hasattr(profile, 'name') else profile)
+
+    @property
+    def frames(self):
+        if self.run_length is None or self.frame_rate is None:
+            return None
+        return round(self.run_length * chapters.parse_frame_rate(self.frame_rate))
+
+
+def job_kind(job):
+    """The jobs.Job kind of the job, or for jobs without one the first word of its name"""
+    return job.kind or job.name.split(' ', 1)[0]
+
+
+class MetricsStore:
+
+    """
+    SQLite record of finished jobs, used to predict how long new jobs will take
+    Public methods:
+        __init__(path):
+            Arguments:
+                path: [string] The file location of the database. Created if missing.
+                    ':memory:' keeps it in memory
+        record(job, result, features=None): Records a jobs.JobResult of the job
+        recorder(graph, features=None, on_result=None): Returns a callable to give jobs.run_jobs
+            as on_result that records every result. features is a dictionary of job name to
+            JobFeatures, and on_result is passed each result afterwards
+        predict(features): Returns the predicted seconds for a job, or None without history
+        priorities(graph, features): Returns a callable to give jobs.run_jobs as priority
+        close(): Closes the database. Also done when used as a context manager
+
+    Predictions come from the successful runs of the same kind, resolution and profile, falling back
+    to ones that only match on fewer of those. Jobs with a run length are scaled by it, using the
+    median seconds taken per second of title, and other jobs take the median seconds taken.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._db:
+            self._db.executescript(_schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._db.close()
+
+    def record(self, job, result, features=None):
+        if result.returncode is None:
+            # Skipped or up to date, so there is no runtime to learn from
+            return
+        if features is None:
+            features = JobFeatures(job_kind(job))
+        frames = features.frames
+        fps = frames / result.elapsed if frames and result.elapsed > 0 else None
+        output_size = sum(os.path.getsize(output) for output in job.outputs
+                          if os.path.isfile(output))
+        command = job.command
+        argv = json.dumps([command] if isinstance(command, str) else command.argv)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT INTO jobs (name, kind, finished, status, returncode, elapsed, run_length, '
+                'resolution, profile, frames, fps, output_size, argv) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job.name, features.kind, time.time(), result.status, result.returncode,
+                 result.elapsed, features.run_length, features.resolution, features.profile,
+                 frames, fps, output_size, argv))
+
+    def recorder(self, graph, features=None, on_result=None):
+        features = features or {}
+
+        def record_result(result):
+            self.record(graph[result.name], result, features.get(result.name))
+            if on_result:
+                on_result(result)
+        return record_result
+
+    def predict(self, features):
+        for columns in (('resolution', 'profile'), ('resolution',), ()):
+            where = ['kind = ?', "status = 'ok'"]
+            params = [features.kind]
+            for column in columns:
+                value = getattr(features, column)
+                if value is None:
+                    where.append(column + ' IS NULL')
+                else:
+                    where.append(column + ' = ?')
+                    params.append(value)
+            with self._lock:
+                rows = self._db.execute('SELECT elapsed, run_length FROM jobs WHERE '
+                                        + ' AND '.join(where), params).fetchall()
+            if features.run_length:
+                rates = [elapsed / run_length for elapsed, run_length in rows if run_length]
+                if rates:
+                    return statistics.median(rates) * features.run_length
+            elif rows:
+                return statistics.median(elapsed for elapsed, _ in rows)
+        return None
+
+    def priorities(self, graph, features=None):
+        """Priority of each job is its predicted seconds plus those of the longest chain of jobs
+        waiting on it, so the jobs holding up the end of the batch start first. For independent
+        jobs this is longest job first. Jobs without a prediction count as taking no time"""
+        features = features or {}
+        estimates = {}
+        for job in graph:
+            estimate = self.predict(features.get(job.name) or JobFeatures(job_kind(job)))
+            estimates[job.name] = estimate or 0.0
+        dependents = {job.name: [] for job in graph}
+        for job in graph:
+            for dep in graph.dependencies(job.name):
+                dependents[dep].append(job.name)
+        chains = {}
+        for job in reversed(graph.topological_order()):
+            chains[job.name] = estimates[job.name] + max(
+                (chains[dependent] for dependent in dependents[job.name]), default=0.0)
+        return lambda job: chains[job.name]
@@ -0,0 +1,295 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Pure Python reader of the bluray playlist (BDMV/PLAYLIST/*.mpls) and clip information
+(BDMV/CLIPINF/*.clpi) files, for reading titles without libbluray.
+
+MplsBluray mirrors the parts of bluread.Bluray that disc.BlurayTitleInfo uses, so it can be given as
+the bd argument or picked with backend='mpls'. Titles are the playlists in file name order and the
+main title is the longest one. libbluray instead filters out duplicate and very short playlists,
+so title numbers may differ between the two backends. Playlists aren't encrypted, so no keys are
+needed."""
+
+import mmap
+import os
+import struct
+from bench import chapters, tracing
+
+_video_formats = {1: '480i', 2: '576i', 3: '480p', 4: '1080i', 5: '720p', 6: '1080p', 7: '576p',
+                  8: '2160p'}
+_frame_rates = {1: '23.976', 2: '24', 3: '25', 4: '29.97', 6: '50', 7: '59.94'}
+# MPEG-1, MPEG-2, VC-1, H.264, MVC and HEVC video
+_video_coding_types = {0x01, 0x02, 0xEA, 0x1B, 0x20, 0x24}
+
+_u8 = struct.Struct('>B')
+_u16 = struct.Struct('>H')
+_u32 = struct.Struct('>I')
+
+
+class PlayItem:
+
+    __slots__ = ('clip_id', 'in_time', 'out_time', 'num_audio_tracks', 'video_format',
+                 'frame_rate')
+
+    def __init__(self, clip_id, in_time, out_time, num_audio_tracks, video_format, frame_rate):
+        self.clip_id = clip_id
+        self.in_time = in_time
+        self.out_time = out_time
+        self.num_audio_tracks = num_audio_tracks
+        self.video_format = video_format
+        self.frame_rate = frame_rate
+
+
+class Playlist:
+
+    """
+    The contents of a .mpls file
+    Public data members:
+        play_items: [list<PlayItem>] The clips played, in order. Times are 45 kHz ticks
+        chapter_starts: [list<int>] The start of each chapter in 90 kHz ticks from the start of the
+            playlist
+        duration: [int] The length of the playlist in 90 kHz ticks
+    """
+
+    __slots__ = ('play_items', 'chapter_starts', 'duration')
+
+    def __init__(self, play_items, chapter_starts, duration):
+        self.play_items = play_items
+        self.chapter_starts = chapter_starts
+        self.duration = duration
+
+
+@tracing.traced('mpls.read_mpls')
+def read_mpls(path):
+    """Parse a .mpls file into a Playlist. Raises ValueError if it isn't a playlist"""
+    with _map(path) as data:
+        if data[:4] != b'MPLS':
+            raise ValueError(path + ' is not a playlist')
+        playlist_start, mark_start = struct.unpack_from('>II', data, 8)
+
+        num_play_items, = _u16.unpack_from(data, playlist_start + 6)
+        play_items = []
+        pos = playlist_start + 10
+        for _ in range(num_play_items):
+            length, = _u16.unpack_from(data, pos)
+            play_items.append(_read_play_item(data, pos + 2))
+            pos += 2 + length
+
+        item_starts = []
+        elapsed = 0
+        for item in play_items:
+            item_starts.append(elapsed)
+            elapsed += item.out_time - item.in_time
+
+        num_marks, = _u16.unpack_from(data, mark_start + 4)
+        chapter_starts = []
+        for i in range(num_marks):
+            mark = mark_start + 6 + i * 14
+            mark_type, item_id, timestamp = struct.unpack_from('>BHI', data, mark + 1)
+            # Only entry marks are chapters
+            if mark_type != 1 or item_id >= len(play_items):
+                continue
+            start = item_starts[item_id] + timestamp - play_items[item_id].in_time
+            chapter_starts.append(start * 2)
+        if not chapter_starts:
+            chapter_starts.append(0)
+    return Playlist(play_items, chapter_starts, elapsed * 2)
+
+
+class ClipInfo:
+
+    """
+    The parts of a .clpi file used here
+    Public data members:
+        video_format: [nullable string] The resolution of the first video stream, e.g. '1080p'
+        frame_rate: [nullable string] The frame rate of the first video stream, e.g. '23.976'
+        num_streams: [int] The number of elementary streams in the clip
+    """
+
+    __slots__ = ('video_format', 'frame_rate', 'num_streams')
+
+    def __init__(self, video_format, frame_rate, num_streams):
+        self.video_format = video_format
+        self.frame_rate = frame_rate
+        self.num_streams = num_streams
+
+
+@tracing.traced('mpls.read_clpi')
+def read_clpi(path):
+    """Parse a .clpi file into a ClipInfo. Raises ValueError if it isn't clip information"""
+    with _map(path) as data:
+        if data[:4] != b'HDMV':
+            raise ValueError(path + ' is not clip information')
+        program_info_start, = _u32.unpack_from(data, 12)
+        num_sequences, = _u8.unpack_from(data, program_info_start + 5)
+        pos = program_info_start + 6
+        video_format = frame_rate = None
+        num_streams = 0
+        for _ in range(num_sequences):
+            sequence_streams, = _u8.unpack_from(data, pos + 6)
+            pos += 8
+            for _ in range(sequence_streams):
+                length, coding_type, attributes = struct.unpack_from('>BBB', data, pos + 2)
+                if video_format is None and coding_type in _video_coding_types:
+                    video_format = _video_formats.get(attributes >> 4)
+                    frame_rate = _frame_rates.get(attributes & 0xF)
+                num_streams += 1
+                pos += 3 + length
+    return ClipInfo(video_format, frame_rate, num_streams)
+
+
+class MplsBluray:
+
+    def __init__(self, bd_loc, bd_key_loc=None):
+        """Stand-in for bluread.Bluray that reads the playlist and clip information files itself
+
+        Arguments:
+        bd_loc: string root directory of the bluray
+        bd_key_loc: Ignored, since playlists aren't encrypted"""
+
+        self.bd_loc = bd_loc
+        playlist_dir = os.path.join(bd_loc, 'BDMV', 'PLAYLIST')
+        self._playlist_files = sorted(name for name in os.listdir(playlist_dir)
+                                      if name.lower().endswith('.mpls'))
+        self._playlists = {}
+        self._clip_infos = {}
+        self._main_title_num = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def Open(self):
+        pass
+
+    @property
+    def NumberOfTitles(self):
+        return len(self._playlist_files)
+
+    @property
+    def MainTitleNumber(self):
+        if self._main_title_num is None:
+            durations = [self._playlist(i).duration for i in range(self.NumberOfTitles)]
+            if not durations:
+                raise ValueError('No playlists found')
+            self._main_title_num = durations.index(max(durations))
+        return self._main_title_num
+
+    def GetTitle(self, title_num):
+        if not 0 <= title_num < self.NumberOfTitles:
+            raise IndexError('No title ' + str(title_num))
+        return MplsTitle(self, self._playlist_files[title_num], self._playlist(title_num))
+
+    def _playlist(self, title_num):
+        playlist = self._playlists.get(title_num)
+        if playlist is None:
+            path = os.path.join(self.bd_loc, 'BDMV', 'PLAYLIST', self._playlist_files[title_num])
+            playlist = self._playlists[title_num] = read_mpls(path)
+        return playlist
+
+    def _clip_info(self, clip_id):
+        if clip_id not in self._clip_infos:
+            path = os.path.join(self.bd_loc, 'BDMV', 'CLIPINF', clip_id + '.clpi')
+            try:
+                self._clip_infos[clip_id] = read_clpi(path)
+            except (OSError, ValueError, struct.error):
+                self._clip_infos[clip_id] = None
+        return self._clip_infos[clip_id]
+
+
+class MplsTitle:
+
+    def __init__(self, bd, playlist_file, playlist):
+        self.Playlist = playlist_file
+        self.LengthFancy = _fancy(playlist.duration)
+        self.NumberOfChapters = len(playlist.chapter_starts)
+        self.NumberOfClips = len(playlist.play_items)
+        self._bd = bd
+        self._playlist = playlist
+
+    def GetChapter(self, chapter_num):
+        # Numbered from 0, as disc._read_chapters expects
+        starts = self._playlist.chapter_starts
+        start = starts[chapter_num] if chapter_num < len(starts) else self._playlist.duration
+        end = starts[chapter_num + 1] if chapter_num + 1 < len(starts) \
+            else self._playlist.duration
+        return MplsChapter(_fancy(start), _fancy(max(end - start, 0)))
+
+    def GetClip(self, clip_num):
+        item = self._playlist.play_items[clip_num]
+        video_format, frame_rate = item.video_format, item.frame_rate
+        clip_info = self._bd._clip_info(item.clip_id)
+        if clip_info and clip_info.video_format:
+            video_format, frame_rate = clip_info.video_format, clip_info.frame_rate
+        return MplsClip(item.clip_id, item.num_audio_tracks, MplsVideo(video_format, frame_rate))
+
+
+class MplsChapter:
+
+    def __init__(self, start_fancy, length_fancy):
+        self.StartFancy = start_fancy
+        self.LengthFancy = length_fancy
+
+
+class MplsClip:
+
+    def __init__(self, clip_id, num_audio_tracks, video):
+        self.ClipId = clip_id
+        self.NumberOfAudiosPrimary = num_audio_tracks
+        self._video = video
+
+    def GetVideo(self, index):
+        return self._video
+
+
+class MplsVideo:
+
+    def __init__(self, video_format, rate):
+        self.Format = video_format
+        self.Rate = rate
+
+
+def _read_play_item(data, pos):
+    clip_id = bytes(data[pos:pos + 5]).decode('ascii')
+    flags, = _u16.unpack_from(data, pos + 9)
+    # 45 kHz ticks
+    in_time, out_time = struct.unpack_from('>II', data, pos + 12)
+    pos += 32
+    if flags & 0x10:
+        num_angles, = _u8.unpack_from(data, pos)
+        pos += 2 + (num_angles - 1) * 10
+
+    # STN table
+    num_video, num_audio = struct.unpack_from('>BB', data, pos + 4)
+    video_format = frame_rate = None
+    if num_video:
+        entry = pos + 16
+        entry += 1 + data[entry]
+        coding_type, attributes = struct.unpack_from('>BB', data, entry + 1)
+        if coding_type in _video_coding_types:
+            video_format = _video_formats.get(attributes >> 4)
+            frame_rate = _frame_rates.get(attributes & 0xF)
+    return PlayItem(clip_id, in_time, out_time, num_audio, video_format, frame_rate)
+
+
+def _fancy(ticks):
+    # 90 kHz ticks to milliseconds, formatted as bluread does
+    return chapters.format_ms((ticks + 45) // 90)
+
+
+def _map(path):
+    with open(path, 'rb') as file:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
@@ -0,0 +1,232 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from collections.abc import Mapping
+from bench import commands
+
+X264_OPTIONS = frozenset([
+    # Short forms
+    'I', 'i', 'b', 'r', 'q', 'B', 'A', 'w', 'm', 't', 'o', 'v', 'p',
+    # Presets
+    'profile', 'preset', 'tune', 'slow-firstpass',
+    # Frame-type
+    'keyint', 'min-keyint', 'no-scenecut', 'scenecut', 'intra-refresh', 'bframes', 'b-adapt',
+    'b-bias', 'b-pyramid', 'open-gop', 'no-cabac', 'ref', 'no-deblock', 'deblock', 'slices',
+    'slices-max', 'slice-max-size', 'slice-max-mbs', 'slice-min-mbs', 'tff', 'bff',
+    'constrained-intra', 'pulldown', 'fake-interlaced', 'frame-packing',
+    # Ratecontrol
+    'qp', 'bitrate', 'crf', 'rc-lookahead', 'vbv-maxrate', 'vbv-bufsize', 'vbv-init', 'crf-max',
+    'qpmin', 'qpmax', 'qpstep', 'ratetol', 'ipratio', 'pbratio', 'chroma-qp-offset', 'aq-mode',
+    'aq-strength', 'pass', 'stats', 'no-mbtree', 'qcomp', 'cplxblur', 'qblur', 'zones', 'qpfile',
+    # Analysis
+    'partitions', 'direct', 'no-weightb', 'weightp', 'me', 'merange', 'mvrange', 'mvrange-thread',
+    'subme', 'psy-rd', 'no-psy', 'no-mixed-refs', 'no-chroma-me', '8x8dct', 'no-8x8dct',
+    'trellis', 'no-fast-pskip', 'no-dct-decimate', 'nr', 'deadzone-inter', 'deadzone-intra',
+    'cqm', 'cqmfile', 'cqm4', 'cqm8', 'cqm4i', 'cqm4p', 'cqm8i', 'cqm8p', 'cqm4iy', 'cqm4ic',
+    'cqm4py', 'cqm4pc',
+    # Video usability info
+    'overscan', 'videoformat', 'range', 'colorprim', 'transfer', 'colormatrix', 'chromaloc',
+    'nal-hrd', 'filler', 'pic-struct', 'crop-rect',
+    # Input/Output
+    'output', 'muxer', 'demuxer', 'input-fmt', 'input-csp', 'output-csp', 'input-depth',
+    'output-depth', 'input-range', 'input-res', 'index', 'sar', 'fps', 'seek', 'frames', 'level',
+    'bluray-compat', 'avcintra-class', 'stitchable', 'verbose', 'quiet', 'no-progress', 'psnr',
+    'ssim', 'threads', 'lookahead-threads', 'sliced-threads', 'thread-input', 'sync-lookahead',
+    'non-deterministic', 'cpu-independent', 'asm', 'no-asm', 'opencl', 'opencl-clbin',
+    'opencl-device', 'dump-yuv', 'sps-id', 'aud', 'force-cfr', 'tcfile-in', 'tcfile-out',
+    'timebase', 'dts-compress', 'vf', 'video-filter', 'log-level', 'log-file', 'log-file-level',
+    'interlaced', 'no-interlaced',
+])
+
+KNOWN_OPTIONS = {
+    'x264': X264_OPTIONS,
+    'avs4x26x': X264_OPTIONS | {'x26x-binary', 'L'},
+    'neroAAC': frozenset(['q', 'br', 'cbr', 'lc', 'he', 'hev2', '2pass', '2passperiod',
+                          'ignorelength', 'if', 'of']),
+    'mkvmerge': frozenset([
+        'o', 'q', 'v', 'a', 'd', 's', 'A', 'D', 'S', 'M', 'T',
+        # Global
+        'output', 'title', 'default-language', 'chapters', 'chapter-language', 'chapter-charset',
+        'generate-chapters', 'generate-chapters-name-template', 'global-tags', 'track-order',
+        'append-mode', 'append-to', 'split', 'split-max-files', 'link', 'link-to-previous',
+        'link-to-next', 'segment-uid', 'segmentinfo', 'disable-track-statistics-tags', 'no-date',
+        'webm', 'cluster-length', 'timestamp-scale', 'clusters-in-meta-seek', 'no-cues',
+        'disable-lacing', 'enable-durations', 'quiet', 'verbose', 'ui-language',
+        'command-line-charset', 'output-charset', 'gui-mode',
+        # Tracks
+        'language', 'track-name', 'default-track', 'forced-track', 'aspect-ratio',
+        'aspect-ratio-factor', 'display-dimensions', 'default-duration', 'sync', 'compression',
+        'cues', 'tags', 'timestamps', 'fix-bitstream-timing-information', 'nalu-size-length',
+        'audio-tracks', 'video-tracks', 'subtitle-tracks', 'button-tracks', 'track-tags',
+        'attachments', 'no-audio', 'no-video', 'no-subtitles', 'no-buttons', 'no-chapters',
+        'no-attachments', 'no-global-tags', 'no-track-tags', 'sub-charset', 'stereo-mode',
+        'cropping', 'fourcc', 'aac-is-sbr', 'reduce-to-core', 'remove-dialog-normalization-gain',
+        'field-order', 'chapter-sync', 'attachment-description', 'attachment-mime-type',
+        'attachment-name', 'attach-file', 'attach-file-once',
+    ]),
+}
+
+
+class Profile(Mapping):
+
+    """
+    Read-only set of arguments for a program, which can extend another profile. Use it anywhere an
+    args dictionary is taken; its command line tokens and batch file text are rendered once and
+    reused by every command built or written from it, so many episodes only cost their file
+    locations.
+    Public methods:
+        __init__(name, args=None, parent=None, program=None):
+            Arguments:
+                name: [string] The name of the profile, used in error messages
+                args: [nullable string-string dictionary] The arguments, as passed to
+                    commands.write_x264_command and friends. These replace the same arguments of
+                    the parent, and a value of None removes the parent's argument
+                parent: [nullable Profile] The profile this one extends
+                program: [nullable string] One of the keys of KNOWN_OPTIONS. Arguments unknown to
+                    the program raise ValueError. Inherited from the parent when None, and nothing
+                    is checked if neither has one
+        extend(name, args=None, program=None): Returns a new Profile with this one as its parent
+        to_argv(argument_specifier_override=None): Returns the rendered command line tokens
+        to_line(argument_specifier_override=None): Returns the tokens as written to a batch file
+        x264_command(x264_loc, video_input_loc, video_dest_loc, overrides=None): Like
+            commands.x264_command. overrides is a nullable dictionary of per job arguments that
+            replace the profile's, with None removing one. The profile's rendered tokens are
+            reused, with those of the overridden arguments left out and only the overrides
+            rendered per job, after them
+        write_x264_command(file, x264_loc, video_input_loc, video_dest_loc, overrides=None): Like
+            commands.write_x264_command, with overrides as above
+
+    Public data members:
+        name: [string] The name of the profile
+        parent: [nullable Profile] The profile this one extends
+        program: [nullable string] The program the arguments are checked against
+    """
+
+    def __init__(self, name, args=None, parent=None, program=None):
+        if not name:
+            raise ValueError('Must give a name for the profile')
+        if program is None and parent is not None:
+            program = parent.program
+        if program is not None and program not in KNOWN_OPTIONS:
+            raise ValueError('Unknown program ' + program + ' for profile ' + name)
+
+        self.name = name
+        self.parent = parent
+        self.program = program
+        self._args = dict(parent) if parent is not None else {}
+        if args:
+            for key, value in args.items():
+                if value is None:
+                    self._args.pop(key, None)
+                else:
+                    self._args[key] = value
+        if program is not None:
+            unknown = sorted(set(self._args) - KNOWN_OPTIONS[program])
+            if unknown:
+                raise ValueError('Unknown ' + program + ' options in profile ' + name + ': '
+                                 + ', '.join(unknown))
+        # argument_specifier_override to the rendered (key, tokens, batch text) of each argument, in
+        # order, and to the batch text of them all
+        self._rendered = {}
+        self._lines = {}
+        # The overridden arguments of a job to the groups and batch text of the rest
+        self._trimmed = {}
+
+    def __getitem__(self, key):
+        return self._args[key]
+
+    def __iter__(self):
+        return iter(self._args)
+
+    def __len__(self):
+        return len(self._args)
+
+    def __repr__(self):
+        return 'Profile(' + repr(self.name) + ', ' + repr(self._args) + ')'
+
+    def extend(self, name, args=None, program=None):
+        return Profile(name, args, self, program)
+
+    def to_argv(self, argument_specifier_override=None):
+        return [token for _, tokens, _ in self._groups(argument_specifier_override)
+                for token in tokens]
+
+    def to_line(self, argument_specifier_override=None):
+        line = self._lines.get(argument_specifier_override)
+        if line is None:
+            line = self._lines[argument_specifier_override] = ' '.join(
+                text for _, _, text in self._groups(argument_specifier_override))
+        return line
+
+    def x264_command(self, x264_loc, video_input_loc, video_dest_loc, overrides=None):
+        return commands.x264_command(x264_loc, video_input_loc, video_dest_loc,
+                                     self._with_overrides(overrides))
+
+    def write_x264_command(self, file, x264_loc, video_input_loc, video_dest_loc, overrides=None):
+        commands.write_x264_command(file, x264_loc, video_input_loc, video_dest_loc,
+                                    self._with_overrides(overrides))
+
+    def _groups(self, argument_specifier_override):
+        groups = self._rendered.get(argument_specifier_override)
+        if groups is None:
+            groups = self._rendered[argument_specifier_override] = []
+            for key in sorted(self._args):
+                tokens = commands._args_from_dict({key: self._args[key]},
+                                                  argument_specifier_override)
+                groups.append((key, tokens, commands._line(tokens)))
+        return groups
+
+    def _with_overrides(self, overrides):
+        if not overrides:
+            return self
+        if self.program is not None and not KNOWN_OPTIONS[self.program].issuperset(overrides):
+            unknown = sorted(set(overrides) - KNOWN_OPTIONS[self.program])
+            if unknown:
+                raise ValueError('Unknown ' + self.program + ' options in overrides of profile '
+                                 + self.name + ': ' + ', '.join(unknown))
+        extra = commands._args_from_dict({key: value for key, value in overrides.items()
+                                          if value is not None})
+        if self._args.keys().isdisjoint(overrides):
+            # Nothing to leave out, so the whole rendered text is reused
+            groups = self._groups(None)
+            line = self.to_line()
+        else:
+            overridden = frozenset(self._args.keys() & overrides.keys())
+            trimmed = self._trimmed.get(overridden)
+            if trimmed is None:
+                groups = [group for group in self._groups(None) if group[0] not in overridden]
+                trimmed = self._trimmed[overridden] = (
+                    groups, ' '.join(text for _, _, text in groups))
+            groups, line = trimmed
+        if extra:
+            line = (line + ' ' if line else '') + commands._line(extra)
+        return _RenderedArgs(groups, extra, line)
+
+
+class _RenderedArgs:
+
+    # A profile with per job overrides, taken by commands wherever an args dictionary is. The
+    # tokens are only joined up when a command is built, as writing only needs the text
+    __slots__ = ('_groups', '_extra', '_line')
+
+    def __init__(self, groups, extra, line):
+        self._groups = groups
+        self._extra = extra
+        self._line = line
+
+    def to_argv(self, argument_specifier_override=None):
+        return [token for _, tokens, _ in self._groups for token in tokens] + self._extra
+
+    def to_line(self, argument_specifier_override=None):
+        return self._line
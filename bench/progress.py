@@ -0,0 +1,185 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import json
+import re
+import subprocess
+import sys
+import threading
+import time
+from bench import commands, jobs
+
+# e.g. '[45.2%] 1234/2730 frames, 23.45 fps, 5012.34 kb/s, eta 0:01:02'
+#      '1234 frames: 23.45 fps, 5012.34 kb/s'
+#      'encoded 2730 frames, 23.45 fps, 5012.34 kb/s'
+_progress_re = re.compile(
+    r'(?P<encoded>encoded )?(?P<frames>\d+)(?:/(?P<total_frames>\d+))? frames[:,]\s*'
+    r'(?P<fps>[\d.]+) fps,\s*(?P<kbps>[\d.]+) kb/s'
+    r'(?:.*?eta (?P<eta>\d+:\d{2}:\d{2}))?')
+
+
+class X264Progress:
+
+    """
+    A single progress report of a running x264
+    Public data members:
+        job: [string] The name of the job
+        frames: [int] The number of frames encoded so far
+        total_frames: [nullable int] The number of frames to encode, when x264 knows it
+        fps: [float] The average encoding speed in frames per second
+        kbps: [float] The average bitrate of the output so far in kb/s
+        elapsed: [float] Wall-clock seconds since the encode was started
+        eta: [nullable int] x264's estimate of the seconds left, when it knows it
+        done: [bool] Whether this is x264's final report
+    """
+
+    __slots__ = ('job', 'frames', 'total_frames', 'fps', 'kbps', 'elapsed', 'eta', 'done')
+
+    fields = __slots__
+
+    def __init__(self, job, frames, total_frames, fps, kbps, elapsed, eta, done):
+        self.job = job
+        self.frames = frames
+        self.total_frames = total_frames
+        self.fps = fps
+        self.kbps = kbps
+        self.elapsed = elapsed
+        self.eta = eta
+        self.done = done
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.fields}
+
+
+def parse_x264_progress(line, job=None, elapsed=0.0):
+    """X264Progress of a line of x264's standard error, or None if it isn't a progress line"""
+    match = _progress_re.search(line)
+    if not match:
+        return None
+    eta = None
+    if match.group('eta'):
+        hours, minutes, seconds = match.group('eta').split(':')
+        eta = (int(hours) * 60 + int(minutes)) * 60 + int(seconds)
+    total_frames = match.group('total_frames')
+    return X264Progress(job, int(match.group('frames')),
+                        int(total_frames) if total_frames else None,
+                        float(match.group('fps')), float(match.group('kbps')), elapsed, eta,
+                        bool(match.group('encoded')))
+
+
+def iter_lines(stream, chunk_size=4096):
+    """Lines of a binary stream as they arrive, split on either carriage returns or newlines since
+    x264 redraws its progress line with carriage returns"""
+    pending = b''
+    read = getattr(stream, 'read1', stream.read)
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        pending += chunk
+        lines = re.split(b'[\r\n]', pending)
+        pending = lines.pop()
+        for line in lines:
+            if line:
+                yield line.decode(errors='replace')
+    if pending:
+        yield pending.decode(errors='replace')
+
+
+class JsonlSink:
+
+    def __init__(self, file):
+        """Callback that writes each X264Progress to file as a line of JSON. Safe to share between
+        concurrent jobs
+
+        Arguments:
+        file: The text file"""
+        self.file = file
+        self._lock = threading.Lock()
+
+    def __call__(self, progress):
+        line = json.dumps(progress.to_dict()) + '\n'
+        with self._lock:
+            self.file.write(line)
+            self.file.flush()
+
+
+class CsvSink:
+
+    def __init__(self, file):
+        """Callback that writes each X264Progress to file as a row of CSV after a header row. Safe
+        to share between concurrent jobs
+
+        Arguments:
+        file: The text file, opened with newline=''"""
+        self.file = file
+        self._writer = csv.DictWriter(file, X264Progress.fields)
+        self._lock = threading.Lock()
+        self._wrote_header = False
+
+    def __call__(self, progress):
+        with self._lock:
+            if not self._wrote_header:
+                self._writer.writeheader()
+                self._wrote_header = True
+            self._writer.writerow(progress.to_dict())
+            self.file.flush()
+
+
+def run_with_progress(command, callbacks, job=None, passthrough=None):
+    """Run an x264 command, calling every callback with each X264Progress as x264 reports it
+
+    Arguments:
+    command: commands.Command of x264
+    callbacks: list of callables taking an X264Progress, e.g. JsonlSink or CsvSink
+    job: Nullable string name of the job given in each X264Progress
+    passthrough: Nullable text file that lines of standard error which aren't progress reports are
+        written to, so that x264's warnings and errors aren't lost. Defaults to sys.stderr
+
+    Returns the exit status of x264"""
+
+    if passthrough is None:
+        passthrough = sys.stderr
+    start = time.perf_counter()
+    process = command.popen(stderr=subprocess.PIPE)
+    try:
+        for line in iter_lines(process.stderr):
+            progress = parse_x264_progress(line, job, time.perf_counter() - start)
+            if progress:
+                for callback in callbacks:
+                    callback(progress)
+            else:
+                passthrough.write(line + '\n')
+    except BaseException:
+        # A callback failed. Don't leave x264 running with nobody reading its output
+        process.kill()
+        raise
+    finally:
+        process.stderr.close()
+        returncode = process.wait()
+    return returncode
+
+
+def make_progress_runner(callbacks, passthrough=None):
+    """Runner for jobs.run_jobs that reports the progress of x264 jobs to the callbacks. The
+    standard error of every jobs.Job.VIDEO job with a single commands.Command is watched for x264
+    progress reports. Other jobs are run with jobs.run_command"""
+
+    def runner(job):
+        if job.kind == jobs.Job.VIDEO and isinstance(job.command, commands.Command):
+            return run_with_progress(job.command, callbacks, job.name, passthrough)
+        return jobs.run_command(job)
+
+    return runner
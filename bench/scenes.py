@@ -0,0 +1,245 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Find scene cuts in raw Y4M video, e.g. piped from avs2yuv, and use them to split a title into
+segments of even length for parallel encoding. segments.plan_segments can only cut at chapters,
+which leaves lopsided segments on titles with few or uneven chapters.
+
+NumPy is used for the frame differences when it is installed. Without it a slower pure Python
+path looks at a sparser grid of pixels."""
+
+import mmap
+import sys
+import weakref
+from array import array
+from fractions import Fraction
+from bench import chapters
+from bench.segments import Segment
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_chroma_planes = {'420': 0.5, '422': 1.0, '444': 2.0, 'mono': 0.0}
+
+
+class Y4mReader:
+
+    """
+    Frames of a YUV4MPEG2 stream, read without copying where possible
+    Public methods:
+        __init__(source):
+            Arguments:
+                source: [string or binary file] A file location, which is memory-mapped, or a file
+                    object such as a pipe, which is read one frame at a time into a reused buffer
+        lumas(): Iterates over the luma plane of every frame as a memoryview. Each one is
+            released when the next is taken, so nothing made from it, e.g. a numpy array, may be
+            kept past then
+        close(): Closes the file if it was opened here, stopping any unfinished lumas. Also done
+            when used as a context manager
+
+    Public data members:
+        width, height: [int] The size of the frames
+        frame_rate: [nullable Fraction] The frame rate in the header
+        colorspace: [string] The C parameter of the header, e.g. '420jpeg' or '420p10'
+        bit_depth: [int] Bits per sample, e.g. 10 for '420p10' or 16 for 'mono16'
+        sample_size: [int] Bytes per sample, 2 for bit depths above 8
+        frame_size: [int] Bytes of picture data per frame
+    """
+
+    def __init__(self, source):
+        self._own_file = isinstance(source, str)
+        self._file = open(source, 'rb') if self._own_file else source
+        self._mmap = None
+        # Unfinished lumas generators, which hold views of the mapping
+        self._iterators = weakref.WeakSet()
+        try:
+            if self._own_file:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                header_end = self._mmap.find(b'\n')
+                header = self._mmap[:header_end]
+                self._pos = header_end + 1
+            else:
+                header = self._file.readline().rstrip(b'\n')
+            self._parse_header(header)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for iterator in list(self._iterators):
+            iterator.close()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._own_file:
+            self._file.close()
+
+    def _parse_header(self, header):
+        fields = header.split(b' ')
+        if fields[0] != b'YUV4MPEG2':
+            raise ValueError('Not a YUV4MPEG2 stream')
+        params = {field[:1]: field[1:].decode('ascii') for field in fields[1:] if field}
+        if b'W' not in params or b'H' not in params:
+            raise ValueError('The YUV4MPEG2 header has no frame size')
+        self.width = int(params[b'W'])
+        self.height = int(params[b'H'])
+        self.frame_rate = None
+        if b'F' in params:
+            num, den = params[b'F'].split(':')
+            self.frame_rate = Fraction(int(num), int(den))
+        self.colorspace = params.get(b'C', '420jpeg')
+        subsampling = 'mono' if self.colorspace.startswith('mono') else self.colorspace[:3]
+        if subsampling not in _chroma_planes:
+            raise ValueError('Unsupported colorspace ' + self.colorspace)
+        # The depth follows the p of e.g. '420p10', or mono as in 'mono16'
+        if subsampling == 'mono':
+            depth = self.colorspace[4:]
+        else:
+            depth = self.colorspace.split('p')[-1] if 'p' in self.colorspace[3:] else ''
+        self.bit_depth = int(depth) if depth.isdigit() else 8
+        if not 8 <= self.bit_depth <= 16:
+            raise ValueError('Unsupported bit depth in colorspace ' + self.colorspace)
+        self.sample_size = 2 if self.bit_depth > 8 else 1
+        luma_size = self.width * self.height
+        self.frame_size = int(luma_size * (1 + _chroma_planes[subsampling])) * self.sample_size
+
+    def lumas(self):
+        iterator = self._lumas()
+        self._iterators.add(iterator)
+        return iterator
+
+    def _lumas(self):
+        luma_size = self.width * self.height * self.sample_size
+        if self._mmap is not None:
+            # Every view is released before the next frame or on close, as the mapping can't be
+            # closed while any is left
+            with memoryview(self._mmap) as view:
+                pos = self._pos
+                while self._mmap[pos:pos + 5] == b'FRAME':
+                    data = self._mmap.find(b'\n', pos) + 1
+                    if not data or data + self.frame_size > len(self._mmap):
+                        break
+                    with view[data:data + luma_size] as luma:
+                        yield luma
+                    pos = data + self.frame_size
+            return
+        buffer = bytearray(self.frame_size)
+        with memoryview(buffer) as view:
+            while self._file.readline().startswith(b'FRAME'):
+                if self._file.readinto(buffer) < self.frame_size:
+                    break
+                with view[:luma_size] as luma:
+                    yield luma
+
+
+def scene_cut_scores(reader, step=4):
+    """Mean absolute luma difference between each frame and the one before it, from 0 to 255, as
+    an array of one float per frame. The first frame scores 0. Only every step-th row and column
+    are compared, which is plenty to see a cut. The pure Python path compares every 4 * step-th"""
+
+    scores = array('d')
+    previous = None
+    # Differences are scaled from the range of the bit depth to 0 to 255
+    scale = 255 / ((1 << reader.bit_depth) - 1)
+    if numpy is not None:
+        dtype = numpy.uint8 if reader.sample_size == 1 else numpy.dtype('<u2')
+        for luma in reader.lumas():
+            # astype copies, so no array is left holding the frame when the next is taken
+            current = numpy.frombuffer(luma, dtype).reshape(reader.height, reader.width)[
+                ::step, ::step].astype(numpy.int32)
+            if previous is None:
+                scores.append(0.0)
+            else:
+                scores.append(float(numpy.abs(current - previous).mean()) * scale)
+            previous = current
+        return scores
+
+    step *= 4
+    row_size = reader.width * reader.sample_size
+    for luma in reader.lumas():
+        if reader.sample_size == 1:
+            rows = [luma[y * row_size:(y + 1) * row_size:step].tobytes()
+                    for y in range(0, reader.height, step)]
+        else:
+            samples = array('H', luma.tobytes())
+            if sys.byteorder == 'big':
+                samples.byteswap()
+            width = reader.width
+            rows = [samples[y * width:(y + 1) * width:step] for y in range(0, reader.height, step)]
+        if previous is None:
+            scores.append(0.0)
+        else:
+            total = count = 0
+            for row, previous_row in zip(rows, previous):
+                total += sum(abs(a - b) for a, b in zip(row, previous_row))
+                count += len(row)
+            scores.append(total / count * scale if count else 0.0)
+        previous = rows
+    return scores
+
+
+def plan_scene_segments(scores, num_segments, chapter_table=None, frame_rate=None,
+                        tolerance=0.1):
+    """Split a title into num_segments segments of close to equal length, cutting at scene cuts
+
+    Arguments:
+    scores: Sequence of one float per frame, e.g. from scene_cut_scores
+    num_segments: int number of segments
+    chapter_table: Nullable chapters.ChapterTable of the title. Chapter starts near a cut point are
+        preferred over any scene cut, since they are cuts the disc author picked
+    frame_rate: Frame rate of the title in any form chapters.parse_frame_rate accepts. Needed
+        with chapter_table
+    tolerance: float fraction of a segment's length that a cut may move from the even split to
+        find a better frame
+
+    Returns a list of segments.Segment covering every frame in order, for
+    segments.add_segmented_video_jobs"""
+
+    if num_segments < 1:
+        raise ValueError('num_segments must be at least 1')
+    total_frames = len(scores)
+    if not total_frames:
+        raise ValueError('Can not split a title without frames')
+    chapter_starts = set()
+    if chapter_table is not None:
+        if frame_rate is None:
+            raise ValueError('chapter_table and frame_rate must be given together')
+        chapter_starts = set(chapter_table.start_frames(chapters.parse_frame_rate(frame_rate)))
+
+    window = max(int(total_frames / num_segments * tolerance), 1)
+    cuts = []
+    for i in range(1, num_segments):
+        target = total_frames * i // num_segments
+        low = max(target - window, cuts[-1] + 1 if cuts else 1)
+        high = min(target + window, total_frames - 1)
+        if low > high:
+            continue
+        candidates = range(low, high + 1)
+        in_window = [frame for frame in candidates if frame in chapter_starts]
+        if in_window:
+            cuts.append(min(in_window, key=lambda frame: abs(frame - target)))
+        else:
+            # The strongest cut, nearest the target when tied
+            cuts.append(max(candidates, key=lambda frame: (scores[frame], -abs(frame - target))))
+
+    bounds = [0] + cuts + [total_frames]
+    return [Segment(first, last - first) for first, last in zip(bounds, bounds[1:])]
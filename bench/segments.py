@@ -0,0 +1,170 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import io
+import os
+from bench import chapters
+from bench.commands import MkvTrack
+
+
+class Segment:
+
+    """
+    A run of frames of a title to be encoded on its own
+    Public data members:
+        first_frame: [int] The first frame of the segment
+        num_frames: [int] The number of frames in the segment
+    """
+
+    __slots__ = ('first_frame', 'num_frames')
+
+    def __init__(self, first_frame, num_frames):
+        self.first_frame = first_frame
+        self.num_frames = num_frames
+
+    def __eq__(self, other):
+        return isinstance(other, Segment) and self.first_frame == other.first_frame \
+            and self.num_frames == other.num_frames
+
+    def __repr__(self):
+        return 'Segment(' + str(self.first_frame) + ', ' + str(self.num_frames) + ')'
+
+
+def plan_segments(chapter_table, frame_rate, num_segments):
+    """Split a title into at most num_segments segments of roughly equal length, cutting only at
+    chapter starts
+
+    Arguments:
+    chapter_table: chapters.ChapterTable of the title, e.g. BlurayTitleInfo.chapter_table
+    frame_rate: The frame rate of the title in any form chapters.parse_frame_rate accepts,
+        e.g. BlurayTitleInfo.frame_rate
+    num_segments: int maximum number of segments. Fewer are returned when there aren't enough
+        chapters
+
+    Returns a list of Segment covering every frame of the title in order"""
+
+    if num_segments < 1:
+        raise ValueError('num_segments must be at least 1')
+    if not len(chapter_table):
+        raise ValueError('Can not split a title without chapters')
+
+    frame_rate = chapters.parse_frame_rate(frame_rate)
+    total_frames = chapters.ticks_to_frames(max(chapter_table.ends), frame_rate)
+    starts = sorted(set(chapter_table.start_frames(frame_rate)) - {0})
+    cuts = []
+    for i in range(1, num_segments):
+        target = total_frames * i / num_segments
+        candidates = [start for start in starts if start < total_frames
+                      and (not cuts or start > cuts[-1])]
+        if not candidates:
+            break
+        cuts.append(min(candidates, key=lambda start: abs(start - target)))
+
+    bounds = [0] + cuts + [total_frames]
+    return [Segment(first, last - first) for first, last in zip(bounds, bounds[1:])]
+
+
+def segment_dest_loc(video_dest_loc, index):
+    """The file location x264 writes the given segment of video_dest_loc to"""
+    return '{0}.part{1:02d}.264'.format(os.path.splitext(video_dest_loc)[0], index + 1)
+
+
+def qpfile_loc_for(video_dest_loc):
+    """The file location of the qpfile written for video_dest_loc"""
+    return os.path.splitext(video_dest_loc)[0] + '.qp'
+
+
+def add_keyframed_video_job(graph, x264_loc, video_input_loc, video_dest_loc, chapter_table,
+                            frame_rate, args=None):
+    """Write a qpfile forcing an IDR frame at every chapter start alongside video_dest_loc, e.g.
+    'folder\\test.qp', and add an x264 job that uses it. Cutting or splitting the encode at chapters
+    is then a stream copy. See commands.write_x264_command for the other arguments
+
+    Arguments:
+    chapter_table: chapters.ChapterTable of the title, e.g. BlurayTitleInfo.chapter_table
+    frame_rate: The frame rate of the title in any form chapters.parse_frame_rate accepts,
+        e.g. BlurayTitleInfo.frame_rate
+
+    Returns the x264 job"""
+
+    qpfile_loc = qpfile_loc_for(video_dest_loc)
+    text = io.StringIO()
+    chapter_table.write_qpfile(text, frame_rate)
+    _write_if_changed(qpfile_loc, text.getvalue())
+    return graph.add_video_job(x264_loc, video_input_loc, video_dest_loc, args, qpfile_loc)
+
+
+def add_segmented_video_jobs(graph, x264_loc, mkvmerge_loc, video_input_loc, video_dest_loc,
+                             segments, args=None, chapter_table=None, frame_rate=None):
+    """Add one x264 job per segment and an mkvmerge job that appends the encoded segments back
+    together into a single video track. The segment jobs don't depend on each other so run_jobs
+    encodes them concurrently, and a failed segment can be rerun on its own.
+
+    Arguments:
+    Note: All file location strings have Parentheses wrapped around them by the commands.
+
+    graph: The jobs.JobGraph
+    x264_loc: The string file location of the x264 executable
+    mkvmerge_loc: String file location of the mkvmerge executable
+    video_input_loc: The string file location of the input video. It must support seeking,
+        e.g. an AviSynth script
+    video_dest_loc: The string file location of the joined video, e.g. 'folder\\test.mkv'.
+        Segments are written alongside it as e.g. 'folder\\test.part01.264'
+    segments: list of Segment, e.g. from plan_segments
+    args: Nullable string, string dictionary for the arguments to be passed to x264.
+        seek and frames are set per segment
+    chapter_table: Nullable chapters.ChapterTable of the title. When given along with frame_rate,
+        each segment gets a qpfile, e.g. 'folder\\test.part01.qp', forcing an IDR frame at every
+        chapter start within it
+    frame_rate: Nullable frame rate of the title in any form chapters.parse_frame_rate accepts
+
+    Returns the mkvmerge job"""
+
+    if not segments:
+        raise ValueError('Must give at least one segment')
+    if (chapter_table is None) != (frame_rate is None):
+        raise ValueError('chapter_table and frame_rate must be given together')
+
+    tracks = []
+    for i, segment in enumerate(segments):
+        segment_args = dict(args) if args else {}
+        segment_args['frames'] = str(segment.num_frames)
+        if segment.first_frame:
+            segment_args['seek'] = str(segment.first_frame)
+        else:
+            segment_args.pop('seek', None)
+        dest_loc = segment_dest_loc(video_dest_loc, i)
+        qpfile_loc = None
+        if chapter_table is not None:
+            # x264 numbers qpfile frames from the start of the input, counting the seek
+            qpfile_loc = qpfile_loc_for(dest_loc)
+            text = io.StringIO()
+            chapter_table.write_qpfile(text, frame_rate, segment.first_frame, segment.num_frames)
+            _write_if_changed(qpfile_loc, text.getvalue())
+        graph.add_video_job(x264_loc, video_input_loc, dest_loc, segment_args, qpfile_loc)
+        tracks.append(MkvTrack(dest_loc, append=i > 0))
+    return graph.add_mux_job(mkvmerge_loc, video_dest_loc, tracks)
+
+
+def _write_if_changed(path, text):
+    # The qpfile is an input of its job, so rewriting the same text would make a manifest.Manifest
+    # see the job as out of date on every build of the graph
+    try:
+        with open(path) as file:
+            if file.read() == text:
+                return
+    except FileNotFoundError:
+        pass
+    with open(path, 'w') as file:
+        file.write(text)
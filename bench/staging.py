@@ -0,0 +1,348 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Copy the m2ts clips of upcoming titles from a disc or network share to local scratch space in
+the background, so encodes read their input from a local disk without waiting for a copy first.
+
+Scripts for the encodes point at ClipStager.local_loc of each clip. Every clip of the batch is
+given to prefetch up front, and the scratch budget throttles how far ahead the copies run:
+once it is full, the copies wait for encodes to release their clips, which are then evicted least
+recently used first. Wrapping the runner with ClipStager.runner holds each job until its clips
+are local.
+
+    stager = staging.ClipStager('/scratch/bench', 200 * 2**30)
+    clips = {job_name: staging.clip_locs(bd_loc, title_info) for ...}
+    stager.prefetch(loc for locs in clips.values() for loc in locs)
+    jobs.run_jobs(graph, runner=stager.runner(clips))
+    stager.close()"""
+
+import collections
+import errno
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from bench import jobs, tracing
+
+# Large enough that an optical drive streams rather than seeks, small enough that close doesn't
+# wait long on a copy in progress, which it stops between blocks
+BLOCK_SIZE = 64 * 2**20
+
+# Errors meaning a copy method isn't supported for these files, so the next one should be tried
+_fallback_errnos = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP,
+                    errno.EBADF, errno.ETXTBSY}
+
+
+def copy_file(src_loc, dest_loc, block_size=BLOCK_SIZE, stop=None):
+    """Copy a file a block at a time, in the kernel without passing through Python where the
+    platform allows it. Uses copy_file_range, which can also clone blocks on filesystems that
+    support it, then sendfile, then plain reads and writes. Returns the number of bytes copied.
+    stop is a nullable callable checked before each block. Once it returns true the copy gives up
+    with InterruptedError, leaving dest_loc partly written"""
+    with open(src_loc, 'rb') as src, open(dest_loc, 'wb') as dest:
+        src_fd = src.fileno()
+        dest_fd = dest.fileno()
+        size = os.fstat(src_fd).st_size
+        pos = 0
+        for method in _copy_methods:
+            try:
+                while pos < size:
+                    if stop and stop():
+                        raise InterruptedError('Copy of ' + src_loc + ' stopped')
+                    copied = method(src_fd, dest_fd, pos, min(block_size, size - pos))
+                    if not copied:
+                        # The source got shorter while being copied
+                        return pos
+                    pos += copied
+                return pos
+            except OSError as error:
+                if isinstance(error, InterruptedError) or error.errno not in _fallback_errnos \
+                        or method is _read_write:
+                    raise
+        return pos
+
+
+def _copy_file_range(src_fd, dest_fd, pos, count):
+    return os.copy_file_range(src_fd, dest_fd, count, pos, pos)
+
+
+def _sendfile(src_fd, dest_fd, pos, count):
+    os.lseek(dest_fd, pos, os.SEEK_SET)
+    return os.sendfile(dest_fd, src_fd, pos, count)
+
+
+def _read_write(src_fd, dest_fd, pos, count):
+    os.lseek(src_fd, pos, os.SEEK_SET)
+    data = memoryview(os.read(src_fd, count))
+    os.lseek(dest_fd, pos, os.SEEK_SET)
+    written = 0
+    while written < len(data):
+        written += os.write(dest_fd, data[written:])
+    return len(data)
+
+
+_copy_methods = ([_copy_file_range] if hasattr(os, 'copy_file_range') else []) \
+    + ([_sendfile] if hasattr(os, 'sendfile') else []) + [_read_write]
+
+
+def clip_locs(bd_loc, title_info):
+    """The file locations of the m2ts clips of a disc.BlurayTitleInfo or disc.DiscTitle"""
+    return [os.path.join(bd_loc, 'BDMV', 'STREAM', clip) for clip in title_info.clip_files]
+
+
+class _Clip:
+
+    __slots__ = ('src_loc', 'local_loc', 'size', 'state', 'refs', 'error')
+
+    QUEUED = 'queued'
+    COPYING = 'copying'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self, src_loc, local_loc, size):
+        self.src_loc = src_loc
+        self.local_loc = local_loc
+        self.size = size
+        self.state = _Clip.QUEUED
+        self.refs = 0
+        self.error = None
+
+
+class ClipStager:
+
+    """
+    Copies clips to scratch space in the background within a budget of bytes
+    Public methods:
+        __init__(scratch_dir, budget, max_workers=1, block_size=BLOCK_SIZE):
+            Arguments:
+                scratch_dir: [string] The directory to copy the clips to. Created if missing
+                budget: [int] The most bytes of clips to keep in scratch_dir at once
+                max_workers: [int] The number of clips copied at once. One suits optical drives,
+                    which slow down badly when read in two places; more can suit network shares
+                block_size: [int] Bytes copied per system call
+        local_loc(src_loc): Returns where the clip at src_loc is copied to
+        prefetch(src_locs): Queues the clips to be copied, in order, skipping those already
+            queued or copied. Raises ValueError for a clip larger than the whole budget
+        acquire(src_loc): Waits for the clip to be copied, queueing it first if needed, and
+            returns its local location. A clip still queued moves ahead of those not acquired.
+            The clip isn't evicted until it is released. Raises the error of a failed copy
+        release(src_loc): Lets the clip be evicted once nothing else has acquired it
+        staged(src_locs): Context manager acquiring every clip and releasing them on exit. Gives
+            the list of local locations
+        runner(clips, runner=jobs.run_command): Returns a runner for jobs.run_jobs that runs each
+            job with its clips staged. clips is a dictionary of job name to its clip locations
+        close(): Stops copying, waiting for at most a block of each copy in progress, and removes
+            every copied clip. Also done when used as a context manager
+
+    Public data members:
+        used: [int] Bytes of scratch space taken by clips copied or being copied
+
+    A clip that has been prefetched but not yet acquired would waste its copy if evicted, so the
+    copies wait for the budget until the clips are used. The exception is a clip that is acquired
+    while the budget is full of them: the most recently queued are evicted to make room, and are
+    queued to copy again after the clips already waiting. Acquiring a clip while holding others
+    can wait forever if the budget can't fit them all.
+    """
+
+    def __init__(self, scratch_dir, budget, max_workers=1, block_size=BLOCK_SIZE):
+        if budget < 1 or max_workers < 1:
+            raise ValueError('budget and max_workers must be at least 1')
+        self.scratch_dir = scratch_dir
+        self.budget = budget
+        self.block_size = block_size
+        self.used = 0
+        os.makedirs(scratch_dir, exist_ok=True)
+        self._clips = {}
+        self._queue = collections.deque()
+        # Released clips, least recently used first
+        self._evictable = collections.OrderedDict()
+        # Copied clips never acquired, in the order they were queued
+        self._prefetched = collections.OrderedDict()
+        self._closed = False
+        self._cond = threading.Condition()
+        self._workers = [threading.Thread(target=self._work, daemon=True)
+                         for _ in range(max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def local_loc(self, src_loc):
+        # Clips of different discs share names like 00001.m2ts, so the name is prefixed with a
+        # hash of the directory they came from
+        src_loc = os.path.abspath(src_loc)
+        digest = hashlib.sha1(os.path.dirname(src_loc).encode('utf-8', 'surrogateescape'))
+        return os.path.join(self.scratch_dir,
+                            digest.hexdigest()[:12] + '-' + os.path.basename(src_loc))
+
+    def prefetch(self, src_locs):
+        for src_loc in src_locs:
+            with self._cond:
+                self._queue_clip(src_loc)
+
+    def acquire(self, src_loc):
+        with self._cond:
+            clip = self._queue_clip(src_loc)
+            clip.refs += 1
+            self._evictable.pop(clip.src_loc, None)
+            self._prefetched.pop(clip.src_loc, None)
+            if clip.state == _Clip.QUEUED and clip.refs == 1:
+                # Move it ahead of the clips not acquired yet, so it doesn't wait behind them for
+                # the budget
+                self._queue.remove(clip)
+                index = 0
+                while index < len(self._queue) and self._queue[index].refs:
+                    index += 1
+                self._queue.insert(index, clip)
+                self._cond.notify_all()
+            while clip.state in (_Clip.QUEUED, _Clip.COPYING) and not self._closed:
+                self._cond.wait()
+            if clip.state != _Clip.READY:
+                clip.refs -= 1
+                if clip.state == _Clip.FAILED:
+                    # Forget it so that acquiring it again retries the copy
+                    self._clips.pop(clip.src_loc, None)
+                    raise clip.error
+                raise ValueError('The ClipStager is closed')
+            return clip.local_loc
+
+    def release(self, src_loc):
+        with self._cond:
+            clip = self._clips[os.path.abspath(src_loc)]
+            clip.refs -= 1
+            if clip.refs == 0 and clip.state == _Clip.READY:
+                self._evictable[clip.src_loc] = clip
+                self._cond.notify_all()
+
+    @contextmanager
+    def staged(self, src_locs):
+        acquired = []
+        try:
+            for src_loc in src_locs:
+                self.acquire(src_loc)
+                acquired.append(src_loc)
+            yield [self.local_loc(src_loc) for src_loc in acquired]
+        finally:
+            if not self._closed:
+                for src_loc in acquired:
+                    self.release(src_loc)
+
+    def runner(self, clips, runner=jobs.run_command):
+        def run_staged(job):
+            with self.staged(clips.get(job.name, ())):
+                return runner(job)
+        return run_staged
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._queue.clear()
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+        with self._cond:
+            for clip in self._clips.values():
+                _remove(clip.local_loc)
+            self._clips.clear()
+            self._evictable.clear()
+            self._prefetched.clear()
+            self.used = 0
+
+    def _queue_clip(self, src_loc):
+        src_loc = os.path.abspath(src_loc)
+        clip = self._clips.get(src_loc)
+        if clip is not None:
+            return clip
+        if self._closed:
+            raise ValueError('The ClipStager is closed')
+        size = os.path.getsize(src_loc)
+        if size > self.budget:
+            raise ValueError(src_loc + ' is larger than the scratch budget')
+        clip = self._clips[src_loc] = _Clip(src_loc, self.local_loc(src_loc), size)
+        self._queue.append(clip)
+        self._cond.notify_all()
+        return clip
+
+    def _work(self):
+        while True:
+            with self._cond:
+                clip = self._next_clip()
+                if clip is None:
+                    return
+            try:
+                with tracing.span('staging.copy', {'clip': clip.src_loc}):
+                    temp_loc = clip.local_loc + '.part'
+                    copied = copy_file(clip.src_loc, temp_loc, self.block_size,
+                                       lambda: self._closed)
+                    os.replace(temp_loc, clip.local_loc)
+                tracing.count('staging.bytes', copied)
+                error = None
+            except Exception as e:
+                _remove(clip.local_loc + '.part')
+                error = e
+            with self._cond:
+                if error is None:
+                    clip.state = _Clip.READY
+                    if not clip.refs:
+                        self._prefetched[clip.src_loc] = clip
+                else:
+                    clip.state = _Clip.FAILED
+                    clip.error = error
+                    self.used -= clip.size
+                self._cond.notify_all()
+
+    def _next_clip(self):
+        # Clips are reserved strictly in queue order, so a large clip at the front isn't starved
+        # by smaller ones behind it
+        while not self._closed:
+            if self._queue:
+                clip = self._queue[0]
+                while self.used + clip.size > self.budget and self._evictable:
+                    self._evict(self._evictable.popitem(last=False)[1])
+                if clip.refs and self.used + clip.size > self.budget and self.used + clip.size \
+                        - sum(ready.size for ready in self._prefetched.values()) <= self.budget:
+                    # Only worth wasting copies if that makes enough room
+                    while self.used + clip.size > self.budget:
+                        self._requeue(self._prefetched.popitem()[1])
+                if self.used + clip.size <= self.budget:
+                    self._queue.popleft()
+                    self.used += clip.size
+                    clip.state = _Clip.COPYING
+                    return clip
+            self._cond.wait()
+        return None
+
+    def _evict(self, clip):
+        _remove(clip.local_loc)
+        del self._clips[clip.src_loc]
+        self.used -= clip.size
+        tracing.count('staging.evictions')
+
+    def _requeue(self, clip):
+        _remove(clip.local_loc)
+        self.used -= clip.size
+        clip.state = _Clip.QUEUED
+        self._queue.append(clip)
+        tracing.count('staging.evictions')
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
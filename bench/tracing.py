@@ -0,0 +1,180 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Timing spans and counters around the stages of a batch: disc reads, chapter processing,
+command generation and job runs.
+
+Tracing is off until start_tracing is called, and until then span and count return at once, so
+the instrumentation can stay in hot paths. Traces load in chrome://tracing or Perfetto with
+Tracer.write_chrome_trace, or can be summed up per span with Tracer.write_summary.
+
+    tracer = tracing.start_tracing()
+    ... run the batch ...
+    tracing.stop_tracing()
+    with open('batch.trace.json', 'w') as file:
+        tracer.write_chrome_trace(file)"""
+
+import functools
+import json
+import os
+import threading
+import time
+
+_tracer = None
+
+
+class Tracer:
+
+    """
+    The spans and counters recorded while tracing
+    Public methods:
+        write_chrome_trace(file): Writes the Chrome trace event JSON
+        summary(): Returns a list of (name, count, total seconds, mean seconds, max seconds) per
+            span name, the most total time first
+        write_summary(file): Writes the summary as a table, followed by the counters
+
+    Public data members:
+        counters: [dictionary] Counter name to its total
+    """
+
+    def __init__(self):
+        self.counters = {}
+        self._events = []
+        self._lock = threading.Lock()
+        self._start_ns = time.perf_counter_ns()
+        self._pid = os.getpid()
+
+    def _add_span(self, name, start_ns, end_ns, args):
+        event = {'name': name, 'cat': name.split('.', 1)[0], 'ph': 'X', 'pid': self._pid,
+                 'tid': threading.get_ident(), 'ts': (start_ns - self._start_ns) / 1000,
+                 'dur': (end_ns - start_ns) / 1000}
+        if args:
+            event['args'] = args
+        # Appending to a list is atomic, so spans from many threads need no lock
+        self._events.append(event)
+
+    def _count(self, name, value):
+        with self._lock:
+            total = self.counters[name] = self.counters.get(name, 0) + value
+        self._events.append({'name': name, 'ph': 'C', 'pid': self._pid,
+                             'ts': (time.perf_counter_ns() - self._start_ns) / 1000,
+                             'args': {'value': total}})
+
+    def write_chrome_trace(self, file):
+        json.dump({'traceEvents': list(self._events), 'displayTimeUnit': 'ms'}, file)
+
+    def summary(self):
+        totals = {}
+        for event in list(self._events):
+            if event['ph'] != 'X':
+                continue
+            entry = totals.setdefault(event['name'], [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += event['dur']
+            entry[2] = max(entry[2], event['dur'])
+        rows = [(name, count, total / 1e6, total / count / 1e6, longest / 1e6)
+                for name, (count, total, longest) in totals.items()]
+        return sorted(rows, key=lambda row: row[2], reverse=True)
+
+    def write_summary(self, file):
+        file.write('{0:<40} {1:>8} {2:>12} {3:>12} {4:>12}\n'.format('span', 'count', 'total s',
+                                                                      'mean ms', 'max ms'))
+        for name, count, total, mean, longest in self.summary():
+            file.write('{0:<40} {1:>8d} {2:>12.3f} {3:>12.3f} {4:>12.3f}\n'.format(
+                name, count, total, mean * 1000, longest * 1000))
+        for name in sorted(self.counters):
+            file.write('{0:<40} {1:>8}\n'.format(name, self.counters[name]))
+
+
+class _Span:
+
+    __slots__ = ('_tracer', '_name', '_args', '_start_ns')
+
+    def __init__(self, tracer, name, args):
+        self._tracer = tracer
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._start_ns = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._tracer._add_span(self._name, self._start_ns, time.perf_counter_ns(), self._args)
+
+
+class _NullSpan:
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+def start_tracing():
+    """Start recording into a new Tracer, which is returned"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing():
+    """Stop recording. Returns the Tracer that was recording, or None"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    return tracer
+
+
+def is_tracing():
+    return _tracer is not None
+
+
+def span(name, args=None):
+    """Context manager timing its body as a span. name is dotted, with the part before the first
+    dot used as its category, e.g. 'disc.title_info'. args is a nullable JSON-able dictionary
+    shown with the span"""
+    tracer = _tracer
+    if tracer is None:
+        return _null_span
+    return _Span(tracer, name, args)
+
+
+def count(name, value=1):
+    """Add value to the named counter"""
+    tracer = _tracer
+    if tracer is not None:
+        tracer._count(name, value)
+
+
+def traced(name):
+    """Decorator timing every call of a function as a span"""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            tracer = _tracer
+            if tracer is None:
+                return function(*args, **kwargs)
+            start_ns = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                tracer._add_span(name, start_ns, time.perf_counter_ns(), None)
+        return wrapper
+    return decorate
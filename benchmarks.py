@@ -0,0 +1,191 @@
+# pyBENCH
+# Copyright (C) 2017 Thomas Sweeney
+# This file is part of pyBENCH.
+# pyBENCH is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# pyBENCH is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+"""Micro-benchmarks of the chapter, disc and command generation hot paths.
+
+Run with 'python benchmarks.py'. Use --save to keep the results as a baseline and --compare to
+show the change against a saved baseline. Disc benchmarks read a synthetic disc made by
+bench.fake_bluread, so no drive is needed. Without bluread installed, bench.fake_bluread takes
+its place."""
+
+import argparse
+import importlib.util
+import io
+import json
+import sys
+import timeit
+import tracemalloc
+from datetime import timedelta
+import bench.fake_bluread
+if importlib.util.find_spec('bluread') is None:
+    sys.modules['bluread'] = bench.fake_bluread
+import bench.chapters
+import bench.commands
+import bench.disc
+import example_x264_defaults
+
+benchmarks = []
+
+
+def benchmark(name):
+    def register(setup):
+        benchmarks.append((name, setup))
+        return setup
+    return register
+
+
+def make_chapters(count, seconds=300):
+    step = timedelta(seconds=seconds)
+    duration = bench.chapters.Chapter.min_time + step
+    return [bench.chapters.Chapter('Chapter ' + str(i+1), bench.chapters.Chapter.min_time + i*step,
+                                   duration) for i in range(count)]
+
+
+@benchmark('commands._write_args_from_dict x264 defaults')
+def setup_write_args():
+    args = example_x264_defaults.make_avs4x26x_defaults()
+    return lambda: bench.commands._write_args_from_dict(io.StringIO(), args)
+
+
+@benchmark('commands.write_x264_command x1000')
+def setup_write_x264():
+    args = example_x264_defaults.make_avs4x26x_defaults()
+
+    def run():
+        file = io.StringIO()
+        for i in range(1000):
+            bench.commands.write_x264_command(file, 'x264.exe', 'episode' + str(i) + '.avs',
+                                              'episode' + str(i) + '.264', args)
+    return run
+
+
+@benchmark('profiles.Profile.write_x264_command x1000')
+def setup_profile_write_x264():
+    profile = example_x264_defaults.make_avs4x26x_profile()
+
+    def run():
+        file = io.StringIO()
+        for i in range(1000):
+            profile.write_x264_command(file, 'x264.exe', 'episode' + str(i) + '.avs',
+                                       'episode' + str(i) + '.264')
+    return run
+
+
+@benchmark('profiles.Profile.write_x264_command override x1000')
+def setup_profile_write_x264_override():
+    profile = example_x264_defaults.make_avs4x26x_profile()
+
+    def run():
+        file = io.StringIO()
+        for i in range(1000):
+            profile.write_x264_command(file, 'x264.exe', 'episode' + str(i) + '.avs',
+                                       'episode' + str(i) + '.264', {'seek': str(i)})
+    return run
+
+
+@benchmark('chapters.split_chapters 10000 chapters')
+def setup_split_chapters():
+    chapters = make_chapters(10000)
+    return lambda: bench.chapters.split_chapters(chapters, 12)
+
+
+@benchmark('chapters.remove_chapters_shorter_than 10000 chapters')
+def setup_remove_chapters():
+    chapters = make_chapters(10000)
+    return lambda: bench.chapters.remove_chapters_shorter_than(list(chapters), 600)
+
+
+@benchmark('chapters.ChapterTable.split 10000 chapters')
+def setup_table_split():
+    table = bench.chapters.ChapterTable.from_chapters(make_chapters(10000))
+    return lambda: table.split(12)
+
+
+@benchmark('chapters.ChapterTable.start_frames 10000 chapters')
+def setup_table_frames():
+    table = bench.chapters.ChapterTable.from_chapters(make_chapters(10000))
+    return lambda: table.start_frames('23.976')
+
+
+@benchmark('disc.BlurayTitleInfo 5000 chapters')
+def setup_title_info():
+    bd = bench.fake_bluread.FakeBluray(num_chapters=5000, chapter_ms=10000, num_clips=20)
+    return lambda: bench.disc.BlurayTitleInfo('fake', 0, bd=bd)
+
+
+@benchmark('disc.DiscTitle.chapter_table 5000 chapters')
+def setup_disc_chapter_table():
+    bd = bench.fake_bluread.FakeBluray(num_chapters=5000, chapter_ms=10000)
+    return lambda: bench.disc.DiscTitle(bd, 0).chapter_table
+
+
+@benchmark('disc.DiscTitle.playlist 800 titles')
+def setup_disc_playlists():
+    bd = bench.fake_bluread.FakeBluray(num_titles=800)
+    return lambda: [bench.disc.DiscTitle(bd, i).playlist for i in range(800)]
+
+
+def measure(run, repeat, number):
+    """Best seconds per call over repeat runs of number calls, and the peak bytes and net blocks
+    allocated by a single call"""
+    seconds = min(timeit.repeat(run, repeat=repeat, number=number)) / number
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return {'seconds': seconds, 'peak_bytes': peak, 'blocks': blocks}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-k', dest='filter', default='',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5, help='timing runs per benchmark')
+    parser.add_argument('--number', type=int, default=10, help='calls per timing run')
+    parser.add_argument('--save', metavar='FILE', help='save the results as JSON')
+    parser.add_argument('--compare', metavar='FILE', help='compare against saved results')
+    args = parser.parse_args(argv)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+
+    results = {}
+    print('{0:<56} {1:>12} {2:>10} {3:>9} {4:>9}'.format('benchmark', 'time', 'peak KiB',
+                                                          'blocks', 'change'))
+    for name, setup in benchmarks:
+        if args.filter not in name:
+            continue
+        run = setup()
+        result = results[name] = measure(run, args.repeat, args.number)
+        change = ''
+        if name in baseline:
+            change = '{0:+.1%}'.format(result['seconds'] / baseline[name]['seconds'] - 1)
+        print('{0:<56} {1:>10.1f}us {2:>10.1f} {3:>9d} {4:>9}'.format(
+            name, result['seconds'] * 1e6, result['peak_bytes'] / 1024, result['blocks'], change))
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,3 +1,6 @@
+from bench.profiles import Profile
+
+
 def make_x264_defaults():
 
     return {
@@ -30,3 +33,15 @@ def make_avs4x26x_defaults():
     defaults['x26x-binary'] = '"Programs\\x264.exe"'
     defaults['input-depth'] = '16'
     return defaults
+
+
+def make_x264_profile():
+
+    return Profile('x264', make_x264_defaults(), program='x264')
+
+
+def make_avs4x26x_profile():
+
+    # This needs to be wrapped in parentheses because it is a generic argument
+    return make_x264_profile().extend('avs4x26x', {'x26x-binary': '"Programs\\x264.exe"',
+                                                   'input-depth': '16'}, program='avs4x26x')
@@ -15,8 +15,44 @@
 
 import unittest
 import io
+import math
+import mmap
+import os
+import socket
+import struct
+import subprocess
 import copy
+import json
+import sys
+import tempfile
+import threading
+import time
+import types
+from datetime import timedelta
+from unittest import mock
+from fractions import Fraction
+import bench.audio
+import bench.buildfiles
+import bench.cache
+import bench.chapters
 import bench.commands
+import bench.cores
+import bench.crf
+import bench.disc
+import bench.fake_bluread
+import bench.farm
+import bench.h264
+import bench.jobs
+import bench.m2ts
+import bench.manifest
+import bench.metrics
+import bench.mpls
+import bench.profiles
+import bench.progress
+import bench.scenes
+import bench.segments
+import bench.staging
+import bench.tracing
 import example_x264_defaults
 
 
@@ -361,5 +397,1914 @@ class TestCommands(unittest.TestCase):
         assertStrEqual(self.file.getvalue(), expected)
 
 
+class TestCommandObjects(unittest.TestCase):
+
+    def test_x264_argv(self):
+        command = bench.commands.x264_command(x264_loc, video_input_loc, video_dest_loc,
+                                              {'crf': '16', 'no-fast-pskip': ''})
+        self.assertEqual(command.argv, [x264_loc, '--output', video_dest_loc, '--crf', '16',
+                                        '--no-fast-pskip', video_input_loc])
+
+    def test_bepipe_nero_is_piped(self):
+        command = bench.commands.bePipe_neroAAC_command(bepipe_loc, nero_loc, bescript,
+                                                        audio_dest_loc, {'q': '0.65'})
+        self.assertEqual(command.source.argv, [bepipe_loc, '--script', bescript])
+        self.assertEqual(command.sink.argv, [nero_loc, '-q', '0.65', '-if', '-', '-of',
+                                             audio_dest_loc])
+
+    def test_mkvmerge_argv(self):
+        tracks = bench.commands.MkvTrack(video_dest_loc, {'language': '0:Japanese'}),
+        attachments = bench.commands.MkvAttachment(fontA_loc, fontA_mime_type, fontA_name),
+        command = bench.commands.mkvmerge_command(mkvmerge_loc, mux_output_loc, tracks,
+                                                  attachments, {'title': 'Hooplah'})
+        self.assertEqual(command.argv, [
+            mkvmerge_loc, '--output', mux_output_loc, '--title', 'Hooplah',
+            '--attachment-mime-type', fontA_mime_type, '--attachment-name', fontA_name,
+            '--attach-file', fontA_loc, '--language', '0:Japanese', video_dest_loc])
+
+    def test_batch_writers_match_command_lines(self):
+        # The batch writers don't build commands, so check they write the same lines
+        def expect(header, command):
+            return 'REM ' + header + '\n' + command.line() + '\n\n'
+        args = {'crf': '16', 'no-fast-pskip': '', 'qpfile': bench.commands.Quoted('a b.txt')}
+        tracks = [bench.commands.MkvTrack(video_dest_loc, {'language': '0:Japanese'}),
+                  bench.commands.MkvTrack(audio_dest_loc, append=True)]
+        attachments = [bench.commands.MkvAttachment(fontA_loc, fontA_mime_type, fontA_name,
+                                                    'A font', attach_once=True)]
+        file = io.StringIO()
+        bench.commands.write_x264_command(file, x264_loc, video_input_loc, video_dest_loc, args)
+        self.assertEqual(file.getvalue(), expect('Video ' + video_dest_loc,
+                                                 bench.commands.x264_command(
+                                                     x264_loc, video_input_loc, video_dest_loc,
+                                                     args)))
+        file = io.StringIO()
+        bench.commands.write_bePipe_neroAAC_command(file, bepipe_loc, nero_loc, bescript,
+                                                    audio_dest_loc, {'q': '0.65', 'lc': ''})
+        self.assertEqual(file.getvalue(), expect('Audio ' + audio_dest_loc,
+                                                 bench.commands.bePipe_neroAAC_command(
+                                                     bepipe_loc, nero_loc, bescript,
+                                                     audio_dest_loc, {'q': '0.65', 'lc': ''})))
+        file = io.StringIO()
+        bench.commands.write_mkvmerge_command(file, mkvmerge_loc, mux_output_loc, tracks,
+                                              attachments, {'title': 'Hooplah'})
+        self.assertEqual(file.getvalue(), expect('Mux ' + mux_output_loc,
+                                                 bench.commands.mkvmerge_command(
+                                                     mkvmerge_loc, mux_output_loc, tracks,
+                                                     attachments, {'title': 'Hooplah'})))
+
+    @unittest.skipIf(os.name == 'nt', 'Uses the running python as both ends of the pipe')
+    def test_piped_command_runs_without_shell(self):
+        source = bench.commands.Command([sys.executable, '-c', 'print("x" * 100000)'])
+        sink = bench.commands.Command([sys.executable, '-c',
+                                       'import sys; sys.exit(len(sys.stdin.read()) != 100001)'])
+        self.assertEqual(bench.commands.PipedCommand(source, sink).run(), 0)
+        failing = bench.commands.Command([sys.executable, '-c', 'import sys; sys.exit(3)'])
+        drain = bench.commands.Command([sys.executable, '-c', 'import sys; sys.stdin.read()'])
+        self.assertEqual(bench.commands.PipedCommand(failing, drain).run(), 3)
+
+
+class TestProfiles(unittest.TestCase):
+
+    def test_extends_parent(self):
+        profile = example_x264_defaults.make_avs4x26x_profile()
+        self.assertEqual(dict(profile), example_x264_defaults.make_avs4x26x_defaults())
+        self.assertEqual(profile.parent.name, 'x264')
+        child = profile.extend('fast', {'subme': '7', 'no-fast-pskip': None})
+        self.assertEqual(child['subme'], '7')
+        self.assertNotIn('no-fast-pskip', child)
+        self.assertEqual(profile['subme'], '10')
+        self.assertEqual(child.program, 'avs4x26x')
+
+    def test_unknown_options(self):
+        with self.assertRaises(ValueError):
+            bench.profiles.Profile('bad', {'crf': '16', 'crff': '16'}, program='x264')
+        with self.assertRaises(ValueError):
+            example_x264_defaults.make_x264_profile().extend('bad', {'x26x-binary': 'x264'})
+        bench.profiles.Profile('unchecked', {'crff': '16'})
+
+    def test_commands_match_dicts(self):
+        profile = example_x264_defaults.make_avs4x26x_profile()
+        expected, actual = io.StringIO(), io.StringIO()
+        bench.commands.write_x264_command(expected, x264_loc, video_input_loc, video_dest_loc,
+                                          x264_args)
+        profile.write_x264_command(actual, x264_loc, video_input_loc, video_dest_loc)
+        self.assertEqual(actual.getvalue(), expected.getvalue())
+        self.assertEqual(profile.x264_command(x264_loc, video_input_loc, video_dest_loc).argv,
+                         bench.commands.x264_command(x264_loc, video_input_loc, video_dest_loc,
+                                                     x264_args).argv)
+
+    def test_overrides_follow_profile(self):
+        profile = example_x264_defaults.make_avs4x26x_profile()
+        overrides = {'crf': '18', 'seek': '100', 'no-fast-pskip': None}
+        argv = profile.x264_command(x264_loc, video_input_loc, video_dest_loc, overrides).argv
+        base = dict(x264_args)
+        for key in overrides:
+            base.pop(key, None)
+        self.assertEqual(argv, [x264_loc, '--output', video_dest_loc]
+                         + bench.commands._args_from_dict(base) + ['--crf', '18', '--seek', '100',
+                                                                     video_input_loc])
+        expected, actual = io.StringIO(), io.StringIO()
+        expected.write('REM Video ' + video_dest_loc + '\n'
+                       + bench.commands.Command(argv).line() + '\n\n')
+        profile.write_x264_command(actual, x264_loc, video_input_loc, video_dest_loc, overrides)
+        self.assertEqual(actual.getvalue(), expected.getvalue())
+        with self.assertRaises(ValueError):
+            profile.x264_command(x264_loc, video_input_loc, video_dest_loc, {'crff': '18'})
+        # Rendering the profile once is enough for any number of jobs
+        self.assertEqual(list(profile._rendered), [None])
+
+    def test_jobs_only_render_their_overrides(self):
+        profile = example_x264_defaults.make_avs4x26x_profile()
+        profile.write_x264_command(io.StringIO(), x264_loc, video_input_loc, video_dest_loc)
+        file = io.StringIO()
+        with mock.patch('bench.commands._args_from_dict',
+                        wraps=bench.commands._args_from_dict) as render:
+            for i in range(10):
+                profile.write_x264_command(file, x264_loc, video_input_loc, str(i) + '.264')
+            self.assertEqual(render.call_count, 0)
+            for i in range(10):
+                profile.write_x264_command(file, x264_loc, video_input_loc, str(i) + '.264',
+                                           {'crf': str(i)})
+            # Only the override itself, with the rest of the profile's text cached
+            self.assertEqual(render.call_count, 10)
+            self.assertEqual([call.args[0] for call in render.call_args_list[-2:]],
+                             [{'crf': '8'}, {'crf': '9'}])
+        self.assertEqual(len(profile._trimmed), 1)
+        self.assertEqual(file.getvalue().count('--crf'), 20)
+
+    def test_nero_profile(self):
+        profile = bench.profiles.Profile('nero', {'q': '0.65'}, program='neroAAC')
+        command = bench.commands.bePipe_neroAAC_command(bepipe_loc, nero_loc, bescript,
+                                                        audio_dest_loc, profile)
+        self.assertEqual(command.sink.argv, [nero_loc, '-q', '0.65', '-if', '-', '-of',
+                                             audio_dest_loc])
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.graph = bench.jobs.JobGraph()
+        self.audio = self.graph.add_audio_job(bepipe_loc, nero_loc, bescript, audio_dest_loc)
+        self.video = self.graph.add_video_job(x264_loc, video_input_loc, video_dest_loc)
+        tracks = bench.commands.MkvTrack(video_dest_loc), bench.commands.MkvTrack(audio_dest_loc)
+        self.mux = self.graph.add_mux_job(mkvmerge_loc, mux_output_loc, tracks)
+
+    def test_mux_depends_on_its_tracks(self):
+        self.assertEqual(self.graph.dependencies(self.mux.name),
+                         [self.video.name, self.audio.name])
+        self.assertEqual(self.graph.dependencies(self.video.name), [])
+
+    def test_write_to_matches_serial_commands(self):
+        expected = io.StringIO()
+        bench.commands.write_bePipe_neroAAC_command(
+            expected, bepipe_loc, nero_loc, bescript, audio_dest_loc)
+        bench.commands.write_x264_command(expected, x264_loc, video_input_loc, video_dest_loc)
+        tracks = bench.commands.MkvTrack(video_dest_loc), bench.commands.MkvTrack(audio_dest_loc)
+        bench.commands.write_mkvmerge_command(expected, mkvmerge_loc, mux_output_loc, tracks)
+        file = io.StringIO()
+        self.graph.write_to(file)
+        assertStrEqual(file.getvalue(), expected.getvalue())
+
+    def test_duplicate_output_exception(self):
+        self.assertRaises(ValueError, self.graph.add_video_job, x264_loc, 'other.avs',
+                          video_dest_loc)
+
+    def test_independent_jobs_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+        finished = []
+
+        def runner(job):
+            if job is not self.mux:
+                barrier.wait()
+            finished.append(job.name)
+            return 0
+
+        results = bench.jobs.run_jobs(self.graph, max_workers=2, runner=runner)
+        self.assertEqual(finished[-1], self.mux.name)
+        self.assertTrue(all(r.status == bench.jobs.JobResult.OK for r in results.values()))
+
+    def test_limits_by_kind(self):
+        graph = bench.jobs.JobGraph()
+        for i in range(4):
+            graph.add(bench.jobs.Job('encode ' + str(i), 'x264', kind=bench.jobs.Job.VIDEO))
+        graph.add(bench.jobs.Job('audio', 'neroAAC', kind=bench.jobs.Job.AUDIO))
+        lock = threading.Lock()
+        running = []
+        most_encodes = [0]
+        audio_started = threading.Event()
+
+        def runner(job):
+            with lock:
+                running.append(job)
+                most_encodes[0] = max(most_encodes[0], sum(
+                    1 for other in running if other.kind == bench.jobs.Job.VIDEO))
+            if job.kind == bench.jobs.Job.AUDIO:
+                audio_started.set()
+            else:
+                # The audio job is added last, but doesn't wait behind the encodes
+                audio_started.wait(5)
+            with lock:
+                running.remove(job)
+            return 0
+
+        results = bench.jobs.run_jobs(graph, 3, runner, limits={bench.jobs.Job.VIDEO: 2})
+        self.assertTrue(all(result.succeeded for result in results.values()))
+        self.assertEqual(most_encodes[0], 2)
+        self.assertTrue(audio_started.is_set())
+
+    def test_failed_job_skips_dependents(self):
+        def runner(job):
+            return 1 if job is self.video else 0
+
+        results = bench.jobs.run_jobs(self.graph, max_workers=1, runner=runner)
+        self.assertEqual(results[self.audio.name].status, bench.jobs.JobResult.OK)
+        self.assertEqual(results[self.video.name].returncode, 1)
+        self.assertEqual(results[self.video.name].status, bench.jobs.JobResult.FAILED)
+        self.assertEqual(results[self.mux.name].status, bench.jobs.JobResult.SKIPPED)
+
+    def test_runner_exception_fails_job(self):
+        def runner(job):
+            if job is self.video:
+                raise RuntimeError('runner bug')
+            return 0
+
+        results = bench.jobs.run_jobs(self.graph, max_workers=2, runner=runner)
+        self.assertEqual(results[self.audio.name].status, bench.jobs.JobResult.OK)
+        self.assertEqual(results[self.video.name].status, bench.jobs.JobResult.FAILED)
+        self.assertEqual(results[self.mux.name].status, bench.jobs.JobResult.SKIPPED)
+
+    def test_audio_script_is_input(self):
+        self.assertEqual(self.audio.inputs, ['Documents\\script.avs'])
+        self.assertEqual(bench.commands.script_inputs('Import( ^a.avs^ ) ++ import(^b.avs^)'),
+                         ['a.avs', 'b.avs'])
+        graph = bench.jobs.JobGraph()
+        source = graph.add(bench.jobs.Job('Script', 'make', outputs=['Documents\\script.avs']))
+        audio = graph.add_audio_job(bepipe_loc, nero_loc, bescript, audio_dest_loc)
+        self.assertEqual(graph.dependencies(audio.name), [source.name])
+
+
+class TestAudio(unittest.TestCase):
+
+    def test_one_job_per_track(self):
+        graph = bench.jobs.JobGraph()
+        audio_jobs = bench.audio.add_audio_track_jobs(graph, bepipe_loc, nero_loc,
+                                                      ['track0.avs', 'track1.avs'],
+                                                      'folder\\test.m4a', {'q': '0.65'})
+        self.assertEqual([job.outputs for job in audio_jobs],
+                         [['folder\\test.track01.m4a'], ['folder\\test.track02.m4a']])
+        self.assertEqual(audio_jobs[1].command.source.argv, [bepipe_loc, '--script', 'track1.avs'])
+        self.assertEqual(audio_jobs[0].command.bufsize, bench.audio.PIPE_SIZE)
+        self.assertEqual(graph.dependencies(audio_jobs[1].name), [])
+
+    def test_tracks_encode_concurrently(self):
+        lock = threading.Lock()
+        running = [0, 0]
+        both_started = threading.Barrier(2, timeout=5)
+
+        def runner(job):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            both_started.wait()
+            with lock:
+                running[0] -= 1
+            return 0
+
+        results = bench.audio.encode_audio_tracks(bepipe_loc, nero_loc, ['a', 'b'], 'test.m4a',
+                                                  max_workers=8, runner=runner)
+        self.assertEqual(running[1], 2)
+        self.assertTrue(all(result.succeeded for result in results.values()))
+
+    @unittest.skipUnless(hasattr(getattr(bench.commands, 'fcntl', None), 'F_GETPIPE_SZ'),
+                         'Pipe sizes can only be changed on Linux')
+    def test_pipe_is_grown(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            bench.commands._grow_pipe(write_fd, 256 * 1024)
+            size = bench.commands.fcntl.fcntl(write_fd, bench.commands.fcntl.F_GETPIPE_SZ)
+            self.assertGreaterEqual(size, 256 * 1024)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+
+class TestChapterTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = bench.chapters.ChapterTable(
+            ['A', 'B', 'C', 'D'],
+            [0, 90000 * 60, 90000 * 61, 90000 * 300],
+            [90000 * 60, 90000, 90000 * 239, 90000 * 30])
+
+    def test_parse_frame_rate(self):
+        self.assertEqual(bench.chapters.parse_frame_rate('23.976'), Fraction(24000, 1001))
+        self.assertEqual(bench.chapters.parse_frame_rate('24000/1001'), Fraction(24000, 1001))
+        self.assertEqual(bench.chapters.parse_frame_rate('25'), Fraction(25))
+        self.assertRaises(ValueError, bench.chapters.parse_frame_rate, 'fast')
+
+    def test_ticks_from_timestamp(self):
+        self.assertEqual(bench.chapters.ticks_from_timestamp('01:02:03.500'),
+                         (3723 * 1000 + 500) * 90)
+
+    def test_frames_are_exact_at_ntsc_rates(self):
+        # One hour of 24000/1001 is exactly 86313.686... frames
+        ticks = 90000 * 3600
+        self.assertEqual(bench.chapters.ticks_to_frames(ticks, '23.976'), 86314)
+        self.assertEqual(bench.chapters.ticks_to_frames(1001 * 90000, '23.976'), 24000)
+
+    def test_round_trips_chapters(self):
+        chapters = self.table.to_chapters()
+        self.assertEqual(str(chapters[1]), 'B starts at 00:01:00 and lasts 00:00:01')
+        table = bench.chapters.ChapterTable.from_chapters(chapters)
+        self.assertEqual(table.starts, self.table.starts)
+        self.assertEqual(table.durations, self.table.durations)
+
+    def test_remove_shorter_than(self):
+        self.assertEqual(self.table.remove_shorter_than(30).names, ['A', 'C', 'D'])
+        self.assertEqual(len(self.table), 4)
+
+    def test_split(self):
+        first, second = self.table.split(2)
+        self.assertEqual(list(second.starts), [0, 90000 * 239])
+        self.assertEqual(second.names, ['C', 'D'])
+        self.assertEqual(self.table.starts[2], 90000 * 61)
+
+    def test_rename(self):
+        self.assertEqual(self.table.rename(['x']).names, ['x', 'B', 'C', 'D'])
+        self.assertEqual(self.table.rename(['x', 'y'], True).names, ['x', 'y', 'x', 'y'])
+        self.assertRaises(ValueError, self.table.rename, ['x', 'y', 'z'], True)
+
+    def test_write_qpfile(self):
+        file = io.StringIO()
+        self.table.write_qpfile(file, '23.976')
+        assertStrEqual(file.getvalue(), '0 I\n1439 I\n1463 I\n7193 I\n')
+        expected = io.StringIO()
+        bench.chapters.create_x264_qpfile(self.table.to_chapters(), '23.976', expected)
+        assertStrEqual(expected.getvalue(), file.getvalue())
+
+    def test_write_qpfile_limits_to_segment(self):
+        # x264 looks frames up in the qpfile by input frame number, seek included, so only the
+        # range changes
+        file = io.StringIO()
+        self.table.write_qpfile(file, '23.976', 1439, 5754)
+        assertStrEqual(file.getvalue(), '1439 I\n1463 I\n')
+
+    def test_write_mkv_matches_create_mkv_chapters(self):
+        expected = io.StringIO()
+        bench.chapters.create_mkv_chapters(self.table.to_chapters(), expected)
+        file = io.StringIO()
+        self.table.write_mkv(file)
+        assertStrEqual(file.getvalue(), expected.getvalue())
+
+
+class TestFarm(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.graph = bench.jobs.JobGraph()
+        self.sources = []
+        for name in ('a', 'b'):
+            source = os.path.join(self.temp_dir.name, name + '.txt')
+            with open(source, 'w') as file:
+                file.write(name * 1000)
+            self.sources.append(source)
+            self.graph.add(bench.jobs.Job('Copy ' + name, self.copy_command(
+                source, source + '.out'), inputs=[source], outputs=[source + '.out']))
+        self.mux_loc = os.path.join(self.temp_dir.name, 'mux.txt')
+        self.graph.add(bench.jobs.Job('Mux', self.copy_command(self.sources[0] + '.out',
+                                                               self.mux_loc),
+                                      inputs=[source + '.out' for source in self.sources],
+                                      outputs=[self.mux_loc]))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    @staticmethod
+    def copy_command(source, dest):
+        return bench.commands.Command([sys.executable, '-c',
+                                       'import shutil, sys; shutil.copy(sys.argv[1], sys.argv[2])',
+                                       bench.commands.Quoted(source), bench.commands.Quoted(dest)])
+
+    def start_workers(self, server, count, **kwargs):
+        threads = [threading.Thread(target=bench.farm.run_worker, args=server.address,
+                                    kwargs=dict(kwargs, name='worker' + str(i)))
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_command_round_trip(self):
+        command = bench.commands.bePipe_neroAAC_command(bepipe_loc, nero_loc, bescript,
+                                                        audio_dest_loc)
+        message = bench.farm.command_to_message(command)
+        rebuilt = bench.farm.command_from_message(message, {audio_dest_loc: 'local.m4a'})
+        self.assertEqual(rebuilt.line(), command.line().replace(audio_dest_loc, 'local.m4a'))
+        self.assertEqual(bench.farm.command_from_message(
+            bench.farm.command_to_message('copy a b'), {'b': 'c'}), 'copy a c')
+
+    def test_workers_run_graph(self):
+        with bench.farm.JobServer(self.graph) as server:
+            threads = self.start_workers(server, 2)
+            results = server.wait(30)
+            for thread in threads:
+                thread.join(30)
+        self.assertEqual([result.status for result in results.values()], ['ok'] * 3)
+        self.assertEqual(set(server.workers.values()) - {'worker0', 'worker1'}, set())
+        with open(self.mux_loc) as file:
+            self.assertEqual(file.read(), 'a' * 1000)
+
+    def test_lost_worker_is_retried(self):
+        with bench.farm.JobServer(self.graph) as server:
+            with socket.create_connection(server.address) as sock, sock.makefile('rb') as reader:
+                bench.farm._send_message(sock, {'type': 'request'})
+                first = bench.farm._read_message(reader)['name']
+            threads = self.start_workers(server, 1)
+            results = server.wait(30)
+            for thread in threads:
+                thread.join(30)
+        self.assertTrue(all(result.succeeded for result in results.values()))
+        self.assertEqual(server.attempts[first], 2)
+
+    def test_failure_skips_dependents(self):
+        with bench.farm.JobServer(self.graph, max_attempts=1) as server:
+            threads = self.start_workers(server, 1, runner=lambda job: 0 if 'b' in job.name else 2)
+            results = server.wait(30)
+            for thread in threads:
+                thread.join(30)
+        self.assertEqual([result.status for result in results.values()],
+                         ['failed', 'ok', 'skipped'])
+
+    def test_staged_worker_process(self):
+        stage_dir = os.path.join(self.temp_dir.name, 'stage')
+        os.mkdir(stage_dir)
+        with bench.farm.JobServer(self.graph) as server:
+            worker = subprocess.Popen(
+                [sys.executable, '-m', 'bench.farm', server.address[0], str(server.address[1]),
+                 '--stage-dir', stage_dir, '--slots', '2'],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+            try:
+                results = server.wait(60)
+            finally:
+                self.assertEqual(worker.wait(60), 0)
+        self.assertTrue(all(result.succeeded for result in results.values()))
+        with open(self.sources[1] + '.out') as file:
+            self.assertEqual(file.read(), 'b' * 1000)
+        self.assertEqual(os.listdir(stage_dir), [])
+
+
+class TestCores(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_detect_pairs_hyperthreads(self):
+        # Hyperthreads of a core numbered n and n + 2, as Linux usually does
+        for cpu in os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else range(1):
+            topology_dir = os.path.join(self.temp_dir.name, 'cpu' + str(cpu), 'topology')
+            os.makedirs(topology_dir)
+            for name, value in (('physical_package_id', 0), ('core_id', cpu % 2)):
+                with open(os.path.join(topology_dir, name), 'w') as file:
+                    file.write(str(value) + '\n')
+        topology = bench.cores.CpuTopology.detect(self.temp_dir.name)
+        self.assertLessEqual(len(topology), 2)
+        self.assertEqual(sorted(cpu for core in topology.cores for cpu in core),
+                         sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity')
+                         else [0])
+
+    def test_plan_slots(self):
+        topology = bench.cores.CpuTopology([(i, i + 10) for i in range(10)])
+        slots = bench.cores.plan_slots(topology, 8, 4)
+        self.assertEqual([slot.cpus for slot in slots],
+                         [(0, 10, 1, 11, 2, 12, 3, 13, 4, 14), (5, 15, 6, 16, 7, 17, 8, 18, 9, 19)])
+        self.assertEqual(slots[0].args(), {'threads': '15', 'lookahead-threads': '3'})
+        self.assertEqual(len(bench.cores.plan_slots(topology, 1, 4)[0].cpus), 20)
+        self.assertEqual(len(bench.cores.plan_slots(bench.cores.CpuTopology([(0,)]), 4)), 1)
+
+    def test_with_thread_args(self):
+        command = bench.commands.x264_command(x264_loc, video_input_loc, video_dest_loc,
+                                              {'crf': '16', 'threads': '64'})
+        slot = bench.cores.CpuSlot(range(4))
+        self.assertEqual(bench.cores.with_thread_args(command, slot).argv,
+                         [x264_loc, '--output', video_dest_loc, '--crf', '16', '--threads', '6',
+                          '--lookahead-threads', '1', video_input_loc])
+
+    def test_scheduler_runs_encodes_in_slots(self):
+        # Stand-in for x264 that writes its arguments and CPUs to its output
+        script = os.path.join(self.temp_dir.name, 'encoder.py')
+        with open(script, 'w') as file:
+            file.write('import os, sys\n'
+                       'cpus = sorted(os.sched_getaffinity(0)) '
+                       'if hasattr(os, "sched_getaffinity") else []\n'
+                       'with open(sys.argv[2], "w") as file:\n'
+                       '    file.write(" ".join(sys.argv[3:-1]) + "\\n" + repr(cpus))\n')
+        graph = bench.jobs.JobGraph()
+        outputs = []
+        for i in range(3):
+            output = os.path.join(self.temp_dir.name, str(i) + '.264')
+            outputs.append(output)
+            graph.add(bench.jobs.Job('Video ' + output, bench.commands.Command(
+                [sys.executable, script, '--output', output, 'input.avs']), outputs=[output],
+                kind=bench.jobs.Job.VIDEO))
+        # Named like an encode, but only the kind counts
+        graph.add(bench.jobs.Job('Video notes', bench.commands.Command([sys.executable, '-c', ''])))
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else [0]
+        topology = bench.cores.CpuTopology([(cpu,) for cpu in cpus])
+        scheduler = bench.cores.CoreScheduler(topology, cores_per_encode=1, pin=True)
+        results = scheduler.run(graph)
+        self.assertTrue(all(result.succeeded for result in results.values()))
+        slot_cpus = {repr(list(slot.cpus)) for slot in scheduler.slots}
+        for output in outputs:
+            with open(output) as file:
+                args, used_cpus = file.read().split('\n')
+            self.assertTrue(args.startswith('--threads'))
+            if hasattr(os, 'sched_setaffinity'):
+                self.assertIn(used_cpus, slot_cpus)
+        self.assertFalse(bench.cores.is_video_job(graph['Video notes']))
+
+    def test_queued_encodes_leave_workers_free(self):
+        graph = bench.jobs.JobGraph()
+        for i in range(4):
+            graph.add(bench.jobs.Job('Video ' + str(i), bench.commands.Command(
+                [sys.executable, '-c', 'import time; time.sleep(0.5)', 'input.avs']),
+                kind=bench.jobs.Job.VIDEO))
+        graph.add(bench.jobs.Job('Audio', bench.commands.Command([sys.executable, '-c', '']),
+                                 kind=bench.jobs.Job.AUDIO))
+        finished = {}
+        start = time.monotonic()
+        scheduler = bench.cores.CoreScheduler(bench.cores.CpuTopology([(0,), (1,)]),
+                                              cores_per_encode=1, extra_workers=1)
+        results = scheduler.run(graph, lambda result: finished.setdefault(
+            result.name, time.monotonic() - start), priority=lambda job: 0)
+        self.assertTrue(all(result.succeeded for result in results.values()))
+        # Before, the audio job waited for a worker behind the encodes queued for a slot, and
+        # those encodes counted the wait in their elapsed time
+        self.assertLess(finished['Audio'], 0.45)
+        self.assertLess(max(results['Video ' + str(i)].elapsed for i in range(4)), 0.9)
+
+    @unittest.skipUnless(hasattr(os, 'sched_setaffinity'), 'needs sched_setaffinity')
+    def test_run_pinned_without_taskset(self):
+        cpu = min(os.sched_getaffinity(0))
+        output = os.path.join(self.temp_dir.name, 'cpus')
+        command = bench.commands.Command(
+            [sys.executable, '-c', 'import os, sys, time\n'
+             'time.sleep(0.2)\n'
+             'open(sys.argv[1], "w").write(repr(sorted(os.sched_getaffinity(0))))', output])
+        with mock.patch('shutil.which', return_value=None):
+            self.assertEqual(bench.cores.run_pinned(command, [cpu]), 0)
+        with open(output) as file:
+            self.assertEqual(file.read(), repr([cpu]))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.store = bench.metrics.MetricsStore(':memory:')
+        self.graph = bench.jobs.JobGraph()
+        for name in ('short', 'long', 'unknown'):
+            self.graph.add_video_job(x264_loc, name + '.avs', name + '.264', {'crf': '16'})
+        self.features = {
+            'Video short.264': bench.metrics.JobFeatures('Video', 600, '1080p', '24', 'x264'),
+            'Video long.264': bench.metrics.JobFeatures('Video', 6000, '1080p', '24', 'x264'),
+            'Video unknown.264': bench.metrics.JobFeatures('Video', 60, '480i', '29.97')}
+
+    def tearDown(self):
+        self.store.close()
+
+    def record(self, name, features, elapsed, status=bench.jobs.JobResult.OK):
+        job = bench.jobs.Job(name, 'encode', outputs=[name])
+        self.store.record(job, bench.jobs.JobResult(name, status, 0, elapsed), features)
+
+    def test_predict_scales_by_run_length(self):
+        self.record('a', bench.metrics.JobFeatures('Video', 1000, '1080p', '24', 'x264'), 2000)
+        self.record('b', bench.metrics.JobFeatures('Video', 1000, '1080p', '24', 'x264'), 4000)
+        self.record('c', bench.metrics.JobFeatures('Video', 1000, '1080p', '24', 'fast'), 100)
+        self.record('d', bench.metrics.JobFeatures('Video', 1000, '1080p', '24', 'x264'), 1,
+                    bench.jobs.JobResult.FAILED)
+        self.record('e', bench.metrics.JobFeatures('Mux'), 30)
+        self.assertAlmostEqual(self.store.predict(self.features['Video long.264']), 18000)
+        # Only the kind matches, so every successful video counts
+        self.assertAlmostEqual(self.store.predict(self.features['Video unknown.264']), 120)
+        self.assertEqual(self.store.predict(bench.metrics.JobFeatures('Mux')), 30)
+        self.assertIsNone(self.store.predict(bench.metrics.JobFeatures('Audio')))
+
+    def test_recorder_stores_results(self):
+        results = bench.jobs.run_jobs(self.graph, runner=lambda job: 0,
+                                      on_result=self.store.recorder(self.graph, self.features))
+        self.assertTrue(all(result.succeeded for result in results.values()))
+        rows = self.store._db.execute('SELECT name, frames, argv FROM jobs ORDER BY id').fetchall()
+        self.assertEqual(len(rows), 3)
+        self.assertIn(('Video short.264', 14400), [row[:2] for row in rows])
+        self.assertIn('--crf', rows[0][2])
+
+    def test_longest_job_starts_first(self):
+        self.record('a', bench.metrics.JobFeatures('Video', 1000, '1080p', '24', 'x264'), 2000)
+        started = []
+        priority = self.store.priorities(self.graph, self.features)
+
+        def runner(job):
+            started.append(job.name)
+            return 0
+
+        bench.jobs.run_jobs(self.graph, 1, runner, priority=priority)
+        self.assertEqual(started, ['Video long.264', 'Video short.264', 'Video unknown.264'])
+        mux = self.graph.add_mux_job(mkvmerge_loc, 'short.mkv',
+                                     [bench.commands.MkvTrack('short.264')])
+        self.store.record(mux, bench.jobs.JobResult(mux.name, 'ok', 0, 50000))
+        priority = self.store.priorities(self.graph, self.features)
+        self.assertGreater(priority(self.graph['Video short.264']),
+                           priority(self.graph['Video long.264']))
+
+
+class TestTracing(unittest.TestCase):
+
+    def tearDown(self):
+        bench.tracing.stop_tracing()
+
+    def test_disabled_records_nothing(self):
+        self.assertFalse(bench.tracing.is_tracing())
+        self.assertIs(bench.tracing.span('a'), bench.tracing.span('b'))
+        bench.tracing.count('a')
+        self.assertIsNone(bench.tracing.stop_tracing())
+
+    def test_trace_of_batch(self):
+        tracer = bench.tracing.start_tracing()
+        table = bench.chapters.ChapterTable.from_chapters(make_chapters(60, 60))
+        table.write_qpfile(io.StringIO(), '24')
+        graph = bench.jobs.JobGraph()
+        graph.add_video_job(x264_loc, video_input_loc, video_dest_loc)
+        graph.add_mux_job(mkvmerge_loc, mux_output_loc, [bench.commands.MkvTrack(video_dest_loc)])
+        bench.jobs.run_jobs(graph, runner=lambda job: 1)
+        self.assertIs(bench.tracing.stop_tracing(), tracer)
+
+        self.assertEqual(tracer.counters, {'jobs.failed': 1, 'jobs.skipped': 1})
+        names = [row[0] for row in tracer.summary()]
+        for name in ('chapters.ChapterTable.from_chapters', 'chapters.ChapterTable.write_qpfile',
+                     'chapters.ChapterTable.start_frames', 'commands.x264_command', 'jobs.run'):
+            self.assertIn(name, names)
+        file = io.StringIO()
+        tracer.write_chrome_trace(file)
+        events = json.loads(file.getvalue())['traceEvents']
+        run = [event for event in events if event['name'] == 'jobs.run'][0]
+        self.assertEqual((run['ph'], run['cat'], run['args']),
+                         ('X', 'jobs', {'job': 'Video ' + video_dest_loc}))
+        summary = io.StringIO()
+        tracer.write_summary(summary)
+        self.assertIn('jobs.skipped', summary.getvalue())
+
+
+class TestBuildFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.dir = self.temp_dir.name
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_graph(self):
+        # Two independent 'encodes' with awkward names and a 'mux' joining them
+        source = os.path.join(self.dir, 'in put.txt')
+        with open(source, 'w') as file:
+            file.write('x')
+        first = os.path.join(self.dir, "it's $1.txt")
+        second = os.path.join(self.dir, 'b:c.txt')
+        muxed = os.path.join(self.dir, 'out.txt')
+        copy_code = 'import sys; open(sys.argv[2], "w").write(open(sys.argv[1]).read() * 2)'
+        join_code = ('import sys; open(sys.argv[3], "w").write(open(sys.argv[1]).read()'
+                     ' + open(sys.argv[2]).read())')
+        graph = bench.jobs.JobGraph()
+        for name, output in (('Video a', first), ('Audio b', second)):
+            graph.add(bench.jobs.Job(name, bench.commands.Command(
+                [sys.executable, '-c', copy_code, source, output]), [source], [output]))
+        graph.add(bench.jobs.Job('Mux out', bench.commands.Command(
+            [sys.executable, '-c', join_code, first, second, muxed]), [first, second], [muxed]))
+        return graph, muxed
+
+    def test_posix_line(self):
+        command = bench.commands.Command(['x264', bench.commands.Quoted("a b'c"), '$HOME'])
+        self.assertEqual(command.posix_line(), "x264 'a b'\"'\"'c' '$HOME'")
+        piped = bench.commands.PipedCommand(bench.commands.Command(['a', 'b c']),
+                                            bench.commands.Command(['d']))
+        self.assertEqual(piped.posix_line(), "a 'b c' | d")
+
+    def test_shell_script(self):
+        graph, muxed = self.make_graph()
+        script = os.path.join(self.dir, 'run.sh')
+        with open(script, 'w') as file:
+            bench.buildfiles.write_shell_script(graph, file)
+        subprocess.run(['sh', script], check=True)
+        with open(muxed) as file:
+            self.assertEqual(file.read(), 'xxxx')
+
+    def test_ninja(self):
+        graph, muxed = self.make_graph()
+        file = io.StringIO()
+        bench.buildfiles.write_ninja(graph, file)
+        text = file.getvalue()
+        self.assertTrue(text.startswith('rule run\n  command = $cmd\n'))
+        first = os.path.join(self.dir, "it's $$1.txt").replace(' ', '$ ')
+        second = os.path.join(self.dir, 'b$:c.txt')
+        self.assertIn('build ' + muxed + ': run ' + first + ' ' + second + '\n', text)
+        self.assertIn("'\"'\"'s $$1.txt'", text)
+        self.assertIn('  desc = Mux out\n', text)
+
+    def test_makefile(self):
+        graph, muxed = self.make_graph()
+        makefile = os.path.join(self.dir, 'Makefile')
+        with open(makefile, 'w') as file:
+            bench.buildfiles.write_makefile(graph, file)
+        with open(makefile) as file:
+            text = file.read()
+        self.assertIn('.DELETE_ON_ERROR:\n', text)
+        self.assertIn(muxed + ': ' + os.path.join(self.dir, "it's $$1.txt").replace(' ', '\\ ')
+                      + ' ' + os.path.join(self.dir, 'b\\:c.txt') + '\n\t', text)
+        try:
+            subprocess.run(['make', '-s', '-j', '2', '-f', makefile], check=True)
+        except FileNotFoundError:
+            self.skipTest('make is not installed')
+        with open(muxed) as file:
+            self.assertEqual(file.read(), 'xxxx')
+        self.assertEqual(subprocess.run(['make', '-q', '-f', makefile]).returncode, 0)
+        # An output older than its inputs is out of date again
+        os.utime(muxed, (0, 0))
+        self.assertNotEqual(subprocess.run(['make', '-q', '-f', makefile]).returncode, 0)
+
+    def test_needs_outputs(self):
+        graph = bench.jobs.JobGraph()
+        graph.add(bench.jobs.Job('Audio a', bench.commands.Command(['a'])))
+        with self.assertRaises(ValueError):
+            bench.buildfiles.write_ninja(graph, io.StringIO())
+        with self.assertRaises(ValueError):
+            bench.buildfiles.write_makefile(graph, io.StringIO())
+
+
+class TestStaging(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.src_dir = os.path.join(self.temp_dir.name, 'BD', 'BDMV', 'STREAM')
+        self.scratch_dir = os.path.join(self.temp_dir.name, 'scratch')
+        os.makedirs(self.src_dir)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def make_clip(self, name, size):
+        path = os.path.join(self.src_dir, name)
+        with open(path, 'wb') as file:
+            file.write(bytes(range(256)) * (size // 256) + bytes(size % 256))
+        return path
+
+    def test_copy_file(self):
+        src = self.make_clip('00001.m2ts', 100000)
+        dest = os.path.join(self.temp_dir.name, 'copy.m2ts')
+        self.assertEqual(bench.staging.copy_file(src, dest, block_size=4096), 100000)
+        with open(src, 'rb') as a, open(dest, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+        for method in bench.staging._copy_methods:
+            with open(src, 'rb') as a, open(dest, 'r+b') as b:
+                self.assertEqual(method(a.fileno(), b.fileno(), 4096, 10), 10)
+
+    def test_copy_file_stop(self):
+        src = self.make_clip('00001.m2ts', 100000)
+        dest = os.path.join(self.temp_dir.name, 'copy.m2ts')
+        checks = []
+
+        def stop():
+            checks.append(None)
+            return len(checks) > 3
+        with self.assertRaises(InterruptedError):
+            bench.staging.copy_file(src, dest, block_size=4096, stop=stop)
+        self.assertEqual(len(checks), 4)
+        self.assertEqual(os.path.getsize(dest), 3 * 4096)
+
+    def test_close_stops_copies(self):
+        clip = self.make_clip('00001.m2ts', 100000)
+        started = threading.Event()
+        copy_method = bench.staging._copy_methods[0]
+
+        def slow_copy(*args):
+            started.set()
+            time.sleep(0.01)
+            return copy_method(*args)
+        stager = bench.staging.ClipStager(self.scratch_dir, 100000, block_size=100)
+        with mock.patch('bench.staging._copy_methods', [slow_copy]):
+            stager.prefetch([clip])
+            self.assertTrue(started.wait(5))
+            start = time.monotonic()
+            stager.close()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+    def test_clip_locs(self):
+        title = bench.disc.BlurayTitleInfo.__new__(bench.disc.BlurayTitleInfo)
+        title.clip_files = ['00001.m2ts', '00002.m2ts']
+        self.assertEqual(bench.staging.clip_locs('BD', title),
+                         [os.path.join('BD', 'BDMV', 'STREAM', '00001.m2ts'),
+                          os.path.join('BD', 'BDMV', 'STREAM', '00002.m2ts')])
+
+    def test_budget_and_eviction(self):
+        clips = [self.make_clip('0000{0}.m2ts'.format(i), 1000) for i in range(4)]
+        with bench.staging.ClipStager(self.scratch_dir, 2500) as stager:
+            self.assertNotEqual(stager.local_loc(clips[0]),
+                                stager.local_loc(os.path.join(self.temp_dir.name, '00000.m2ts')))
+            stager.prefetch(clips)
+            first = stager.acquire(clips[0])
+            second = stager.acquire(clips[1])
+            with open(first, 'rb') as a, open(clips[0], 'rb') as b:
+                self.assertEqual(a.read(), b.read())
+            # The third clip would go over the budget until one is released
+            stager.release(clips[1])
+            stager.release(clips[0])
+            with stager.staged(clips[2:]) as local_locs:
+                self.assertTrue(all(os.path.isfile(loc) for loc in local_locs))
+                self.assertLessEqual(stager.used, 2500)
+                # The least recently used clip went first
+                self.assertFalse(os.path.exists(second))
+                self.assertFalse(os.path.exists(first))
+            # Acquiring an evicted clip copies it again
+            self.assertTrue(os.path.isfile(stager.acquire(clips[0])))
+            stager.release(clips[0])
+        self.assertEqual(os.listdir(self.scratch_dir), [])
+
+    def test_acquire_out_of_order(self):
+        clips = [self.make_clip('0000{0}.m2ts'.format(i), 100) for i in range(4)]
+        with bench.staging.ClipStager(self.scratch_dir, 200) as stager:
+            stager.prefetch(clips)
+            # The budget fills with the first two, which nothing has acquired
+            for clip in clips[:2]:
+                while not os.path.isfile(stager.local_loc(clip)):
+                    time.sleep(0.01)
+            acquired = []
+            thread = threading.Thread(target=lambda: acquired.append(stager.acquire(clips[3])),
+                                      daemon=True)
+            thread.start()
+            thread.join(10)
+            self.assertEqual(acquired, [stager.local_loc(clips[3])])
+            # The most recently queued clip made room, and is copied again later
+            self.assertTrue(os.path.isfile(stager.local_loc(clips[0])))
+            self.assertFalse(os.path.exists(stager.local_loc(clips[1])))
+            stager.release(clips[3])
+            for clip in clips[:3]:
+                self.assertTrue(os.path.isfile(stager.acquire(clip)))
+                stager.release(clip)
+            self.assertLessEqual(stager.used, 200)
+
+    def test_copy_failure(self):
+        clip = self.make_clip('00001.m2ts', 100)
+        with bench.staging.ClipStager(self.scratch_dir, 1000) as stager, \
+                mock.patch('bench.staging.copy_file', side_effect=RuntimeError('bad copy')):
+            with self.assertRaisesRegex(RuntimeError, 'bad copy'):
+                stager.acquire(clip)
+            self.assertEqual(stager.used, 0)
+
+    def test_errors(self):
+        big = self.make_clip('00001.m2ts', 5000)
+        with bench.staging.ClipStager(self.scratch_dir, 1000) as stager:
+            with self.assertRaises(ValueError):
+                stager.prefetch([big])
+            with self.assertRaises(OSError):
+                stager.acquire(os.path.join(self.src_dir, 'missing.m2ts'))
+        with self.assertRaises(ValueError):
+            bench.staging.ClipStager(self.scratch_dir, 0)
+
+    def test_runner(self):
+        clips = [self.make_clip('0000{0}.m2ts'.format(i), 1000) for i in range(3)]
+        graph = bench.jobs.JobGraph()
+        seen = {}
+        with bench.staging.ClipStager(self.scratch_dir, 2000, max_workers=2) as stager:
+            def runner(job):
+                seen[job.name] = all(os.path.isfile(stager.local_loc(clip))
+                                     for clip in job_clips[job.name])
+                return 0
+            job_clips = {}
+            for i, clip in enumerate(clips):
+                name = 'Video ' + str(i)
+                graph.add(bench.jobs.Job(name, 'encode', outputs=[name]))
+                job_clips[name] = [clip]
+            stager.prefetch(clips)
+            results = bench.jobs.run_jobs(graph, 2, stager.runner(job_clips, runner))
+        self.assertTrue(all(result.succeeded for result in results.values()))
+        self.assertEqual(seen, {name: True for name in job_clips})
+
+
+def make_h264(num_frames, gop=4, slices=2):
+    """Raw H.264 made of just the NAL headers and first slice header bytes that frame counting
+    looks at"""
+    data = b'\x00\x00\x00\x01\x67\x64\x00\x28' + b'\x00\x00\x00\x01\x68\xeb\xe3'
+    data += b'\x00\x00\x01\x06\x05\x10' + b'x264 options'
+    for frame in range(num_frames):
+        header = b'\x65' if frame % gop == 0 else b'\x41'
+        data += b'\x00\x00\x00\x01' + header + b'\x88\x84\x00\x03' + b'\xff' * 50
+        for _ in range(slices - 1):
+            # first_mb_in_slice isn't 0, so the slice continues the frame
+            data += b'\x00\x00\x01' + header + b'\x02\x40' + b'\x9a' * 20
+    return data
+
+
+class TestH264(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.stream_loc = os.path.join(self.temp_dir.name, 'video.264')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_stream(self, data):
+        with open(self.stream_loc, 'wb') as file:
+            file.write(data)
+
+    def test_count_frames(self):
+        self.assertEqual(bench.h264.count_frames(make_h264(10)), (10, 3))
+        self.assertEqual(bench.h264.count_frames(make_h264(5, gop=1, slices=4)), (5, 5))
+        self.assertEqual(bench.h264.count_frames(b''), (0, 0))
+
+    def test_expected_frames(self):
+        run_length = bench.chapters.Chapter.min_time + timedelta(seconds=10, milliseconds=10)
+        self.assertEqual(bench.h264.expected_frames(run_length, '23.976'), 240)
+        self.assertEqual(bench.h264.expected_frames(timedelta(seconds=2), '25'), 50)
+        self.assertEqual(bench.h264.expected_frames(2.0, Fraction(60000, 1001)), 120)
+
+    def test_verify_stream(self):
+        data = make_h264(240)
+        self.write_stream(data)
+        check = bench.h264.verify_stream(self.stream_loc, 241)
+        self.assertTrue(check.ok)
+        self.assertEqual((check.frames, check.idr_frames, check.size), (240, 60, len(data)))
+        self.assertIn('ok', str(check))
+
+        # Truncated part way through the encode
+        self.write_stream(data[:len(data) // 2])
+        check = bench.h264.verify_stream(self.stream_loc, 240)
+        self.assertFalse(check.ok)
+        self.assertIn('120 frames of 240 expected INCOMPLETE', str(check))
+
+        self.write_stream(b'')
+        self.assertFalse(bench.h264.verify_stream(self.stream_loc).ok)
+        with self.assertRaises(OSError):
+            bench.h264.verify_stream(os.path.join(self.temp_dir.name, 'missing.264'))
+
+    def test_verify_title_stream(self):
+        title = bench.disc.BlurayTitleInfo.__new__(bench.disc.BlurayTitleInfo)
+        title.run_length = bench.chapters.Chapter.min_time + timedelta(seconds=4)
+        title.frame_rate = '25'
+        self.write_stream(make_h264(100))
+        self.assertTrue(bench.h264.verify_title_stream(self.stream_loc, title).ok)
+        self.write_stream(make_h264(90))
+        self.assertFalse(bench.h264.verify_title_stream(self.stream_loc, title).ok)
+
+
+class TestManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.input_loc = self.path('script.avs')
+        with open(self.input_loc, 'w') as file:
+            file.write('version 1')
+        self.manifest = bench.manifest.Manifest(self.path('manifest.json'))
+        self.ran = []
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.temp_dir.name, name)
+
+    def make_graph(self, global_args=None):
+        graph = bench.jobs.JobGraph()
+        graph.add_audio_job(bepipe_loc, nero_loc, bescript, self.path('test.m4a'))
+        graph.add_video_job(x264_loc, self.input_loc, self.path('test.264'))
+        tracks = (bench.commands.MkvTrack(self.path('test.264')),
+                  bench.commands.MkvTrack(self.path('test.m4a')))
+        graph.add_mux_job(mkvmerge_loc, self.path('test.mkv'), tracks, global_args=global_args)
+        return graph
+
+    def runner(self, job):
+        self.ran.append(job.name.split()[0])
+        for output in job.outputs:
+            with open(output, 'w') as file:
+                file.write(str(len(self.ran)))
+        return 0
+
+    def run_graph(self, graph):
+        self.ran = []
+        results = bench.jobs.run_jobs(graph, 1, self.runner, manifest=self.manifest)
+        self.assertTrue(all(result.succeeded for result in results.values()))
+        return sorted(self.ran)
+
+    def test_unchanged_jobs_are_skipped(self):
+        self.assertEqual(self.run_graph(self.make_graph()), ['Audio', 'Mux', 'Video'])
+        self.assertEqual(self.run_graph(self.make_graph()), [])
+        reloaded = bench.manifest.Manifest(self.path('manifest.json'))
+        job = self.make_graph()['Mux ' + self.path('test.mkv')]
+        self.assertTrue(reloaded.is_up_to_date(job, reloaded.fingerprint(job)))
+
+    def test_changed_args_rerun_only_that_job(self):
+        self.run_graph(self.make_graph())
+        self.assertEqual(self.run_graph(self.make_graph({'title': 'Hooplah'})), ['Mux'])
+
+    def test_changed_input_reruns_downstream(self):
+        self.run_graph(self.make_graph())
+        with open(self.input_loc, 'w') as file:
+            file.write('version 2 is longer')
+        self.assertEqual(self.run_graph(self.make_graph()), ['Mux', 'Video'])
+
+    def test_deleted_output_reruns(self):
+        self.run_graph(self.make_graph())
+        os.remove(self.path('test.m4a'))
+        self.assertEqual(self.run_graph(self.make_graph()), ['Audio', 'Mux'])
+
+    def test_corrupt_manifest_reruns_everything(self):
+        self.run_graph(self.make_graph())
+        for contents in ('{"Audio', '[]'):
+            with open(self.path('manifest.json'), 'w') as file:
+                file.write(contents)
+            self.manifest = bench.manifest.Manifest(self.path('manifest.json'))
+            self.assertEqual(self.run_graph(self.make_graph()), ['Audio', 'Mux', 'Video'])
+            self.assertEqual(self.run_graph(self.make_graph()), [])
+
+    def test_changed_audio_script_reruns_audio(self):
+        graph = bench.jobs.JobGraph()
+        graph.add_audio_job(bepipe_loc, nero_loc, 'import(^' + self.input_loc + '^)',
+                            self.path('test.m4a'))
+        self.run_graph(graph)
+        with open(self.input_loc, 'w') as file:
+            file.write('version 2 is longer')
+        self.assertEqual(self.run_graph(graph), ['Audio'])
+
+    def test_sampled_hash_ignores_mtime(self):
+        before = bench.manifest.file_identity(self.input_loc, True)
+        os.utime(self.input_loc, ns=(0, 0))
+        self.assertEqual(bench.manifest.file_identity(self.input_loc, True), before)
+        self.assertEqual(bench.manifest.file_identity(self.path('none'), True), 'missing')
+
+
+class TestProgress(unittest.TestCase):
+
+    def test_parse_with_total(self):
+        progress = bench.progress.parse_x264_progress(
+            '[45.2%] 1234/2730 frames, 23.45 fps, 5012.34 kb/s, 12.30 MB, eta 0:01:02, '
+            'est.size 27.20 MB', 'job', 1.5)
+        self.assertEqual((progress.frames, progress.total_frames, progress.fps, progress.kbps,
+                          progress.eta, progress.done, progress.job, progress.elapsed),
+                         (1234, 2730, 23.45, 5012.34, 62, False, 'job', 1.5))
+
+    def test_parse_without_total(self):
+        progress = bench.progress.parse_x264_progress('1234 frames: 23.45 fps, 5012.34 kb/s')
+        self.assertEqual((progress.frames, progress.total_frames, progress.eta), (1234, None, None))
+
+    def test_parse_final(self):
+        progress = bench.progress.parse_x264_progress(
+            'encoded 2730 frames, 23.45 fps, 5012.34 kb/s')
+        self.assertTrue(progress.done)
+        self.assertIsNone(bench.progress.parse_x264_progress('x264 [info]: profile High 10'))
+
+    def test_iter_lines_splits_carriage_returns(self):
+        stream = io.BytesIO(b'a\rb\r\nc\nd')
+        self.assertEqual(list(bench.progress.iter_lines(stream, 2)), ['a', 'b', 'c', 'd'])
+
+    def test_sinks(self):
+        progress = bench.progress.parse_x264_progress('10 frames: 1.00 fps, 2.00 kb/s', 'job')
+        jsonl = io.StringIO()
+        bench.progress.JsonlSink(jsonl)(progress)
+        self.assertIn('"frames": 10', jsonl.getvalue())
+        table = io.StringIO(newline='')
+        sink = bench.progress.CsvSink(table)
+        sink(progress)
+        sink(progress)
+        lines = table.getvalue().splitlines()
+        self.assertEqual(lines[0], 'job,frames,total_frames,fps,kbps,elapsed,eta,done')
+        self.assertEqual(len(lines), 3)
+
+    @unittest.skipIf(os.name == 'nt', 'Runs the current python as a fake x264')
+    def test_run_with_progress(self):
+        script = ('import sys\n'
+                  'sys.stderr.write("x264 [info]: hello\\n")\n'
+                  'sys.stderr.write("1 frames: 1.00 fps, 2.00 kb/s\\r")\n'
+                  'sys.stderr.write("2 frames: 2.00 fps, 3.00 kb/s\\r")\n'
+                  'sys.stderr.write("encoded 2 frames, 2.00 fps, 3.00 kb/s\\n")\n')
+        command = bench.commands.Command([sys.executable, '-c', script])
+        reports = []
+        passthrough = io.StringIO()
+        returncode = bench.progress.run_with_progress(command, [reports.append], 'job',
+                                                      passthrough)
+        self.assertEqual(returncode, 0)
+        self.assertEqual([progress.frames for progress in reports], [1, 2, 2])
+        self.assertTrue(reports[-1].done)
+        self.assertEqual(passthrough.getvalue(), 'x264 [info]: hello\n')
+
+    @unittest.skipIf(os.name == 'nt', 'Runs the current python as a fake x264')
+    def test_failed_callback_kills_process(self):
+        script = ('import sys, time\n'
+                  'sys.stderr.write("1 frames: 1.00 fps, 2.00 kb/s\\n")\n'
+                  'sys.stderr.flush()\n'
+                  'time.sleep(60)\n')
+        command = bench.commands.Command([sys.executable, '-c', script])
+        processes = []
+        popen = command.popen
+
+        def record_popen(**kwargs):
+            processes.append(popen(**kwargs))
+            return processes[-1]
+
+        def callback(progress):
+            raise RuntimeError('sink failed')
+
+        command.popen = record_popen
+        with self.assertRaises(RuntimeError):
+            bench.progress.run_with_progress(command, [callback], 'job', io.StringIO())
+        self.assertIsNotNone(processes[0].returncode)
+
+    @unittest.skipIf(os.name == 'nt', 'Runs the current python as a fake x264')
+    def test_progress_runner_only_watches_x264(self):
+        script = 'import sys\nsys.stderr.write("encoded 2 frames, 2.00 fps, 3.00 kb/s\\n")\n'
+        command = bench.commands.Command([sys.executable, '-c', script])
+        reports = []
+        runner = bench.progress.make_progress_runner([reports.append], io.StringIO())
+        self.assertEqual(runner(bench.jobs.Job('Mux a', command, kind=bench.jobs.Job.MUX)), 0)
+        self.assertEqual(reports, [])
+        self.assertEqual(runner(bench.jobs.Job('Video a', command, kind=bench.jobs.Job.VIDEO)),
+                         0)
+        self.assertEqual([progress.job for progress in reports], ['Video a'])
+
+
+class TestSegments(unittest.TestCase):
+
+    def setUp(self):
+        # Six chapters of ten minutes each at 24000/1001
+        minutes = 90000 * 60
+        self.table = bench.chapters.ChapterTable(
+            ['Chapter ' + str(i) for i in range(6)],
+            [i * 10 * minutes for i in range(6)],
+            [10 * minutes] * 6)
+
+    def test_plan_cuts_at_chapters(self):
+        segments = bench.segments.plan_segments(self.table, '23.976', 3)
+        self.assertEqual(segments, [bench.segments.Segment(0, 28771),
+                                    bench.segments.Segment(28771, 28771),
+                                    bench.segments.Segment(57542, 28772)])
+
+    def test_plan_with_too_few_chapters(self):
+        segments = bench.segments.plan_segments(self.table, '23.976', 10)
+        self.assertEqual(len(segments), 6)
+        self.assertEqual(sum(segment.num_frames for segment in segments), 86314)
+
+    def test_segment_jobs_and_append(self):
+        graph = bench.jobs.JobGraph()
+        segments = bench.segments.plan_segments(self.table, '23.976', 2)
+        mux = bench.segments.add_segmented_video_jobs(
+            graph, x264_loc, mkvmerge_loc, video_input_loc, test_loc + '.mkv', segments,
+            {'crf': '16'})
+        file = io.StringIO()
+        graph.write_to(file)
+        assertStrEqual(file.getvalue(), (
+            'REM Video folder\\test.part01.264\n'
+            '"Programs\\x264.exe" --output "folder\\test.part01.264" --crf 16 --frames 43157 '
+            '"Documents\\script.avs"\n\n'
+            'REM Video folder\\test.part02.264\n'
+            '"Programs\\x264.exe" --output "folder\\test.part02.264" --crf 16 --frames 43157 '
+            '--seek 43157 "Documents\\script.avs"\n\n'
+            'REM Mux folder\\test.mkv\n'
+            '"Programs\\mkvmerge.exe" --output "folder\\test.mkv" "folder\\test.part01.264" + '
+            '"folder\\test.part02.264"\n\n'))
+        self.assertEqual(len(graph.dependencies(mux.name)), 2)
+
+    def test_segment_qpfiles(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dest_loc = os.path.join(temp_dir, 'test.mkv')
+            graph = bench.jobs.JobGraph()
+            segments = bench.segments.plan_segments(self.table, '23.976', 2)
+            bench.segments.add_segmented_video_jobs(
+                graph, x264_loc, mkvmerge_loc, video_input_loc, dest_loc, segments,
+                chapter_table=self.table, frame_rate='23.976')
+            qpfile_loc = os.path.join(temp_dir, 'test.part02.qp')
+            with open(qpfile_loc) as file:
+                self.assertEqual(file.read(), '43157 I\n57542 I\n71928 I\n')
+            job = graph['Video ' + os.path.join(temp_dir, 'test.part02.264')]
+            self.assertIn('--qpfile "' + qpfile_loc + '"', str(job.command))
+            self.assertIn(qpfile_loc, job.inputs)
+
+    def test_rebuilt_graph_is_up_to_date(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            dest_loc = os.path.join(temp_dir, 'test.264')
+            manifest = bench.manifest.Manifest(os.path.join(temp_dir, 'manifest.json'))
+
+            def runner(job):
+                with open(job.outputs[0], 'w') as file:
+                    file.write('encoded')
+                return 0
+
+            statuses = []
+            for _ in range(2):
+                graph = bench.jobs.JobGraph()
+                job = bench.segments.add_keyframed_video_job(
+                    graph, x264_loc, video_input_loc, dest_loc, self.table, '23.976')
+                results = bench.jobs.run_jobs(graph, 1, runner, manifest=manifest)
+                statuses.append(results[job.name].status)
+            self.assertEqual(statuses, [bench.jobs.JobResult.OK, bench.jobs.JobResult.UP_TO_DATE])
+            # A changed chapter table still rewrites the qpfile
+            qpfile_loc = bench.segments.qpfile_loc_for(dest_loc)
+            bench.segments.add_keyframed_video_job(
+                bench.jobs.JobGraph(), x264_loc, video_input_loc, dest_loc,
+                bench.chapters.ChapterTable(['Chapter 0'], [0], [90000]), '23.976')
+            with open(qpfile_loc) as file:
+                self.assertEqual(file.read(), '0 I\n')
+
+
+def make_ts_packet(pid, pts=None, stream_id=0xE0, keyframe=False):
+    # 4 byte arrival timestamp, then a 188 byte transport packet
+    packet = bytearray(b'\x00\x00\x00\x00\x47')
+    packet += bytes([(0x40 if pts is not None else 0) | (pid >> 8), pid & 0xFF])
+    if keyframe:
+        packet += bytes([0x30, 1, 0x40])
+    else:
+        packet += b'\x10'
+    if pts is not None:
+        packet += b'\x00\x00\x01' + bytes([stream_id]) + b'\x00\x00\x80\x80\x05'
+        packet += bytes([0x21 | ((pts >> 29) & 0xE), (pts >> 22) & 0xFF, ((pts >> 14) & 0xFE) | 1,
+                         (pts >> 7) & 0xFF, ((pts << 1) & 0xFE) | 1])
+    return bytes(packet + b'\xff' * (192 - len(packet)))
+
+
+class TestCrf(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        # 24 minutes in three chapters
+        self.table = bench.chapters.ChapterTable.from_chapters(make_chapters(60, 1200, 180))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_fit_exponential(self):
+        crfs = [14.0, 18.0, 22.0]
+        model = bench.crf.CrfModel.fit(crfs, [1e9 * math.exp(-0.12 * crf) for crf in crfs])
+        self.assertAlmostEqual(model.slope, -0.12)
+        self.assertAlmostEqual(model.crf_for(1e9 * math.exp(-0.12 * 20)), 20)
+        self.assertEqual(model.crf_for(1), bench.crf.MAX_CRF)
+        with self.assertRaises(ValueError):
+            bench.crf.CrfModel.fit([16, 16], [1, 2])
+
+    def test_samples_stay_in_chapters(self):
+        samples = bench.crf.plan_samples(self.table, '24', 3, 240)
+        self.assertEqual(samples, [bench.segments.Segment(5640, 240),
+                                   bench.segments.Segment(17160, 240),
+                                   bench.segments.Segment(28680, 240)])
+        # Centered on frame 1560 it would start before the chapter at 1536
+        table = bench.chapters.ChapterTable.from_chapters(make_chapters(64, 10, 56))
+        self.assertEqual(bench.crf.plan_samples(table, '24', 1, 240),
+                         [bench.segments.Segment(1536, 240)])
+        self.assertEqual(bench.crf.plan_samples(self.table, '24', 200, 240),
+                         [bench.segments.Segment(0, 34560)])
+
+    def test_predict_crf(self):
+        def runner(job):
+            argv = job.command.argv
+            crf = float(argv[argv.index('--crf') + 1])
+            frames = int(argv[argv.index('--frames') + 1])
+            with open(job.outputs[0], 'wb') as file:
+                file.write(bytes(int(frames * 50000 * math.exp(-0.1 * crf))))
+            return 0
+
+        # 34560 frames at 50000 * exp(-2.0) bytes each
+        target_size = 34560 * 50000 * math.exp(-2.0)
+        args = bench.crf.predict_crf(x264_loc, video_input_loc, self.temp_dir.name, self.table,
+                                     '24', {'preset': 'slow', 'crf': '16'},
+                                     target_size=target_size, runner=runner)
+        self.assertEqual(args, {'preset': 'slow', 'crf': '20.0'})
+        args = bench.crf.predict_crf(x264_loc, video_input_loc, self.temp_dir.name, self.table,
+                                     '24', target_bitrate=target_size * 8 / 1000 / 1440,
+                                     runner=runner)
+        self.assertEqual(args, {'crf': '20.0'})
+
+    def test_failed_sample_raises(self):
+        with self.assertRaises(subprocess.CalledProcessError):
+            bench.crf.predict_crf(x264_loc, video_input_loc, self.temp_dir.name, self.table, '24',
+                                  target_size=1000, runner=lambda job: 1)
+
+
+class TestM2ts(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.clip_loc = os.path.join(self.temp_dir.name, '00001.m2ts')
+        first_pts = 54000000
+        packets = [make_ts_packet(0x1100, first_pts, 0xBD)]
+        # A keyframe every 4 frames of 3750 ticks, in decode order I P B B
+        for gop in range(4):
+            base = first_pts + gop * 4 * 3750
+            for i, (pts, keyframe) in enumerate(((base, True), (base + 3 * 3750, False),
+                                                 (base + 3750, False), (base + 2 * 3750, False))):
+                packets.append(make_ts_packet(0x1011, pts, keyframe=keyframe))
+                packets.append(make_ts_packet(0x1011))
+        with open(self.clip_loc, 'wb') as file:
+            file.write(b''.join(packets))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_index(self):
+        with bench.m2ts.M2tsClip(self.clip_loc) as clip:
+            self.assertEqual(clip.index.pid, 0x1011)
+            self.assertEqual(len(clip.index), 16)
+            self.assertEqual(clip.index.first_pts, 54000000)
+            self.assertEqual(list(clip.index.keyframes[:5]), [1, 0, 0, 0, 1])
+            self.assertEqual(clip.index.offsets[1], 3 * 192)
+
+    def test_byte_range_starts_at_keyframe(self):
+        with bench.m2ts.M2tsClip(self.clip_loc) as clip:
+            # Frame 6 is in the second group of pictures, which starts at packet 9
+            self.assertEqual(clip.index.byte_range(6 * 3750, 8 * 3750), (9 * 192, 17 * 192))
+            self.assertEqual(clip.index.byte_range(0), (192, 33 * 192))
+
+    def test_view_and_stream(self):
+        with bench.m2ts.M2tsClip(self.clip_loc) as clip:
+            with clip.view(4 * 3750, 8 * 3750) as view:
+                self.assertEqual(len(view), 8 * 192)
+                self.assertEqual(view[4], 0x47)
+            out = io.BytesIO()
+            self.assertEqual(clip.stream_to(out, 4 * 3750, 8 * 3750, 1000), 8 * 192)
+        with open(self.clip_loc, 'rb') as file:
+            self.assertEqual(out.getvalue(), file.read()[9 * 192:17 * 192])
+
+    def test_index_is_persisted(self):
+        index_loc = os.path.join(self.temp_dir.name, '00001.idx')
+        with bench.m2ts.M2tsClip(self.clip_loc, index_loc) as clip:
+            built = clip.index
+        loaded = bench.m2ts.ClipIndex.load(index_loc, os.path.getsize(self.clip_loc))
+        self.assertEqual(loaded.pts, built.pts)
+        self.assertEqual(loaded.offsets, built.offsets)
+        self.assertIsNone(bench.m2ts.ClipIndex.load(index_loc, 1))
+
+    def test_header_overlapping_false_match(self):
+        # With PID 0x1047 an arrival timestamp ending 47 50 looks like the start of a header that
+        # runs into the real one
+        packets = [b'\x00\x00\x47\x50' + make_ts_packet(0x1047, 90000 + i * 3750, keyframe=True)[4:]
+                   for i in range(3)]
+        buffer = b''.join(packets)
+        index = bench.m2ts.ClipIndex.build(buffer, 0x1047)
+        self.assertEqual(list(index.offsets), [0, 192, 384])
+
+    def test_failed_index_unmaps_clip(self):
+        with open(self.clip_loc, 'wb') as file:
+            file.write(make_ts_packet(0x1100, 90000, 0xBD))
+        maps = []
+        real_mmap = mmap.mmap
+
+        def record_mmap(*args, **kwargs):
+            maps.append(real_mmap(*args, **kwargs))
+            return maps[-1]
+
+        with mock.patch('mmap.mmap', record_mmap), self.assertRaises(ValueError):
+            bench.m2ts.M2tsClip(self.clip_loc)
+        self.assertTrue(maps[0].closed)
+
+
+def make_y4m(levels, width=32, height=16):
+    # One frame per luma level, with a gradient so that frames within a scene differ a little
+    data = b'YUV4MPEG2 W' + str(width).encode() + b' H' + str(height).encode() \
+        + b' F24:1 Ip A1:1 C420jpeg\n'
+    for i, level in enumerate(levels):
+        luma = bytes((level + (x + i) % 4) for _ in range(height) for x in range(width))
+        data += b'FRAME\n' + luma + bytes(width * height // 2)
+    return data
+
+
+class TestScenes(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.y4m = make_y4m([20] * 10 + [100] * 15 + [220] * 15)
+        self.y4m_loc = os.path.join(self.temp_dir.name, 'video.y4m')
+        with open(self.y4m_loc, 'wb') as file:
+            file.write(self.y4m)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_header(self):
+        with bench.scenes.Y4mReader(io.BytesIO(b'YUV4MPEG2 W1920 H1080 F24000:1001 C420p10\n')) \
+                as reader:
+            self.assertEqual(reader.frame_rate, Fraction(24000, 1001))
+            self.assertEqual((reader.sample_size, reader.frame_size), (2, 1920 * 1080 * 3))
+        with self.assertRaises(ValueError):
+            bench.scenes.Y4mReader(io.BytesIO(b'RIFF'))
+        for colorspace, depth, frame_size in (('mono', 8, 16), ('mono12', 12, 32),
+                                              ('mono16', 16, 32), ('420jpeg', 8, 24)):
+            with bench.scenes.Y4mReader(io.BytesIO(b'YUV4MPEG2 W4 H4 C' + colorspace.encode()
+                                                   + b'\n')) as reader:
+                self.assertEqual((reader.bit_depth, reader.frame_size), (depth, frame_size))
+
+    def test_high_bit_depth_scores(self):
+        # Black, white, black at 2x2, scoring the whole 0 to 255 range whatever the bit depth
+        for colorspace, white, chroma in ((b'C420p10', b'\xff\x03', 4),
+                                          (b'Cmono16', b'\xff\xff', 0)):
+            black = bytes(8 + chroma)
+            y4m = b'YUV4MPEG2 W2 H2 ' + colorspace + b'\n' + b''.join(
+                b'FRAME\n' + frame for frame in (black, white * 4 + bytes(chroma), black))
+            for path_numpy in (bench.scenes.numpy, None):
+                with bench.scenes.Y4mReader(io.BytesIO(y4m)) as reader, \
+                        mock.patch.object(bench.scenes, 'numpy', path_numpy):
+                    self.assertEqual(list(bench.scenes.scene_cut_scores(reader, step=1)),
+                                     [0.0, 255.0, 255.0])
+
+    def test_scores_peak_at_cuts(self):
+        with bench.scenes.Y4mReader(self.y4m_loc) as reader:
+            scores = bench.scenes.scene_cut_scores(reader, step=1)
+        self.assertEqual(len(scores), 40)
+        self.assertEqual(sorted(range(40), key=scores.__getitem__)[-2:], [10, 25])
+        self.assertLess(max(scores[11:25]), 5)
+        with bench.scenes.Y4mReader(io.BytesIO(self.y4m)) as reader:
+            self.assertEqual(bench.scenes.scene_cut_scores(reader, step=1), scores)
+
+    def test_close_unmaps_during_lumas(self):
+        reader = bench.scenes.Y4mReader(self.y4m_loc)
+        lumas = reader.lumas()
+        first = next(lumas)
+        self.assertEqual(first[0], 20)
+        reader.close()
+        self.assertTrue(reader._file.closed)
+        with self.assertRaises(ValueError):
+            first[0]
+
+    @unittest.skipIf(bench.scenes.numpy is None, 'needs numpy')
+    def test_numpy_matches_pure_python(self):
+        # Flat frames score the same whichever pixels are looked at
+        levels = [20] * 5 + [100] * 4 + [40, 220, 221, 0]
+        data = b'YUV4MPEG2 W32 H16 F24:1 C420jpeg\n' + b''.join(
+            b'FRAME\n' + bytes([level]) * (32 * 16) + bytes(32 * 8) for level in levels)
+        y4m_loc = os.path.join(self.temp_dir.name, 'flat.y4m')
+        with open(y4m_loc, 'wb') as file:
+            file.write(data)
+        for loc in (y4m_loc, self.y4m_loc):
+            with bench.scenes.Y4mReader(loc) as reader:
+                numpy_scores = bench.scenes.scene_cut_scores(reader, step=1)
+            with bench.scenes.Y4mReader(loc) as reader, \
+                    mock.patch.object(bench.scenes, 'numpy', None):
+                python_scores = bench.scenes.scene_cut_scores(reader, step=1)
+            if loc == y4m_loc:
+                self.assertEqual(list(numpy_scores), list(python_scores))
+            else:
+                # The sparser grid sees the gradient differently, but the same cuts
+                self.assertEqual(len(numpy_scores), len(python_scores))
+                for scores in (numpy_scores, python_scores):
+                    self.assertEqual(sorted(range(40), key=scores.__getitem__)[-2:], [10, 25])
+
+    def test_plan_at_scene_cuts(self):
+        with bench.scenes.Y4mReader(self.y4m_loc) as reader:
+            scores = bench.scenes.scene_cut_scores(reader, step=1)
+        self.assertEqual(bench.scenes.plan_scene_segments(scores, 2, tolerance=0.5),
+                         [bench.segments.Segment(0, 25), bench.segments.Segment(25, 15)])
+        # A chapter start in the window wins over the scene cut
+        table = bench.chapters.ChapterTable(['Chapter 1', 'Chapter 2'], [0, 18 * 3750],
+                                            [18 * 3750, 22 * 3750])
+        self.assertEqual(bench.scenes.plan_scene_segments(scores, 2, table, '24', 0.5),
+                         [bench.segments.Segment(0, 18), bench.segments.Segment(18, 22)])
+
+
+def make_chapters(*durations):
+    ret = []
+    start = bench.chapters.Chapter.min_time
+    for i, seconds in enumerate(durations):
+        duration = bench.chapters.Chapter.min_time + timedelta(seconds=seconds)
+        ret.append(bench.chapters.Chapter('Chapter ' + str(i+1), start, duration))
+        start += timedelta(seconds=seconds)
+    return ret
+
+
+class TestChapterPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.chapters = make_chapters(60, 1, 239, 30)
+
+    def starts(self, chapters):
+        return [bench.chapters.Chapter.to_seconds(chapter.start) for chapter in chapters]
+
+    def test_remove_chapters_shorter_than(self):
+        bench.chapters.remove_chapters_shorter_than(self.chapters, 30)
+        self.assertEqual([chapter.name for chapter in self.chapters],
+                         ['Chapter 1', 'Chapter 3', 'Chapter 4'])
+
+    def test_split_chapters_leaves_source_untouched(self):
+        groups = bench.chapters.split_chapters(self.chapters, 3)
+        self.assertEqual([self.starts(group) for group in groups], [[0, 60, 61], [0]])
+        self.assertEqual(self.starts(self.chapters), [0, 60, 61, 300])
+
+    def test_pipeline_is_lazy(self):
+        seen = []
+
+        def source():
+            for chapter in self.chapters:
+                seen.append(chapter.name)
+                yield chapter
+
+        pipeline = bench.chapters.ChapterPipeline(source()).remove_shorter_than(30).offset(10)
+        self.assertEqual(seen, [])
+        self.assertEqual(self.starts(pipeline), [10, 71, 310])
+        self.assertEqual(len(seen), 4)
+
+    def test_merge_shorter_than(self):
+        merged = list(bench.chapters.ChapterPipeline(self.chapters).merge_shorter_than(30))
+        self.assertEqual(self.starts(merged), [0, 61, 300])
+        self.assertEqual(bench.chapters.Chapter.to_seconds(merged[0].duration), 61)
+
+    def test_concat_offsets_each_source(self):
+        joined = bench.chapters.ChapterPipeline.concat(self.chapters, make_chapters(10, 20))
+        self.assertEqual(self.starts(joined), [0, 60, 61, 300, 330, 340])
+
+    def test_rename_validates_at_end(self):
+        pipeline = bench.chapters.ChapterPipeline(self.chapters).rename(['a', 'b', 'c'], True)
+        self.assertRaises(ValueError, list, pipeline)
+        names = [c.name for c in bench.chapters.ChapterPipeline(self.chapters).rename(['a'])]
+        self.assertEqual(names, ['a', 'Chapter 2', 'Chapter 3', 'Chapter 4'])
+        self.assertEqual(self.chapters[0].name, 'Chapter 1')
+
+    def test_bad_arguments_raise_at_call(self):
+        pipeline = bench.chapters.ChapterPipeline(self.chapters)
+        self.assertRaises(ValueError, pipeline.split, 0)
+        self.assertRaises(ValueError, pipeline.rename, [])
+        self.assertRaises(ValueError, pipeline.rename, [], True)
+
+    def test_create_mkv_chapters_writes_nothing_on_error(self):
+        file = io.StringIO()
+        pipeline = bench.chapters.ChapterPipeline(self.chapters).rename(list('abcde'))
+        self.assertRaises(ValueError, bench.chapters.create_mkv_chapters, pipeline, file)
+        self.assertEqual(file.getvalue(), '')
+
+    def test_create_mkv_chapters_from_pipeline(self):
+        file = io.StringIO()
+        pipeline = bench.chapters.ChapterPipeline(self.chapters).remove_shorter_than(30)
+        bench.chapters.create_mkv_chapters(pipeline, file)
+        assertStrEqual(file.getvalue(), 'CHAPTER01=00:00:00\nCHAPTER01NAME=Chapter 1\n'
+                                        'CHAPTER02=00:01:01\nCHAPTER02NAME=Chapter 3\n'
+                                        'CHAPTER03=00:05:00\nCHAPTER03NAME=Chapter 4\n')
+
+
+def make_fake_bdmv(root, playlists=('00000.mpls',)):
+    os.makedirs(os.path.join(root, 'BDMV', 'PLAYLIST'))
+    with open(os.path.join(root, 'BDMV', 'index.bdmv'), 'wb') as file:
+        file.write(b'INDX0200')
+    for playlist in playlists:
+        with open(os.path.join(root, 'BDMV', 'PLAYLIST', playlist), 'wb') as file:
+            file.write(b'MPLS0200')
+
+
+class TestTitleInfoCache(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bd_loc = os.path.join(self.temp_dir.name, 'disc')
+        make_fake_bdmv(self.bd_loc)
+        self.cache = bench.cache.TitleInfoCache(os.path.join(self.temp_dir.name, 'cache'), 2)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_miss_then_hit(self):
+        self.assertIsNone(self.cache.get(self.bd_loc, 1))
+        self.cache.put(self.bd_loc, 1, {'playlist': '00000.mpls'})
+        self.assertEqual(self.cache.get(self.bd_loc, 1), {'playlist': '00000.mpls'})
+        self.assertIsNone(self.cache.get(self.bd_loc, 2))
+
+    def test_changed_disc_misses(self):
+        self.cache.put(self.bd_loc, 1, {'playlist': '00000.mpls'})
+        with open(os.path.join(self.bd_loc, 'BDMV', 'PLAYLIST', '00001.mpls'), 'wb') as file:
+            file.write(b'MPLS0200')
+        self.assertIsNone(self.cache.get(self.bd_loc, 1))
+
+    def test_invalidate(self):
+        self.cache.put(self.bd_loc, 1, {})
+        self.cache.put(self.bd_loc, 2, {})
+        self.cache.invalidate(self.bd_loc)
+        self.assertIsNone(self.cache.get(self.bd_loc, 1))
+        self.assertIsNone(self.cache.get(self.bd_loc, 2))
+
+    def test_evicts_least_recently_used(self):
+        self.cache.put(self.bd_loc, 1, {})
+        self.cache.put(self.bd_loc, 2, {})
+        fingerprint = bench.cache.disc_fingerprint(self.bd_loc)
+        os.utime(self.cache._entry_path(fingerprint, 2), ns=(0, 0))
+        self.cache.put(self.bd_loc, 3, {})
+        self.assertIsNotNone(self.cache.get(self.bd_loc, 1))
+        self.assertIsNone(self.cache.get(self.bd_loc, 2))
+        self.assertIsNotNone(self.cache.get(self.bd_loc, 3))
+
+    def test_disc_image(self):
+        iso_loc = os.path.join(self.temp_dir.name, 'disc.iso')
+        with open(iso_loc, 'wb') as file:
+            file.write(bytes(2048))
+        self.cache.put(iso_loc, 1, {'playlist': '00000.mpls'})
+        self.assertEqual(self.cache.get(iso_loc, 1), {'playlist': '00000.mpls'})
+        with open(iso_loc, 'ab') as file:
+            file.write(bytes(2048))
+        self.assertIsNone(self.cache.get(iso_loc, 1))
+
+    def test_unreadable_disc_misses(self):
+        missing = os.path.join(self.temp_dir.name, 'missing')
+        self.cache.put(missing, 1, {})
+        self.assertIsNone(self.cache.get(missing, 1))
+        self.assertEqual(os.listdir(self.cache.cache_dir), [])
+
+    def test_entry_evicted_while_read(self):
+        self.cache.put(self.bd_loc, 1, {'playlist': '00000.mpls'})
+        with mock.patch('os.utime', side_effect=FileNotFoundError):
+            self.assertEqual(self.cache.get(self.bd_loc, 1), {'playlist': '00000.mpls'})
+
+    def test_concurrent_puts(self):
+        def put(i):
+            for _ in range(20):
+                self.cache.put(self.bd_loc, 1, {'writer': i})
+        threads = [threading.Thread(target=put, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertIn(self.cache.get(self.bd_loc, 1), [{'writer': i} for i in range(4)])
+        self.assertEqual(len(os.listdir(self.cache.cache_dir)), 1)
+
+
+def make_mpls(play_items, marks, video_attributes=0x61, num_audio_tracks=2):
+    """play_items are (clip_id, in_time, out_time) and marks are (play_item, timestamp), all in
+    45 kHz ticks"""
+    stn = struct.pack('>HHBBBBBBB5x', 0, 0, 1, num_audio_tracks, 0, 0, 0, 0, 0) \
+        + b'\x09' + b'\x01\x10\x11' + bytes(6) + b'\x05' + bytes([0x1B, video_attributes]) \
+        + bytes(3)
+    items = b''
+    for clip_id, in_time, out_time in play_items:
+        item = clip_id.encode() + b'M2TS' + struct.pack('>HBII', 0, 0, in_time, out_time) \
+            + bytes(12) + stn
+        items += struct.pack('>H', len(item)) + item
+    playlist = struct.pack('>I2xHH', 0, len(play_items), 0) + items
+    mark_start = 40 + len(playlist)
+    mark_data = b''.join(struct.pack('>BBHIHI', 0, 1, item, timestamp, 0x1011, 0)
+                         for item, timestamp in marks)
+    header = b'MPLS0200' + struct.pack('>III', 40, mark_start, 0) + bytes(20)
+    return header + playlist + struct.pack('>IH', 0, len(marks)) + mark_data
+
+
+def make_clpi(video_attributes):
+    program_info = struct.pack('>IxB', 0, 1) + struct.pack('>IHBx', 0, 0x100, 2) \
+        + struct.pack('>HBBB', 0x1011, 5, 0x1B, video_attributes) + bytes(3) \
+        + struct.pack('>HBBB', 0x1100, 5, 0x81, 0x31) + bytes(3)
+    return b'HDMV0200' + struct.pack('>II', 40, 40) + bytes(24) + program_info
+
+
+class TestMpls(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.bd_loc = self.temp_dir.name
+        os.makedirs(os.path.join(self.bd_loc, 'BDMV', 'PLAYLIST'))
+        os.makedirs(os.path.join(self.bd_loc, 'BDMV', 'CLIPINF'))
+        # Two clips of 60 and 30 seconds, with chapters at 0, 20 and 60 seconds
+        self.write('PLAYLIST', '00000.mpls', make_mpls(
+            [('00001', 45000, 45000 * 61), ('00002', 90000, 90000 + 45000 * 30)],
+            [(0, 45000), (0, 45000 * 21), (1, 90000)]))
+        self.write('PLAYLIST', '00001.mpls', make_mpls([('00003', 0, 45000 * 10)], []))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write(self, directory, name, data):
+        with open(os.path.join(self.bd_loc, 'BDMV', directory, name), 'wb') as file:
+            file.write(data)
+
+    def test_read_mpls(self):
+        playlist = bench.mpls.read_mpls(os.path.join(self.bd_loc, 'BDMV', 'PLAYLIST',
+                                                     '00000.mpls'))
+        self.assertEqual([item.clip_id for item in playlist.play_items], ['00001', '00002'])
+        self.assertEqual(playlist.chapter_starts, [0, 20 * 90000, 60 * 90000])
+        self.assertEqual(playlist.duration, 90 * 90000)
+        self.assertEqual(playlist.play_items[0].num_audio_tracks, 2)
+        self.assertEqual(playlist.play_items[0].video_format, '1080p')
+        self.assertEqual(playlist.play_items[0].frame_rate, '23.976')
+
+    def test_not_a_playlist(self):
+        self.write('PLAYLIST', '00002.mpls', b'HDMV0200' + bytes(32))
+        with self.assertRaises(ValueError):
+            bench.mpls.read_mpls(os.path.join(self.bd_loc, 'BDMV', 'PLAYLIST', '00002.mpls'))
+
+    def test_title_info(self):
+        info = bench.disc.BlurayTitleInfo(self.bd_loc, backend='mpls')
+        self.assertEqual(info.title_num, 0)
+        self.assertEqual(info.playlist, '00000.mpls')
+        self.assertEqual(info.run_length.time().isoformat(), '00:01:30')
+        self.assertEqual((info.resolution, info.frame_rate), ('1080p', '23.976'))
+        self.assertEqual(info.num_audio_tracks, 2)
+        self.assertEqual(info.clip_files, ['00001.m2ts', '00002.m2ts'])
+        self.assertEqual(info.chapter_table.starts.tolist(), [0, 20 * 90000, 60 * 90000])
+        self.assertEqual(info.chapter_table.durations.tolist(),
+                         [20 * 90000, 40 * 90000, 30 * 90000])
+
+    def test_clip_info_video(self):
+        self.write('CLIPINF', '00001.clpi', make_clpi(0x43))
+        with bench.disc.BlurayDisc(self.bd_loc, backend='mpls') as disc:
+            self.assertEqual(disc.num_titles, 2)
+            self.assertEqual((disc.title().resolution, disc.title().frame_rate), ('1080i', '25'))
+            self.assertEqual(disc.title(1).chapter_table.durations.tolist(), [10 * 90000])
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            bench.disc.open_bluray(self.bd_loc, backend='libdvdread')
+
+
+class StallingCache:
+
+    """Title cache that crashes or stalls the scans of chosen discs, as a bad disc might crash or
+    stall libbluray. Picklable, so it reaches the processes of scan_discs"""
+
+    def __init__(self, crash_loc=None, stall_loc=None):
+        self.crash_loc = crash_loc
+        self.stall_loc = stall_loc
+
+    def get(self, bd_loc, title_num):
+        if bd_loc == self.crash_loc:
+            os._exit(3)
+        if bd_loc == self.stall_loc:
+            time.sleep(60)
+        return None
+
+    def put(self, bd_loc, title_num, data):
+        pass
+
+
+class TestScanDiscs(unittest.TestCase):
+
+    def setUp(self):
+        self.stall = threading.Event()
+        self.addCleanup(self.stall.set)
+
+    def bluray(self, bd_loc, bd_key_loc=None):
+        bd = bench.fake_bluread.FakeBluray(bd_loc, bd_key_loc, num_titles=2, num_chapters=3)
+        if bd_loc == 'bad':
+            bd.GetTitle = lambda title_num: 1 / 0
+        elif bd_loc == 'slow':
+            bd.Open = lambda: self.stall.wait(10)
+        return bd
+
+    def test_success_and_error(self):
+        with patch_bluread(self.bluray):
+            scans = bench.disc.scan_discs(['a', 'bad', ('b', 'KEYDB.cfg')], all_titles=True)
+        self.assertEqual([scan.bd_loc for scan in scans], ['a', 'bad', 'b'])
+        self.assertEqual([len(scan.titles) for scan in scans], [2, 0, 2])
+        self.assertIsInstance(scans[1].error, ZeroDivisionError)
+        self.assertIsNone(scans[2].error)
+        self.assertTrue(all(scan.elapsed > 0 for scan in scans))
+        self.assertEqual(bench.disc.scan_discs([]), [])
+
+    def test_timeout(self):
+        start = time.monotonic()
+        with patch_bluread(self.bluray):
+            scans = bench.disc.scan_discs(['slow', 'a', 'c'], max_workers=2, timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertIsInstance(scans[0].error, TimeoutError)
+        self.assertIn('longer than', str(scans[0].error))
+        self.assertEqual([len(scan.titles) for scan in scans[1:]], [1, 1])
+
+    def test_timeout_is_per_disc(self):
+        with patch_bluread(self.bluray):
+            scans = bench.disc.scan_discs(['slow', 'a', 'b'], max_workers=1, timeout=0.3)
+        self.assertIn('longer than', str(scans[0].error))
+        self.assertGreaterEqual(scans[0].elapsed, 0.3)
+        # The discs queued behind the stalled one get a worker of their own and their own clock
+        self.assertEqual([len(scan.titles) for scan in scans[1:]], [1, 1])
+        self.assertLess(max(scan.elapsed for scan in scans[1:]), 0.3)
+
+    def test_batch_timeout(self):
+        start = time.monotonic()
+        with patch_bluread(self.bluray):
+            scans = bench.disc.scan_discs(['slow', 'a'], max_workers=1, timeout=5,
+                                          batch_timeout=0.3)
+        self.assertLess(time.monotonic() - start, 4)
+        self.assertIn('batch timeout', str(scans[0].error))
+        self.assertIn('never started', str(scans[1].error))
+        self.assertEqual(scans[1].elapsed, 0)
+
+    def test_processes_isolate_crashes(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        good = os.path.join(temp_dir.name, 'good')
+        os.makedirs(os.path.join(good, 'BDMV', 'PLAYLIST'))
+        with open(os.path.join(good, 'BDMV', 'PLAYLIST', '00000.mpls'), 'wb') as file:
+            file.write(make_mpls([('00001', 0, 45000 * 10)], []))
+        crash, stall, missing = (os.path.join(temp_dir.name, name)
+                                 for name in ('crash', 'stall', 'missing'))
+        scans = bench.disc.scan_discs([crash, good, missing], use_processes=True,
+                                      backend='mpls', cache=StallingCache(crash))
+        self.assertIn('exited with status 3', str(scans[0].error))
+        self.assertEqual(scans[1].titles[0].playlist, '00000.mpls')
+        self.assertIsInstance(scans[2].error, OSError)
+
+        start = time.monotonic()
+        scans = bench.disc.scan_discs([stall, good], max_workers=1, timeout=2, use_processes=True,
+                                      backend='mpls', cache=StallingCache(stall_loc=stall))
+        self.assertIsInstance(scans[0].error, TimeoutError)
+        # Queued behind the stalled disc, but timed from its own start
+        self.assertEqual(scans[1].titles[0].playlist, '00000.mpls')
+        self.assertLess(time.monotonic() - start, 20)
+
+
+class TestFakeBluread(unittest.TestCase):
+
+    def test_format_ms(self):
+        self.assertEqual(bench.chapters.format_ms(3723456), '01:02:03.456')
+        self.assertEqual(bench.chapters.format_ms(0), '00:00:00.000')
+
+    def test_synthetic_disc(self):
+        with bench.fake_bluread.Bluray('fake', num_titles=2, main_title_num=1, num_chapters=3,
+                                       chapter_ms=1500, num_clips=2) as bd:
+            bd.Open()
+            self.assertTrue(bd.opened)
+            self.assertEqual((bd.NumberOfTitles, bd.MainTitleNumber), (2, 1))
+            title = bd.GetTitle(1)
+            self.assertEqual((title.Playlist, title.LengthFancy, title.NumberOfChapters),
+                             ('00001.mpls', '00:00:04.500', 3))
+            self.assertEqual((title.GetChapter(2).StartFancy, title.GetChapter(2).LengthFancy),
+                             ('00:00:03.000', '00:00:01.500'))
+            self.assertEqual([title.GetClip(i).ClipId for i in range(2)], ['00002', '00003'])
+            self.assertEqual(title.GetClip(0).GetVideo(0).Format, '6')
+            self.assertRaises(IndexError, bd.GetTitle, 2)
+        self.assertFalse(bd.opened)
+
+    def test_disc_benchmarks_run(self):
+        output = io.StringIO()
+        # benchmarks may put the fake in sys.modules as bluread, which is undone afterwards
+        with mock.patch.dict(sys.modules), mock.patch('sys.stdout', output):
+            import benchmarks
+            self.assertEqual(benchmarks.main(['-k', 'disc.', '--repeat', '1', '--number', '1']),
+                             0)
+        lines = output.getvalue().splitlines()[1:]
+        self.assertEqual(len(lines), 3)
+        self.assertFalse(any('skipped' in line for line in lines))
+
+
+def patch_bluread(bluray):
+    """Context manager making bench.disc open discs with bluray, a callable taking the same
+    arguments as bluread.Bluray, such as FakeBluray"""
+    module = types.ModuleType('bluread')
+    module.Bluray = bluray
+    return mock.patch.dict(sys.modules, {'bluread': module})
+
+
+class TestDisc(unittest.TestCase):
+
+    def test_title_info_from_fake(self):
+        bd = bench.fake_bluread.FakeBluray(num_titles=3, main_title_num=2, num_chapters=4,
+                                           chapter_ms=60000, num_clips=2)
+        info = bench.disc.BlurayTitleInfo('fake', bd=bd)
+        self.assertEqual(info.title_num, 2)
+        self.assertEqual(info.clip_files, ['00004.m2ts', '00005.m2ts'])
+        self.assertEqual(info.chapter_table.starts.tolist(), [i * 60 * 90000 for i in range(4)])
+        self.assertEqual(bench.disc.DiscTitle(bd, 2).chapter_table.durations.tolist(),
+                         info.chapter_table.durations.tolist())
+
+    def test_bluray_disc_titles(self):
+        opened = []
+
+        def bluray(bd_loc, bd_key_loc=None):
+            bd = bench.fake_bluread.FakeBluray(bd_loc, bd_key_loc, num_titles=3, main_title_num=1,
+                                               num_chapters=3, chapter_ms=60000, num_clips=2)
+            opened.append(bd)
+            return bd
+
+        with patch_bluread(bluray):
+            with bench.disc.BlurayDisc('fake/') as disc:
+                self.assertEqual((disc.bd_loc, len(disc), disc.main_title_num), ('fake', 3, 1))
+                self.assertTrue(opened[0].opened)
+                self.assertIs(disc.title(), disc.title(1))
+                self.assertEqual([title.title_num for title in disc.titles()], [0, 1, 2])
+                self.assertRaises(ValueError, disc.title, 3)
+                info = disc.title_info(2)
+                self.assertEqual((info.playlist, info.clip_files),
+                                 ('00002.mpls', ['00004.m2ts', '00005.m2ts']))
+            self.assertFalse(opened[0].opened)
+        # Every title came from the one session
+        self.assertEqual(len(opened), 1)
+
+    def test_disc_title_accessors(self):
+        bd = bench.fake_bluread.FakeBluray(num_titles=2, num_chapters=3, chapter_ms=60000,
+                                           num_clips=2, num_audio_tracks=4, video_format='4',
+                                           rate='29.97')
+        title = bench.disc.DiscTitle(bd, 1)
+        self.assertEqual(title.playlist, '00001.mpls')
+        self.assertEqual(title.run_length - bench.chapters.Chapter.min_time,
+                         timedelta(minutes=3))
+        self.assertEqual((title.resolution, title.frame_rate), ('1080i', '29.97'))
+        self.assertEqual(title.num_audio_tracks, 4)
+        self.assertEqual(title.clip_files, ['00002.m2ts', '00003.m2ts'])
+        self.assertEqual([chapter.name for chapter in title.chapters],
+                         ['Chapter 1', 'Chapter 2', 'Chapter 3'])
+        self.assertEqual(title.chapter_table.starts.tolist(), [0, 60 * 90000, 120 * 90000])
+        self.assertEqual(str(title), 'title 1: 00001.mpls 00:03:00')
+        info = bench.disc.BlurayTitleInfo('fake', 1, bd=bd)
+        for member in ('playlist', 'run_length', 'resolution', 'frame_rate', 'num_audio_tracks',
+                       'clip_files'):
+            self.assertEqual(getattr(title, member), getattr(info, member))
+
+
 if __name__ == '__main__':
     unittest.main()